@@ -0,0 +1,116 @@
+"""
+Shared setup for johnny's benchmarks.  These run outside of the test
+runner, against the ``johnny.tests.testapp`` models and fixtures, so that
+their numbers only depend on johnny, Django and the cache being measured.
+"""
+
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+FIXTURES = ['authors.json', 'genres.json', 'publishers.json', 'books.json']
+
+
+def configure(caches=None, db_name=':memory:', **extra):
+    """Configures Django with the testapp installed and a sqlite database,
+    creates its tables and loads the johnny test fixtures."""
+    from django.conf import settings
+    if caches is None:
+        caches = {
+            'default': {
+                'BACKEND': 'johnny.backends.locmem.LocMemCache',
+                'JOHNNY_CACHE': True,
+            }
+        }
+    settings.configure(
+        DEBUG=False,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': db_name,
+                # concurrent writers wait on each other instead of failing
+                'OPTIONS': {'timeout': 30},
+            }
+        },
+        CACHES=caches,
+        INSTALLED_APPS=('johnny', 'johnny.tests.testapp'),
+        **extra
+    )
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    from django.core.management import call_command
+    call_command('syncdb', verbosity=0, interactive=False)
+    call_command('loaddata', *FIXTURES, **{'verbosity': 0})
+
+
+def fake_memcached(latency=0.0):
+    """Starts johnny's fake memcached server (``johnny/tests/memcached.py``)
+    in a subprocess, adding ``latency`` seconds to every command.  Returns
+    the process and its ``host:port`` once it accepts connections."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'johnny', 'tests', 'memcached.py'),
+         '--port', str(port), '--latency', str(latency)], stdout=devnull)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            break
+        except socket.error:
+            if time.time() > deadline or proc.poll() is not None:
+                proc.terminate()
+                raise
+            time.sleep(0.05)
+    return proc, '127.0.0.1:%d' % port
+
+
+def percentile(values, pct):
+    """The ``pct``th percentile of a sorted list, by nearest rank."""
+    if not values:
+        return 0.0
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def summarize(samples):
+    """Returns summary statistics, in seconds, of a list of timings."""
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'min': samples[0],
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 50),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'max': samples[-1],
+    }
+
+
+def metadata():
+    """Describes the environment a run was made in, so that runs made on
+    different commits can be told apart."""
+    import django
+    try:
+        commit = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE).communicate()[0].decode('ascii').strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+    }
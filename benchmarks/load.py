@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Load harness for johnny under concurrency.
+
+Drives a mixed read/write workload on the testapp models from a pool of
+threads and then from a pool of processes, for each pool size given, and
+reports throughput, latency percentiles, the hit rate and the number of
+queries that reached the database.  Threads exercise the thread-local
+``LocalStore`` and the shared ``QueryCacheBackend`` state in one process;
+processes exercise invalidation across processes.
+
+The database is a sqlite file in a temporary directory.  The cache has to be
+shared by all the processes:  by default it is johnny's filebased cache in
+the same directory, or pass ``--memcached host:port`` to use a memcached
+server, or ``--fake-memcached SECONDS`` to start the fake memcached server
+from ``johnny/tests/memcached.py`` with that much latency per command.
+Process pools need a platform that can fork.
+
+    python benchmarks/load.py --workers 1,4,16 --duration 5 --writes 0.05
+"""
+
+from __future__ import print_function
+
+import json
+import multiprocessing
+import random
+import shutil
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+import common
+
+
+class Counters(object):
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.skips = 0
+        self.errors = 0
+        self.latencies = []
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class _Current(threading.local):
+    def __init__(self):
+        self.counters = Counters()
+
+_current = _Current()
+
+
+def _hit(key, tables, size):
+    _current.counters.hits += 1
+
+
+def _miss(key, tables):
+    _current.counters.misses += 1
+
+
+def _skip(key, tables):
+    _current.counters.skips += 1
+
+
+def operations():
+    from johnny.tests.testapp.models import Book, Genre, Publisher
+
+    def read_genre():
+        list(Genre.objects.filter(pk=random.randint(1, 3)))
+
+    def read_books():
+        list(Book.objects.select_related('publisher'))
+
+    def count_publishers():
+        Publisher.objects.count()
+
+    def read_authors():
+        list(Book.objects.get(pk=random.randint(1, 2)).authors.all())
+
+    def write_genre():
+        Genre.objects.filter(pk=random.randint(1, 3)).update(
+            title='Genre %d' % random.randint(0, 1000000))
+
+    return [read_genre, read_books, count_publishers, read_authors], write_genre
+
+
+def work(duration, write_ratio, seed):
+    """Runs the workload in the current thread until ``duration`` seconds
+    have passed, returning its counters as a dict."""
+    from django.db import connection
+    from johnny.compat import timer
+
+    random.seed(seed)
+    counters = _current.counters = Counters()
+    reads, write = operations()
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        if random.random() < write_ratio:
+            op = write
+            counters.writes += 1
+        else:
+            op = random.choice(reads)
+            counters.reads += 1
+        start = timer()
+        try:
+            op()
+        except Exception:
+            counters.errors += 1
+        counters.latencies.append(timer() - start)
+    connection.close()
+    return counters.as_dict()
+
+
+def _process_worker(queue, duration, write_ratio, seed):
+    from django.db import connection
+    # the connection was inherited from the parent;  get our own
+    connection.close()
+    queue.put(work(duration, write_ratio, seed))
+
+
+def run_threads(count, duration, write_ratio):
+    results = []
+
+    def target(seed):
+        results.append(work(duration, write_ratio, seed))
+    threads = [threading.Thread(target=target, args=(i,))
+               for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def run_processes(count, duration, write_ratio):
+    from django.db import connection
+    connection.close()
+    try:
+        mp = multiprocessing.get_context('fork')
+    except AttributeError:  # Python < 3.4 always forks
+        mp = multiprocessing
+    queue = mp.Queue()
+    procs = [mp.Process(target=_process_worker,
+                        args=(queue, duration, write_ratio, i))
+             for i in range(count)]
+    for p in procs:
+        p.start()
+    results = [queue.get() for p in procs]
+    for p in procs:
+        p.join()
+    return results
+
+
+def aggregate(results, duration):
+    total = Counters().as_dict()
+    latencies = []
+    for r in results:
+        latencies.extend(r.pop('latencies'))
+        for k, v in r.items():
+            total[k] += v
+    del total['latencies']
+    ops = total['reads'] + total['writes']
+    lookups = total['hits'] + total['misses']
+    total.update({
+        'ops_per_second': ops / float(duration),
+        'hit_rate': float(total['hits']) / lookups if lookups else 0.0,
+        # every miss, skip and write is one query that reached the database
+        'db_queries': total['misses'] + total['skips'] + total['writes'],
+        'latency': common.summarize(latencies) if latencies else {},
+    })
+    return total
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--workers', default='1,4,16',
+                      help='Comma separated pool sizes to run.')
+    parser.add_option('--duration', type='float', default=5.0)
+    parser.add_option('--writes', type='float', default=0.05,
+                      help='Fraction of operations that are writes.')
+    parser.add_option('--memcached', metavar='HOST:PORT',
+                      help='Use this memcached instead of a filebased cache.')
+    parser.add_option('--fake-memcached', type='float', metavar='SECONDS',
+                      help='Start the fake memcached server with this much '
+                           'latency per command and use it.')
+    parser.add_option('--no-processes', action='store_false',
+                      dest='processes', default=True)
+    parser.add_option('-o', '--output', help='Write results as json here.')
+    options, args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='johnny-load-')
+    server = None
+    try:
+        if options.fake_memcached is not None:
+            server, options.memcached = common.fake_memcached(
+                options.fake_memcached)
+        if options.memcached:
+            cache = {'BACKEND': 'johnny.backends.memcached.MemcachedCache',
+                     'LOCATION': options.memcached}
+        else:
+            cache = {'BACKEND': 'johnny.backends.filebased.FileBasedCache',
+                     'LOCATION': tmp + '/cache'}
+        cache['JOHNNY_CACHE'] = True
+        common.configure(caches={'default': cache}, db_name=tmp + '/db.sqlite')
+
+        from johnny import cache as johnny_cache, hooks
+        johnny_cache.enable()
+        hooks.register('hit', _hit)
+        hooks.register('miss', _miss)
+        hooks.register('skip', _skip)
+
+        kinds = [('threads', run_threads)]
+        if options.processes:
+            kinds.append(('processes', run_processes))
+        results = []
+        print('%-10s %7s %10s %8s %10s %9s %9s %9s %7s' % (
+            'pool', 'workers', 'ops/s', 'hit rate', 'db queries', 'p50',
+            'p90', 'p99', 'errors'))
+        for kind, runner in kinds:
+            for count in [int(n) for n in options.workers.split(',')]:
+                total = aggregate(
+                    runner(count, options.duration, options.writes),
+                    options.duration)
+                total.update({'pool': kind, 'workers': count})
+                results.append(total)
+                lat = total['latency']
+                print('%-10s %7d %10.1f %7.1f%% %10d %7.2fms %7.2fms '
+                      '%7.2fms %7d' % (
+                          kind, count, total['ops_per_second'],
+                          total['hit_rate'] * 100, total['db_queries'],
+                          lat.get('p50', 0) * 1000, lat.get('p90', 0) * 1000,
+                          lat.get('p99', 0) * 1000, total['errors']))
+        if options.output:
+            f = open(options.output, 'w')
+            try:
+                json.dump({'meta': common.metadata(),
+                           'duration': options.duration,
+                           'writes': options.writes,
+                           'cache': cache['BACKEND'],
+                           'fake_memcached': options.fake_memcached,
+                           'results': results}, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+    finally:
+        if server is not None:
+            server.terminate()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks of the per-query overhead of johnny's query cache.
+
+Each query shape is run uncached (johnny unpatched), as a cache miss, as a
+cache hit and with its tables blacklisted, against an in-memory sqlite
+database and johnny's locmem cache, or with ``--memcached-latency`` the
+fake memcached server from ``johnny/tests/memcached.py`` (this needs
+python-memcached), so that round trips and pickling are paid for.  The
+overhead of each mode is its time minus the uncached time.  Results can be
+written as json and compared::
+
+    python benchmarks/querycache.py --output before.json
+    # ... change something ...
+    python benchmarks/querycache.py --output after.json
+    python benchmarks/querycache.py --compare before.json after.json
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+from optparse import OptionParser
+
+import common
+
+MODES = ('uncached', 'miss', 'hit', 'blacklisted')
+
+
+def shapes():
+    """Returns (name, query function, tables) for each query shape."""
+    from johnny.tests.testapp.models import Book, Genre, Person, PersonType
+
+    book = Book.objects.get(pk=1)
+    return [
+        ('single', lambda: list(Genre.objects.filter(pk=1)),
+         ['testapp_genre']),
+        ('join', lambda: list(Book.objects.select_related('publisher')),
+         ['testapp_book', 'testapp_publisher']),
+        ('m2m', lambda: list(book.authors.all()),
+         ['testapp_person', 'testapp_book_authors']),
+        ('subselect', lambda: Book.objects.filter(authors__in=
+            Person.objects.filter(person_types__in=
+                PersonType.objects.filter(title='Author'))).count(),
+         ['testapp_book', 'testapp_book_authors', 'testapp_person',
+          'testapp_person_person_types', 'testapp_persontype']),
+    ]
+
+
+def run_mode(mode, query, tables, iterations, warmup):
+    from johnny import cache, settings
+    from johnny.compat import timer
+
+    backend = cache.get_backend()
+    saved_blacklist = settings.BLACKLIST
+    if mode == 'uncached':
+        backend.unpatch()
+    else:
+        backend.patch()
+    if mode == 'blacklisted':
+        settings.BLACKLIST = set(tables)
+    samples = []
+    try:
+        for i in range(warmup + iterations):
+            if mode == 'miss':
+                cache.invalidate(*tables)
+            start = timer()
+            query()
+            elapsed = timer() - start
+            if i >= warmup:
+                samples.append(elapsed)
+    finally:
+        settings.BLACKLIST = saved_blacklist
+    return common.summarize(samples)
+
+
+def run(iterations, warmup, only=None):
+    results = {}
+    for name, query, tables in shapes():
+        if only and name not in only:
+            continue
+        results[name] = {}
+        for mode in MODES:
+            results[name][mode] = run_mode(mode, query, tables, iterations,
+                                           warmup)
+        base = results[name]['uncached']['p50']
+        for mode in MODES[1:]:
+            results[name][mode]['overhead_p50'] = (
+                results[name][mode]['p50'] - base)
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write('%-10s %-12s %10s %10s %10s %12s\n' % (
+        'shape', 'mode', 'p50', 'p90', 'p99', 'overhead'))
+    for name in sorted(results):
+        for mode in MODES:
+            r = results[name][mode]
+            overhead = r.get('overhead_p50')
+            out.write('%-10s %-12s %8.1fus %8.1fus %8.1fus %12s\n' % (
+                name, mode, r['p50'] * 1e6, r['p90'] * 1e6, r['p99'] * 1e6,
+                '' if overhead is None else '%+.1fus' % (overhead * 1e6)))
+
+
+def compare(before, after, out=sys.stdout):
+    out.write('%-10s %-12s %10s %10s %8s\n' % (
+        'shape', 'mode', 'before', 'after', 'change'))
+    for name in sorted(after['results']):
+        for mode in MODES:
+            try:
+                old = before['results'][name][mode]['p50']
+            except KeyError:
+                continue
+            new = after['results'][name][mode]['p50']
+            out.write('%-10s %-12s %8.1fus %8.1fus %+7.1f%%\n' % (
+                name, mode, old * 1e6, new * 1e6,
+                (new - old) / old * 100 if old else 0.0))
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--iterations', type='int', default=2000)
+    parser.add_option('-w', '--warmup', type='int', default=200)
+    parser.add_option('-s', '--shape', action='append', dest='shapes',
+                      help='Only run this shape; can be repeated.')
+    parser.add_option('-o', '--output', help='Write results as json here.')
+    parser.add_option('--memcached-latency', type='float', metavar='SECONDS',
+                      help='Cache in the fake memcached server, adding this '
+                           'much latency to each command, instead of locmem.')
+    parser.add_option('--compare', nargs=2, metavar='BEFORE AFTER',
+                      help='Compare two json result files and exit.')
+    options, args = parser.parse_args(argv)
+
+    if options.compare:
+        files = [json.load(open(f)) for f in options.compare]
+        compare(*files)
+        return
+
+    server = None
+    caches = None
+    if options.memcached_latency is not None:
+        server, location = common.fake_memcached(options.memcached_latency)
+        caches = {'default': {
+            'BACKEND': 'johnny.backends.memcached.MemcachedCache',
+            'LOCATION': location,
+            'JOHNNY_CACHE': True,
+        }}
+    try:
+        common.configure(caches)
+        results = run(options.iterations, options.warmup, options.shapes)
+    finally:
+        if server is not None:
+            server.terminate()
+    report(results)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump({'meta': common.metadata(),
+                       'iterations': options.iterations,
+                       'memcached_latency': options.memcached_latency,
+                       'results': results}, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
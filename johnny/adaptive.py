@@ -0,0 +1,278 @@
+"""Adaptive caching decisions based on observed query and table behavior."""
+
+import threading
+import time
+
+from . import settings, signals
+
+
+class QueryCost(object):
+    """Running timing statistics for a single query shape."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = 0.0
+        self.average = 0.0
+
+    def add(self, seconds, smoothing):
+        self.count += 1
+        self.total += seconds
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+        if self.count == 1:
+            self.average = seconds
+        else:
+            # exponentially weighted, so a shape that gets slower over time
+            # (eg. a table that grows) finds its way back into the cache
+            self.average += smoothing * (seconds - self.average)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class QueryCostTracker(object):
+    """
+    Keeps database timing statistics for each query *shape* that misses the
+    query cache, where a shape is the database alias, the result type and the
+    sql template (without its params).  Once a shape has been seen
+    ``JOHNNY_MIN_QUERY_SAMPLES`` times, it is excluded from the cache while
+    its average database time stays below ``JOHNNY_MIN_QUERY_SECONDS``;  for
+    queries like indexed primary key lookups, the md5, generation fetch and
+    cache round trip cost more than the query does.
+
+    Excluded shapes still go to the database and are still timed, so they
+    are cached again if they become slower.  Tracking is disabled while
+    ``JOHNNY_MIN_QUERY_SECONDS`` is ``0``, the default.
+    """
+    # new shapes beyond this many are never excluded; keeps memory bounded
+    # for apps that generate lots of one-off sql (like long IN clauses)
+    max_shapes = 2000
+    smoothing = 0.2
+
+    def __init__(self):
+        self.shapes = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return settings.MIN_QUERY_SECONDS > 0
+
+    def record(self, shape, seconds):
+        """Record the database time, in seconds, of one run of ``shape``."""
+        self.lock.acquire()
+        try:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                if len(self.shapes) >= self.max_shapes:
+                    return
+                stats = self.shapes[shape] = QueryCost()
+            stats.add(seconds, self.smoothing)
+        finally:
+            self.lock.release()
+
+    def is_cheap(self, shape):
+        """Returns True if ``shape`` should bypass the query cache."""
+        stats = self.shapes.get(shape)
+        if stats is None or stats.count < settings.MIN_QUERY_SAMPLES:
+            return False
+        return stats.average < settings.MIN_QUERY_SECONDS
+
+    def reason(self, stats):
+        threshold = settings.MIN_QUERY_SECONDS * 1000
+        if stats.count < settings.MIN_QUERY_SAMPLES:
+            return "cached; only %d of %d samples" % (
+                stats.count, settings.MIN_QUERY_SAMPLES)
+        if stats.average < settings.MIN_QUERY_SECONDS:
+            return "excluded; average %.3fms below %.3fms threshold" % (
+                stats.average * 1000, threshold)
+        return "cached; average %.3fms at or above %.3fms threshold" % (
+            stats.average * 1000, threshold)
+
+    def report(self):
+        """Returns a list of dicts describing every tracked shape, excluded
+        shapes first, each with the reason for the decision made on it."""
+        self.lock.acquire()
+        try:
+            items = list(self.shapes.items())
+        finally:
+            self.lock.release()
+        report = []
+        for (db, result_type, sql), stats in items:
+            report.append({
+                'db': db,
+                'result_type': result_type,
+                'sql': sql,
+                'count': stats.count,
+                'average': stats.average,
+                'mean': stats.mean,
+                'min': stats.minimum,
+                'max': stats.maximum,
+                'excluded': self.is_cheap((db, result_type, sql)),
+                'reason': self.reason(stats),
+            })
+        report.sort(key=lambda r: (not r['excluded'], r['average']))
+        return report
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.shapes.clear()
+        finally:
+            self.lock.release()
+
+
+query_costs = QueryCostTracker()
+
+
+class TableActivity(object):
+    """Invalidation, hit and miss counts for one table, kept in one second
+    buckets over a sliding window."""
+    def __init__(self, window):
+        self.window = window
+        self.stamps = [None] * window
+        self.invalidations = [0] * window
+        self.hits = [0] * window
+        self.misses = [0] * window
+        self.checked = 0
+
+    def _bucket(self, now):
+        second = int(now)
+        idx = second % self.window
+        if self.stamps[idx] != second:
+            self.stamps[idx] = second
+            self.invalidations[idx] = self.hits[idx] = self.misses[idx] = 0
+        return idx
+
+    def add(self, counter, now):
+        getattr(self, counter)[self._bucket(now)] += 1
+
+    def totals(self, now):
+        oldest = int(now) - self.window
+        invalidations = hits = misses = 0
+        for i, stamp in enumerate(self.stamps):
+            if stamp is not None and stamp > oldest:
+                invalidations += self.invalidations[i]
+                hits += self.hits[i]
+                misses += self.misses[i]
+        return invalidations, hits, misses
+
+
+class TableBypassTracker(object):
+    """
+    Tracks how often each table is invalidated and how often queries on it
+    hit the cache.  Tables invalidated more than
+    ``JOHNNY_BYPASS_INVALIDATION_RATE`` times per second over the last
+    ``JOHNNY_BYPASS_WINDOW`` seconds, whose hit rate is below
+    ``JOHNNY_BYPASS_MAX_HIT_RATE``, are bypassed:  reads on them go straight
+    to the database, though writes still invalidate them.  A table comes out
+    of bypass once its invalidation rate drops below ``hysteresis`` times the
+    threshold.  The ``qc_bypass`` signal is sent whenever a table goes in or
+    out of bypass.
+
+    Rates are per process;  each process decides on its own based on the
+    writes it has seen.  Tracking is disabled while
+    ``JOHNNY_BYPASS_INVALIDATION_RATE`` is ``0``, the default.  ``clock``
+    returns the current time, in seconds.
+    """
+    hysteresis = 0.5
+    # how often a bypassed table is checked for having cooled down
+    recheck_seconds = 1
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.tables = {}
+        self.bypassed = set()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return settings.BYPASS_INVALIDATION_RATE > 0
+
+    def _activity(self, table):
+        activity = self.tables.get(table)
+        if activity is None:
+            self.lock.acquire()
+            try:
+                activity = self.tables.setdefault(
+                    table, TableActivity(max(int(settings.BYPASS_WINDOW), 1)))
+            finally:
+                self.lock.release()
+        return activity
+
+    def rates(self, table, now=None):
+        """Returns the (invalidations per second, hit rate) of ``table``."""
+        now = now or self.clock()
+        activity = self._activity(table)
+        invalidations, hits, misses = activity.totals(now)
+        lookups = hits + misses
+        return (float(invalidations) / activity.window,
+                float(hits) / lookups if lookups else 0.0)
+
+    def record_invalidation(self, table):
+        now = self.clock()
+        self._activity(table).add('invalidations', now)
+        if table not in self.bypassed:
+            rate, hit_rate = self.rates(table, now)
+            if (rate >= settings.BYPASS_INVALIDATION_RATE and
+                    hit_rate < settings.BYPASS_MAX_HIT_RATE):
+                self._set_bypass(table, True, rate, hit_rate)
+
+    def record_hit(self, tables):
+        now = self.clock()
+        for table in tables:
+            self._activity(table).add('hits', now)
+
+    def record_miss(self, tables):
+        now = self.clock()
+        for table in tables:
+            self._activity(table).add('misses', now)
+
+    def is_bypassed(self, tables):
+        """Returns True if any of ``tables`` is bypassed, first letting any
+        table that has cooled down out of bypass."""
+        if not self.bypassed:
+            return False
+        bypassed = self.bypassed.intersection(tables)
+        if not bypassed:
+            return False
+        now = self.clock()
+        exit_rate = settings.BYPASS_INVALIDATION_RATE * self.hysteresis
+        for table in bypassed:
+            activity = self._activity(table)
+            # re-evaluating is O(window), so don't do it on every read
+            if now - activity.checked < self.recheck_seconds:
+                continue
+            activity.checked = now
+            rate, hit_rate = self.rates(table, now)
+            if rate < exit_rate:
+                self._set_bypass(table, False, rate, hit_rate)
+        return bool(self.bypassed.intersection(tables))
+
+    def _set_bypass(self, table, bypassed, rate, hit_rate):
+        self.lock.acquire()
+        try:
+            if bypassed == (table in self.bypassed):
+                return
+            if bypassed:
+                self.bypassed = self.bypassed | set([table])
+            else:
+                self.bypassed = self.bypassed - set([table])
+        finally:
+            self.lock.release()
+        signals.qc_bypass.send(sender=self, table=table, bypassed=bypassed,
+                               invalidation_rate=rate, hit_rate=hit_rate)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.tables.clear()
+            self.bypassed = set()
+        finally:
+            self.lock.release()
+
+
+table_bypass = TableBypassTracker()
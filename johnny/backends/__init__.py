@@ -20,10 +20,11 @@ Example usage::
         }
     }
 
-**Important Note**:  The ``locmem`` and ``filebased`` caches are NOT
-recommended for setups in which there is more than one server using Johnny;
-invalidation will break with potentially disasterous results if the cache
-Johnny uses is not shared amongst all machines writing to the database.
+**Important Note**:  The ``locmem``, ``filebased``, ``segments`` and ``shm``
+caches are NOT recommended for setups in which there is more than one server
+using Johnny;  invalidation will break with potentially disasterous results if
+the cache Johnny uses is not shared amongst all machines writing to the
+database.
 """
 
-__all__ = ['memcached', 'locmem', 'filebased']
+__all__ = ['memcached', 'locmem', 'filebased', 'segments', 'shm', 'tiered']
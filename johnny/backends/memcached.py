@@ -4,6 +4,10 @@ of 0.
 """
 
 import logging
+import re
+import threading
+import time
+import zlib
 
 from django.core.cache.backends import memcached
 
@@ -47,3 +51,198 @@ class FailSilentlyMemcachedCache(MemcachedCache):
             super(FailSilentlyMemcachedCache, self).set(*args, **kwargs)
         except ValueError:
             logging.warning("Couldn't set the key for the cache")
+
+
+_tag_re = re.compile(r'\{([^{}]+)\}')
+
+
+class TaggedMemcachedCache(MemcachedCache):
+    """
+    A ``MemcachedCache`` that puts keys with the same ``{tag}`` in them on
+    the same server, picked by a hash of the tag, the way a Redis Cluster
+    does.  With ``JOHNNY_SHARD_TAGS``, the generation keys a query reads
+    then come from one server, in one ``get_multi``.  Works with
+    python-memcached, which takes ``(hash, key)`` tuples for keys.
+    """
+    def make_key(self, key, version=None):
+        key = super(TaggedMemcachedCache, self).make_key(key, version=version)
+        match = _tag_re.search(key)
+        if match is None:
+            return key
+        tag = match.group(1).encode('utf-8')
+        hash = getattr(self._lib, 'serverHashFunction', None)
+        if hash is None:
+            hash = zlib.crc32
+        return (hash(tag) & 0x7fffffff, key)
+
+    def get_many(self, keys, version=None):
+        made = dict((self.make_key(k, version=version), k) for k in keys)
+        found = self._cache.get_multi(list(made))
+        # replies are keyed by the key, without its hash
+        names = dict((m[1] if isinstance(m, tuple) else m, k)
+                     for m, k in made.items())
+        return dict((names[k], v) for k, v in found.items())
+
+    def set_many(self, data, *args, **kwargs):
+        # python-memcached's set_multi looks values up by the key without
+        # its hash, so keys with a tag are set one at a time
+        rest = {}
+        for key, value in data.items():
+            if _tag_re.search(key) is None:
+                rest[key] = value
+            else:
+                self.set(key, value, *args, **kwargs)
+        if rest:
+            super(TaggedMemcachedCache, self).set_many(rest, *args, **kwargs)
+
+
+class PoolTimeout(Exception):
+    """Raised when no memcached client could be checked out of a
+    ``ClientPool`` in time."""
+
+
+class ClientPool(object):
+    """
+    A bounded pool of memcached clients, made by calling ``create`` as they
+    are needed, up to ``max_size`` of them.  Threads wait up to ``timeout``
+    seconds for a client to come back before ``acquire`` raises
+    ``PoolTimeout``.
+    """
+    def __init__(self, create, max_size=10, timeout=5):
+        self.create = create
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        self._condition = threading.Condition()
+        self.created = 0
+        self.in_use = 0
+        self.peak = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def acquire(self):
+        self._condition.acquire()
+        try:
+            if not self._idle and self.created >= self.max_size:
+                self.waits += 1
+                start = time.time()
+                deadline = start + self.timeout
+                while not self._idle and self.created >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        self.wait_time += time.time() - start
+                        raise PoolTimeout('No memcached client free after '
+                                          '%s seconds.' % self.timeout)
+                    self._condition.wait(remaining)
+                self.wait_time += time.time() - start
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
+        finally:
+            self._condition.release()
+        try:
+            return self.create()
+        except Exception:
+            self._condition.acquire()
+            try:
+                self.created -= 1
+                self.in_use -= 1
+                self._condition.notify()
+            finally:
+                self._condition.release()
+            raise
+
+    def release(self, client):
+        self._condition.acquire()
+        try:
+            self.in_use -= 1
+            self._idle.append(client)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def stats(self):
+        """Returns the pool's usage counters as a dict."""
+        self._condition.acquire()
+        try:
+            return {'size': self.created, 'max_size': self.max_size,
+                    'idle': len(self._idle), 'in_use': self.in_use,
+                    'peak': self.peak, 'checkouts': self.checkouts,
+                    'waits': self.waits, 'wait_time': self.wait_time,
+                    'timeouts': self.timeouts}
+        finally:
+            self._condition.release()
+
+    def disconnect_all(self):
+        """Drops the connections of the idle clients."""
+        self._condition.acquire()
+        try:
+            idle = list(self._idle)
+        finally:
+            self._condition.release()
+        for client in idle:
+            if hasattr(client, 'disconnect_all'):
+                client.disconnect_all()
+
+
+class _PooledClient(object):
+    """Stands in for a client, checking one out of the pool for each
+    call."""
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        pool = self._pool
+
+        def call(*args, **kwargs):
+            client = pool.acquire()
+            try:
+                return getattr(client, name)(*args, **kwargs)
+            finally:
+                pool.release(client)
+        return call
+
+
+class PooledPyLibMCCache(PyLibMCCache):
+    """
+    A ``PyLibMCCache`` that shares a bounded pool of pylibmc clients between
+    threads, where Django makes a client, and so a connection to each
+    server, for every thread.  The pool puts a limit on those connections.
+    The clients keep their connections across requests, so
+    ``close``, which Django calls when a request finishes, does nothing.
+    The ``POOL_SIZE`` (default 10) and ``POOL_TIMEOUT`` (default 5 seconds)
+    options size the pool;  the other options are pylibmc behaviors.
+    ``pool_stats`` returns the pool's usage counters.
+    """
+    def __init__(self, server, params):
+        params = dict(params)
+        options = dict(params.get('OPTIONS') or {})
+        size = int(options.pop('POOL_SIZE', 10))
+        timeout = float(options.pop('POOL_TIMEOUT', 5))
+        # BaseCache reads MAX_ENTRIES out of OPTIONS, so it must be a dict
+        params['OPTIONS'] = options
+        super(PooledPyLibMCCache, self).__init__(server, params)
+        self._pool = ClientPool(self._make_client, size, timeout)
+        self._pooled_client = _PooledClient(self._pool)
+
+    def _make_client(self):
+        client = self._lib.Client(self._servers)
+        if self._options:
+            client.behaviors = self._options
+        return client
+
+    @property
+    def _cache(self):
+        return self._pooled_client
+
+    def close(self, **kwargs):
+        pass
+
+    def pool_stats(self):
+        return self._pool.stats()
@@ -7,8 +7,20 @@ cache invalidation other than timeouts.
 This module depends on the ``django-redis-cache`` app from PyPI.
 """
 
+from __future__ import absolute_import
+
+import re
+
+try:
+    import cPickle as pickle
+except ImportError:  # Python 3
+    import pickle
+
+from redis.exceptions import ResponseError
 from redis_cache import cache as redis
 
+from johnny.compat import force_text
+
 
 class RedisCache(redis.RedisCache):
     def set(self, key, value, timeout=None, *args, **kwargs):
@@ -16,3 +28,221 @@ class RedisCache(redis.RedisCache):
             timeout = 2591999
         return super(RedisCache, self).set(key, value, timeout,
                                            *args, **kwargs)
+
+
+def _single_client(cache):
+    """Returns the redis client of ``cache``, or None if its keys are
+    sharded over several servers (django-redis-cache >= 1.0 can do that)."""
+    clients = getattr(cache, 'clients', None)
+    if clients is not None:
+        if len(clients) != 1:
+            return None
+        return list(clients.values())[0]
+    return cache._client
+
+
+def _encode(cache, value):
+    if hasattr(cache, 'prep_value'):
+        return cache.prep_value(value)  # django-redis-cache >= 1.0
+    if hasattr(cache, 'pickle'):
+        return cache.pickle(value)
+    # as older versions' set() stores them:  ints as they are
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return pickle.dumps(value)
+
+
+def _decode(cache, value):
+    if hasattr(cache, 'get_value'):
+        return cache.get_value(value)  # django-redis-cache >= 1.0
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return cache.unpickle(value)
+
+
+# KEYS are the table generation keys, ARGV the cache's key prefix, the
+# johnny multi and query key prefixes, and the query's key suffix.  Returns
+# {0} if a generation is missing, {1, generation} on a miss and
+# {2, generation, value} on a hit.
+LOOKUP_SCRIPT = """
+local gens = redis.call('MGET', unpack(KEYS))
+for i = 1, #gens do
+    if not gens[i] then return {0} end
+end
+local gen = gens[1]
+if #gens > 1 then
+    gen = redis.call('GET', ARGV[1] .. ARGV[2] ..
+                     redis.sha1hex(table.concat(gens, ':')))
+    if not gen then return {0} end
+end
+local val = redis.call('GET', ARGV[1] .. ARGV[3] .. gen .. '.' .. ARGV[4])
+if not val then return {1, gen} end
+return {2, gen, val}
+"""
+
+
+class ScriptedRedisCache(RedisCache):
+    """
+    A ``RedisCache`` that lets johnny read a query's table generations, its
+    multi generation and its cached result in a single round trip, with a
+    Lua script, where the normal backends take one round trip for each.  It
+    needs Redis 2.6 and the default ``KEY_FUNCTION``;  the script reads keys
+    it derives itself, so it doesn't work with a Redis Cluster or with
+    several ``LOCATION``\\ s.  When a generation is missing, the lookup falls
+    back to the usual path, which creates it.
+    """
+    johnny_keygen = 'johnny.backends.redis_keys.ScriptedRedisKeyGen'
+    johnny_keyhandler = 'johnny.backends.redis_keys.ScriptedRedisKeyHandler'
+
+    def lookup_query(self, table_keys, multi_prefix, query_prefix, suffix):
+        """
+        Runs the lookup script, returning None if a generation is missing,
+        or the query's generation and its cached value, which is a
+        ``NotInCache`` on a miss.
+        """
+        from johnny.cache import NotInCache
+        client = _single_client(self)
+        # django-redis-cache < 1.0 makes CacheKey objects
+        key_prefix = force_text(self.make_key(''))
+        if (client is None or
+                force_text(self.make_key('x')) != key_prefix + 'x'):
+            return None
+        script = getattr(client, '_johnny_lookup', None)
+        if script is None:
+            script = client._johnny_lookup = client.register_script(
+                LOOKUP_SCRIPT)
+        reply = script(keys=[self.make_key(k) for k in table_keys],
+                       args=[key_prefix, multi_prefix, query_prefix, suffix])
+        if reply[0] == 0:
+            return None
+        generation = force_text(reply[1])
+        if reply[0] == 1:
+            return generation, NotInCache()
+        return generation, _decode(self, reply[2])
+
+
+class GenerationHashRedisCache(RedisCache):
+    """
+    A ``RedisCache`` that keeps johnny's cached query results in one hash
+    per generation, instead of one key per query.  When a table's generation
+    is replaced, the hash of its old generation, and those of the multi
+    generations made from it, are ``UNLINK``\\ ed (or deleted, before Redis
+    4), so their memory is reclaimed right away instead of when the results
+    expire.  Other keys are stored as usual.
+
+    Query keys are recognized by their format, so that results written when
+    a transaction commits end up in the right hash too.  The timeout of a
+    hash is renewed by every result written to it.  When the keys are
+    sharded over several servers, everything is stored as usual.
+    """
+    johnny_keyhandler = 'johnny.backends.redis_keys.GenerationHashKeyHandler'
+
+    def __init__(self, *args, **kwargs):
+        super(GenerationHashRedisCache, self).__init__(*args, **kwargs)
+        self._query_re = self._table_re = None
+
+    def _prefix(self):
+        # johnny's settings import the default cache, which may be this one
+        from johnny import settings
+        return settings.MIDDLEWARE_KEY_PREFIX
+
+    def _compile(self):
+        prefix = re.escape(self._prefix())
+        # the suffix carries the {tag} of JOHNNY_SHARD_RESULTS, if any
+        self._query_re = re.compile(
+            r'^(%s_.+?)_query_([^.]+)\.(.+)$' % prefix)
+        self._table_re = re.compile(r'^(%s_.+?)_table_' % prefix)
+
+    def _result_field(self, key):
+        """Returns the hash and field of the result cached under the johnny
+        query key ``key``, or None if it isn't one or the keys are sharded."""
+        if self._query_re is None:
+            self._compile()
+        match = self._query_re.match(key)
+        if match is None or _single_client(self) is None:
+            return None
+        head, generation, suffix = match.groups()
+        return self.make_key('%s_results_%s' % (head, generation)), suffix
+
+    def _timeout(self, timeout):
+        if not isinstance(timeout, (int, float)):
+            # None, or Django 1.6's DEFAULT_TIMEOUT
+            timeout = self.default_timeout
+        if not timeout or timeout > 2591999:
+            timeout = 2591999
+        return int(timeout)
+
+    def get(self, key, default=None, *args, **kwargs):
+        field = self._result_field(key)
+        if field is None:
+            return super(GenerationHashRedisCache, self).get(
+                key, default, *args, **kwargs)
+        value = _single_client(self).hget(*field)
+        if value is None:
+            return default
+        return _decode(self, value)
+
+    def set(self, key, value, timeout=None, *args, **kwargs):
+        field = self._result_field(key)
+        if field is not None:
+            pipe = _single_client(self).pipeline()
+            pipe.hset(field[0], field[1], _encode(self, value))
+            pipe.expire(field[0], self._timeout(timeout))
+            pipe.execute()
+            return
+        match = self._table_re.match(key)
+        client = _single_client(self)
+        if match is None or client is None or args or kwargs:
+            return super(GenerationHashRedisCache, self).set(
+                key, value, timeout, *args, **kwargs)
+        # a table's generation:  swap it and reclaim the old one's results
+        key = self.make_key(key)
+        pipe = client.pipeline()
+        pipe.getset(key, _encode(self, value))
+        pipe.expire(key, self._timeout(timeout))
+        old = pipe.execute()[0]
+        if old is not None:
+            old = _decode(self, old)
+            if old != value:
+                self.reclaim(match.group(1), old)
+
+    def set_many(self, data, timeout=None, *args, **kwargs):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+
+    def delete(self, key, *args, **kwargs):
+        field = self._result_field(key)
+        if field is None:
+            return super(GenerationHashRedisCache, self).delete(
+                key, *args, **kwargs)
+        _single_client(self).hdel(*field)
+
+    def _deps_key(self, generation):
+        return self.make_key('%s_deps_%s' % (self._prefix(), generation))
+
+    def add_dependencies(self, generations, multi):
+        """Records that the multi generation ``multi`` is made of the table
+        ``generations``."""
+        client = _single_client(self)
+        if client is None:
+            return
+        pipe = client.pipeline()
+        for generation in generations:
+            deps = self._deps_key(generation)
+            pipe.sadd(deps, multi)
+            pipe.expire(deps, self._timeout(None))
+        pipe.execute()
+
+    def reclaim(self, head, generation):
+        """Drops the results cached under a table's old ``generation`` and
+        under every multi generation made from it."""
+        client = _single_client(self)
+        deps = self._deps_key(generation)
+        multis = [force_text(m) for m in client.smembers(deps)]
+        keys = [deps] + [self.make_key('%s_results_%s' % (head, g))
+                         for g in [generation] + multis]
+        try:
+            client.execute_command('UNLINK', *keys)
+        except ResponseError:  # Redis < 4
+            client.delete(*keys)
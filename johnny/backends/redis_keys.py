@@ -0,0 +1,79 @@
+"""
+The key classes of the johnny backends in ``johnny.backends.redis``, which
+name them by their dotted path:  a cache backend module can't import
+``johnny.cache`` when Django makes its default cache, as johnny's settings
+import that cache.
+"""
+
+import binascii
+import os
+from hashlib import sha1
+
+from johnny import settings, stats
+from johnny.cache import KeyGen, KeyHandler
+from johnny.compat import force_bytes, force_text
+from johnny.hotkeys import hot_keys
+
+
+class ScriptedRedisKeyGen(KeyGen):
+    """
+    Generations are integers, which django-redis-cache stores as plain
+    numbers rather than pickles, and multi keys are a sha1 of them, so that
+    a Lua script on the server can derive query keys from the generations.
+    """
+    def random_generator(self):
+        # 62 random bits, from os.urandom, so forked processes don't repeat
+        return int(binascii.hexlify(os.urandom(8)), 16) >> 2
+
+    def multi_key_prefix(self, db='default'):
+        db = settings.DB_CACHE_KEYS[db]
+        if db and len(db) > 100:
+            db = db[0:68] + self.gen_key(db[68:])
+        return '%s_%s_multi_' % (self.prefix, db)
+
+    def gen_multi_key(self, values, db='default', tables=()):
+        values = ':'.join(force_text(v) for v in values)
+        return (self.query_route(tables, db) + self.multi_key_prefix(db) +
+                sha1(force_bytes(values)).hexdigest())
+
+
+class ScriptedRedisKeyHandler(KeyHandler):
+    """Looks up a query's generations and cached result with one call to
+    the ``LOOKUP_SCRIPT`` of a ``ScriptedRedisCache``."""
+    single_trip = True
+
+    def lookup(self, tables, sql, params, order, result_type, db='default'):
+        manager = self.cache_backend
+        # the generations of a transaction's writes are still local, and
+        # debounced and replicated tables aren't read from their table key
+        if manager.is_managed(db) and manager._patched_var:
+            return None
+        # the script doesn't know about shard tags or routes
+        if settings.SHARD_TAGS or settings.CACHE_ROUTERS:
+            return None
+        for table in tables:
+            if table in settings.TABLE_DEBOUNCE or table in settings.TABLE_REPLICAS:
+                return None
+        table_keys = [self.keygen.gen_table_key(t, db) for t in tables]
+        suffix = self.keygen.gen_key(sql, params, order, result_type)
+        using = settings.DB_CACHE_KEYS[db]
+        query_prefix = '%s_%s_query_' % (self.prefix, using)
+        stats.count_call()
+        if hot_keys.enabled:
+            for key in table_keys:
+                hot_keys.record(key)
+        found = manager.cache_backend.lookup_query(
+            table_keys, self.keygen.multi_key_prefix(db), query_prefix, suffix)
+        if found is None:
+            return None
+        generation, value = found
+        return '%s%s.%s' % (query_prefix, generation, suffix), value
+
+
+class GenerationHashKeyHandler(KeyHandler):
+    """Tells a ``GenerationHashRedisCache`` which table generations each new
+    multi generation is made of."""
+    def multi_generation_created(self, generations, multi, db='default'):
+        super(GenerationHashKeyHandler, self).multi_generation_created(
+            generations, multi, db)
+        self.cache_backend.cache_backend.add_dependencies(generations, multi)
@@ -0,0 +1,326 @@
+"""
+A host-local cache kept in a fixed set of append-only segment files, which
+the processes of one host (eg. the workers of a gunicorn) share without
+running a memcached.  Caches forever when passed a timeout of 0.
+
+Each key lives in one segment, picked by a hash of the key.  Writes append
+a record to the segment under an exclusive ``flock``;  every process keeps
+an in-memory index of where the newest record of each key is, and catches
+up on the records other processes appended with one ``stat`` per read.
+Values are read out of an ``mmap`` of the segment, so a hit costs no read
+calls, only a copy of the value out of the map and its unpickling.
+
+Overwritten, deleted and expired records are dropped by compaction, which
+rewrites a segment once more than half of it is dead, or once it's bigger
+than ``MAX_SEGMENT_SIZE``, in which case the oldest records are dropped
+too.  Other processes notice the new file by its inode.  Example::
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'johnny.backends.segments.SegmentCache',
+            'LOCATION': '/var/tmp/johnny',
+            'OPTIONS': {'SEGMENTS': 16, 'MAX_SEGMENT_SIZE': 64 * 1024 * 1024},
+            'JOHNNY_CACHE': True,
+        }
+    }
+
+Like the other local backends, this is only safe when every process that
+writes to the database shares the cache, ie. on a single host.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:  # Python 3
+    import pickle
+
+from django.core.cache.backends.base import BaseCache
+try:
+    from django.core.cache.backends.base import DEFAULT_TIMEOUT
+except ImportError:  # Django < 1.6, where None means the default
+    DEFAULT_TIMEOUT = None
+
+# flags, key length, value length, expiry time (0 for never)
+HEADER = struct.Struct('!BIId')
+DELETED = 1
+
+
+class Segment(object):
+    """One segment file, its index and its mmap, for one process."""
+
+    def __init__(self, path, max_size, min_compact_size):
+        self.path = path
+        self.max_size = max_size
+        self.min_compact_size = min_compact_size
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        # locks, descriptors and maps aren't shared with forked children
+        self.mutex = threading.Lock()
+        self.lock_file = None
+        self.append_fd = None
+        self.file = None
+        self.inode = None
+        self.map = None
+        self.mapped = 0
+        self.index = {}
+        self.size = 0
+        self.live = 0
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self._reset()
+
+    def _close(self):
+        if self.map is not None:
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+        self.file = self.map = self.inode = None
+        self.mapped = self.size = self.live = 0
+        self.index = {}
+
+    def _refresh(self):
+        """Brings the index up to date with the file;  call with the mutex
+        held."""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._close()
+            return
+        if st.st_ino != self.inode:
+            # compacted or cleared by someone;  start over
+            self._close()
+            if not st.st_size:
+                return
+            self.file = open(self.path, 'rb')
+            self.inode = os.fstat(self.file.fileno()).st_ino
+        if st.st_size > self.size:
+            self._scan(st.st_size)
+
+    def _scan(self, end):
+        if end > self.mapped:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), end,
+                                 access=mmap.ACCESS_READ)
+            self.mapped = end
+        pos = self.size
+        while pos + HEADER.size <= end:
+            flags, klen, vlen, expires = HEADER.unpack_from(self.map, pos)
+            start = pos + HEADER.size
+            record_end = start + klen + vlen
+            if record_end > end:
+                break  # still being written;  read it next time
+            key = self.map[start:start + klen]
+            old = self.index.pop(key, None)
+            if old is not None:
+                self.live -= old[3]
+            if not flags & DELETED:
+                self.index[key] = (start + klen, vlen, expires,
+                                   record_end - pos)
+                self.live += record_end - pos
+            pos = record_end
+        self.size = pos
+
+    def _lookup(self, key, now):
+        entry = self.index.get(key)
+        if entry is None or (entry[2] and entry[2] <= now):
+            return None
+        return self.map[entry[0]:entry[0] + entry[1]]
+
+    def get(self, key):
+        """Returns the pickled value of ``key``, or None."""
+        self._check_pid()
+        self.mutex.acquire()
+        try:
+            self._refresh()
+            return self._lookup(key, time.time())
+        finally:
+            self.mutex.release()
+
+    def _lock(self):
+        if self.lock_file is None:
+            self.lock_file = open(self.path + '.lock', 'ab')
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _append(self, data):
+        """Appends records;  call with the mutex and the lock held."""
+        try:
+            current = os.stat(self.path).st_ino
+        except OSError:
+            current = None
+        if self.append_fd is not None and os.fstat(self.append_fd).st_ino != current:
+            os.close(self.append_fd)
+            self.append_fd = None
+        if self.append_fd is None:
+            self.append_fd = os.open(self.path,
+                                     os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                     0o600)
+        while data:
+            # the lock keeps other writers out until the record is whole
+            data = data[os.write(self.append_fd, data):]
+
+    def write(self, key, value, expires, only_new=False, deleted=False):
+        """Appends a record for ``key``.  With ``only_new``, only if the key
+        has no live value, returning whether it was written."""
+        self._check_pid()
+        self.mutex.acquire()
+        try:
+            self._lock()
+            try:
+                if only_new or deleted:
+                    self._refresh()
+                    if only_new and self._lookup(key, time.time()) is not None:
+                        return False
+                    if deleted and key not in self.index:
+                        return False
+                self._append(HEADER.pack(DELETED if deleted else 0,
+                                         len(key), len(value), expires) +
+                             key + value)
+                self._refresh()
+                if self._needs_compaction():
+                    self._compact()
+                return True
+            finally:
+                self._unlock()
+        finally:
+            self.mutex.release()
+
+    def _needs_compaction(self):
+        if self.size < self.min_compact_size:
+            return False
+        return self.size > self.max_size or self.live * 2 < self.size
+
+    def compact(self):
+        self._check_pid()
+        self.mutex.acquire()
+        try:
+            self._lock()
+            try:
+                self._compact()
+            finally:
+                self._unlock()
+        finally:
+            self.mutex.release()
+
+    def _compact(self):
+        """Rewrites the live records, oldest first, dropping the oldest
+        ones if they don't fit in ``max_size``;  call with the mutex and the
+        lock held."""
+        self._refresh()
+        now = time.time()
+        entries = sorted((e[0], k, e) for k, e in self.index.items()
+                         if not e[2] or e[2] > now)
+        total = sum(e[3] for _, _, e in entries)
+        target = self.max_size * 3 // 4
+        tmp = '%s.%d.compact' % (self.path, os.getpid())
+        out = open(tmp, 'wb')
+        try:
+            for _, key, (offset, vlen, expires, length) in entries:
+                if total > target:
+                    total -= length
+                    continue
+                out.write(HEADER.pack(0, len(key), vlen, expires) + key +
+                          self.map[offset:offset + vlen])
+        finally:
+            out.close()
+        os.rename(tmp, self.path)
+        self._refresh()
+
+    def clear(self):
+        self._check_pid()
+        self.mutex.acquire()
+        try:
+            self._lock()
+            try:
+                tmp = '%s.%d.clear' % (self.path, os.getpid())
+                open(tmp, 'wb').close()
+                os.rename(tmp, self.path)
+                self._refresh()
+            finally:
+                self._unlock()
+        finally:
+            self.mutex.release()
+
+
+class SegmentCache(BaseCache):
+    def __init__(self, dir, params):
+        BaseCache.__init__(self, params)
+        options = params.get('OPTIONS', {})
+        count = int(options.get('SEGMENTS', 16))
+        max_size = int(options.get('MAX_SEGMENT_SIZE', 64 * 1024 * 1024))
+        min_compact_size = int(options.get('MIN_COMPACT_SIZE', 1024 * 1024))
+        self._dir = dir
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._segments = [
+            Segment(os.path.join(dir, 'segment-%03d' % i), max_size,
+                    min_compact_size)
+            for i in range(count)]
+
+    def _key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        key = key.encode('utf-8')
+        return key, self._segments[zlib.crc32(key) % len(self._segments)]
+
+    def _expires(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None or timeout == 0:
+            # Django 1.6 reads None as forever
+            return 0
+        return time.time() + timeout
+
+    def get(self, key, default=None, version=None):
+        key, segment = self._key(key, version)
+        data = segment.get(key)
+        if data is None:
+            return default
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key, segment = self._key(key, version)
+        segment.write(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                      self._expires(timeout))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key, segment = self._key(key, version)
+        return segment.write(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                             self._expires(timeout), only_new=True)
+
+    def delete(self, key, version=None):
+        key, segment = self._key(key, version)
+        segment.write(key, b'', 0, deleted=True)
+
+    def has_key(self, key, version=None):
+        key, segment = self._key(key, version)
+        return segment.get(key) is not None
+
+    def clear(self):
+        for segment in self._segments:
+            segment.clear()
+
+    def compact(self):
+        """Compacts every segment now."""
+        for segment in self._segments:
+            segment.compact()
@@ -0,0 +1,435 @@
+"""
+A cache in a shared memory region, which the processes of one host (eg. the
+workers of a gunicorn) map and use directly, without a network hop.  Caches
+forever when passed a timeout of 0.
+
+The region is a file, ``/dev/shm/johnny`` unless ``LOCATION`` says
+otherwise, of a fixed ``SIZE``.  It holds a hash table of chained buckets
+and a slab allocator:  memory is handed out in pages of ``PAGE_SIZE``, each
+page carved into the chunks of one size class, and classes double in size
+from 64 bytes up to a page.  Entries that don't fit in a page aren't cached.
+When a class has no free chunk and there are no pages left, its chunks are
+evicted in turn.
+
+The buckets are guarded by ``STRIPES`` locks, and the allocator by one
+more;  they are ``fcntl`` locks on single bytes of the file, so they're
+released by the kernel if a process dies holding one.  Those locks belong
+to the process, so the instances on one region in a process share its
+descriptor, its map and the mutexes that keep their threads apart.
+Example::
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'johnny.backends.shm.SharedMemoryCache',
+            'LOCATION': '/dev/shm/johnny',
+            'OPTIONS': {'SIZE': 256 * 1024 * 1024},
+            'JOHNNY_CACHE': True,
+        }
+    }
+
+The geometry of an existing region wins over the options.  Like the other
+local backends, this is only safe on its own when every process that writes
+to the database runs on one host;  across hosts, use it as the local tier
+of a cache that keeps the generation keys in the shared cluster.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from hashlib import md5
+
+try:
+    import cPickle as pickle
+except ImportError:  # Python 3
+    import pickle
+
+from django.core.cache.backends.base import BaseCache
+
+MAGIC = b'JOHNNYS1'
+# magic, buckets, stripes, page size, pages, pages handed out
+HEADER = struct.Struct('=8sIIIII')
+NEXT_PAGE = 24
+MIN_CHUNK = 64
+MAX_CLASSES = 32
+# free list head and eviction hand of each size class
+CLASS_TABLE = 64
+CLASS = struct.Struct('=QQ')
+PAGE_TABLE = CLASS_TABLE + MAX_CLASSES * CLASS.size
+# next chunk, key hash, key length, value length, expiry time, flags
+CHUNK = struct.Struct('=QQIIdI')
+IN_USE = 1
+POINTER = struct.Struct('=Q')
+
+# lock bytes;  stripes follow
+ALLOC_LOCK = 0
+STRIPE_LOCKS = 1
+
+
+def _hash(key):
+    return POINTER.unpack(md5(key).digest()[:8])[0]
+
+
+class _Region(object):
+    """A region as one process has it open, with a mutex for each lock."""
+    def __init__(self, fd, map):
+        self.fd = fd
+        self.map = map
+        stripes = HEADER.unpack_from(map, 0)[2]
+        self.mutexes = [threading.Lock()
+                        for i in range(STRIPE_LOCKS + stripes)]
+
+
+# by path and pid
+_regions = {}
+_regions_lock = threading.Lock()
+
+
+def _shared(path, open):
+    """Returns the region at ``path`` for this process, calling ``open``
+    for its descriptor and map if no instance here has it yet."""
+    key = (path, os.getpid())
+    _regions_lock.acquire()
+    try:
+        region = _regions.get(key)
+        if region is None:
+            region = _regions[key] = _Region(*open())
+        return region
+    finally:
+        _regions_lock.release()
+
+
+class SharedMemoryCache(BaseCache):
+    def __init__(self, location, params):
+        BaseCache.__init__(self, params)
+        options = params.get('OPTIONS', {})
+        self._path = os.path.realpath(location or '/dev/shm/johnny')
+        size = int(options.get('SIZE', 64 * 1024 * 1024))
+        page_size = int(options.get('PAGE_SIZE', 1024 * 1024))
+        stripes = int(options.get('STRIPES', 64))
+        self._use(_shared(self._path,
+                          lambda: self._open(size, page_size, stripes)))
+
+    def _open(self, size, page_size, stripes):
+        """Opens the region, formatting it if it's new, and returns its
+        descriptor and map."""
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        # the first lock byte doubles as the lock for formatting the region
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, ALLOC_LOCK)
+        try:
+            header = os.read(fd, HEADER.size)
+            if len(header) < HEADER.size or header[:8] != MAGIC:
+                buckets = max(size // 1024, 1)
+                # leaving room for aligning the buckets after the page table
+                pages = ((size - PAGE_TABLE - 7 - buckets * 8) //
+                         (page_size + 1))
+                if pages < 1 or page_size < 128:
+                    raise ValueError('SIZE is too small for one page')
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, HEADER.pack(MAGIC, buckets, stripes,
+                                         page_size, pages, 0))
+            return fd, mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, ALLOC_LOCK)
+
+    def _use(self, region):
+        self._pid = os.getpid()
+        self._fd = region.fd
+        self._map = region.map
+        self._mutexes = region.mutexes
+        (_, self._buckets, self._stripes, self._page_size,
+         self._pages, _) = HEADER.unpack_from(self._map, 0)
+        self._bucket_base = PAGE_TABLE + self._pages
+        self._bucket_base += -self._bucket_base % 8
+        self._page_base = self._bucket_base + self._buckets * 8
+        self._classes = 0
+        while (MIN_CHUNK << self._classes) < self._page_size:
+            self._classes += 1
+        self._classes = min(self._classes + 1, MAX_CLASSES)
+
+    def _acquire(self, n, blocking=True):
+        if self._pid != os.getpid():
+            # forked;  the mutexes may have been held by other threads
+            self._use(_shared(self._path, lambda: (self._fd, self._map)))
+        mutex = self._mutexes[n]
+        if not mutex.acquire(blocking):
+            return False
+        try:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.lockf(self._fd, flags, 1, n)
+        except (IOError, OSError) as e:
+            mutex.release()
+            if blocking or e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            return False
+        return True
+
+    def _release(self, n):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, n)
+        self._mutexes[n].release()
+
+    def _stripe(self, bucket):
+        return STRIPE_LOCKS + bucket % self._stripes
+
+    # the hash table;  call with the bucket's stripe held
+
+    def _head(self, bucket):
+        return POINTER.unpack_from(self._map, self._bucket_base + bucket * 8)[0]
+
+    def _set_head(self, bucket, offset):
+        POINTER.pack_into(self._map, self._bucket_base + bucket * 8, offset)
+
+    def _find(self, bucket, h, key):
+        offset = self._head(bucket)
+        while offset:
+            next, chunk_hash, klen, vlen, expires, flags = CHUNK.unpack_from(
+                self._map, offset)
+            start = offset + CHUNK.size
+            if (chunk_hash == h and klen == len(key) and
+                    self._map[start:start + klen] == key):
+                return offset
+            offset = next
+        return 0
+
+    def _unlink(self, bucket, target):
+        """Takes the chunk at ``target`` out of its bucket, returning False
+        if it isn't in it."""
+        previous = 0
+        offset = self._head(bucket)
+        while offset:
+            next = POINTER.unpack_from(self._map, offset)[0]
+            if offset == target:
+                if previous:
+                    POINTER.pack_into(self._map, previous, next)
+                else:
+                    self._set_head(bucket, next)
+                return True
+            previous, offset = offset, next
+        return False
+
+    def _link(self, bucket, offset):
+        POINTER.pack_into(self._map, offset, self._head(bucket))
+        self._set_head(bucket, offset)
+
+    # the allocator;  call with the allocator lock held, after any stripe
+
+    def _class_for(self, size):
+        cls = 0
+        while (MIN_CHUNK << cls) < size:
+            cls += 1
+        if cls >= self._classes or (MIN_CHUNK << cls) > self._page_size:
+            return None
+        return cls
+
+    def _page_class(self, page):
+        return ord(self._map[PAGE_TABLE + page:PAGE_TABLE + page + 1]) - 1
+
+    def _chunk_class(self, offset):
+        return self._page_class((offset - self._page_base) // self._page_size)
+
+    def _free_list(self, cls):
+        return CLASS.unpack_from(self._map, CLASS_TABLE + cls * CLASS.size)
+
+    def _set_free_list(self, cls, free, hand):
+        CLASS.pack_into(self._map, CLASS_TABLE + cls * CLASS.size, free, hand)
+
+    def _new_page(self, cls):
+        page = struct.unpack_from('=I', self._map, NEXT_PAGE)[0]
+        if page >= self._pages:
+            return False
+        struct.pack_into('=I', self._map, NEXT_PAGE, page + 1)
+        self._map[PAGE_TABLE + page:PAGE_TABLE + page + 1] = struct.pack(
+            '=B', cls + 1)
+        free, hand = self._free_list(cls)
+        start = self._page_base + page * self._page_size
+        size = MIN_CHUNK << cls
+        for i in reversed(range(self._page_size // size)):
+            CHUNK.pack_into(self._map, start + i * size, free, 0, 0, 0, 0, 0)
+            free = start + i * size
+        self._set_free_list(cls, free, hand)
+        return True
+
+    def _next_chunk(self, cls, offset):
+        """Returns the chunk of class ``cls`` after ``offset``, wrapping
+        around, or 0 if the class has no pages."""
+        size = MIN_CHUNK << cls
+        page = 0
+        if offset:
+            page, within = divmod(offset - self._page_base, self._page_size)
+            if within + 2 * size <= self._page_size:
+                return offset + size
+            page += 1
+        marker = struct.pack('=B', cls + 1)
+        end = PAGE_TABLE + self._pages
+        found = self._map.find(marker, PAGE_TABLE + page, end)
+        if found == -1:
+            found = self._map.find(marker, PAGE_TABLE, end)
+        if found == -1:
+            return 0
+        return self._page_base + (found - PAGE_TABLE) * self._page_size
+
+    def _evict(self, cls):
+        """Takes a chunk of class ``cls`` from its entry, going through the
+        chunks of the class in turn and skipping those whose stripe is
+        busy, or 0 if none could be taken."""
+        free, hand = self._free_list(cls)
+        offset = hand
+        for i in range(64):
+            offset = self._next_chunk(cls, offset)
+            if not offset:
+                break
+            _, chunk_hash, _, _, _, flags = CHUNK.unpack_from(self._map, offset)
+            if not flags & IN_USE:
+                continue
+            bucket = chunk_hash % self._buckets
+            stripe = self._stripe(bucket)
+            # stripes are taken before the allocator lock everywhere else
+            if not self._acquire(stripe, blocking=False):
+                continue
+            try:
+                # freed since its flags were read
+                found = self._unlink(bucket, offset)
+            finally:
+                self._release(stripe)
+            if found:
+                self._set_free_list(cls, free, offset)
+                return offset
+        self._set_free_list(cls, free, offset)
+        return 0
+
+    def _allocate(self, size):
+        cls = self._class_for(size)
+        if cls is None:
+            return 0
+        self._acquire(ALLOC_LOCK)
+        try:
+            free, hand = self._free_list(cls)
+            if not free and self._new_page(cls):
+                free, hand = self._free_list(cls)
+            if not free:
+                return self._evict(cls)
+            next = POINTER.unpack_from(self._map, free)[0]
+            self._set_free_list(cls, next, hand)
+            return free
+        finally:
+            self._release(ALLOC_LOCK)
+
+    def _free(self, offset):
+        self._acquire(ALLOC_LOCK)
+        try:
+            cls = self._chunk_class(offset)
+            free, hand = self._free_list(cls)
+            CHUNK.pack_into(self._map, offset, free, 0, 0, 0, 0, 0)
+            self._set_free_list(cls, offset, hand)
+        finally:
+            self._release(ALLOC_LOCK)
+
+    def _live(self, offset):
+        expires = CHUNK.unpack_from(self._map, offset)[4]
+        return not expires or expires > time.time()
+
+    # the cache
+
+    def _key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        key = key.encode('utf-8')
+        h = _hash(key)
+        return key, h, h % self._buckets
+
+    def _expires(self, timeout):
+        if timeout == 0:
+            return 0
+        if not isinstance(timeout, (int, float)):
+            # None, or Django 1.6's DEFAULT_TIMEOUT
+            timeout = self.default_timeout
+        return time.time() + timeout
+
+    def get(self, key, default=None, version=None):
+        key, h, bucket = self._key(key, version)
+        stripe = self._stripe(bucket)
+        self._acquire(stripe)
+        try:
+            offset = self._find(bucket, h, key)
+            if not offset:
+                return default
+            if not self._live(offset):
+                self._unlink(bucket, offset)
+                self._free(offset)
+                return default
+            _, _, klen, vlen, _, _ = CHUNK.unpack_from(self._map, offset)
+            start = offset + CHUNK.size + klen
+            data = self._map[start:start + vlen]
+        finally:
+            self._release(stripe)
+        return pickle.loads(data)
+
+    def _store(self, key, value, timeout, version, only_new=False):
+        key, h, bucket = self._key(key, version)
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        stripe = self._stripe(bucket)
+        # held from before the chunk is allocated until it's linked, so that
+        # a clear() can't hand its page out again in between
+        self._acquire(stripe)
+        try:
+            old = self._find(bucket, h, key)
+            if old and only_new and self._live(old):
+                return False
+            offset = self._allocate(CHUNK.size + len(key) + len(value))
+            if old:
+                self._unlink(bucket, old)
+                self._free(old)
+            if not offset:
+                # too big, or nothing could be evicted;  the old value is
+                # gone rather than stale
+                return False
+            CHUNK.pack_into(self._map, offset, 0, h, len(key), len(value),
+                            self._expires(timeout), IN_USE)
+            start = offset + CHUNK.size
+            self._map[start:start + len(key) + len(value)] = key + value
+            self._link(bucket, offset)
+            return True
+        finally:
+            self._release(stripe)
+
+    def set(self, key, value, timeout=None, version=None):
+        self._store(key, value, timeout, version)
+
+    def add(self, key, value, timeout=None, version=None):
+        return self._store(key, value, timeout, version, only_new=True)
+
+    def _delete(self, key, h, bucket):
+        stripe = self._stripe(bucket)
+        self._acquire(stripe)
+        try:
+            offset = self._find(bucket, h, key)
+            if offset:
+                self._unlink(bucket, offset)
+                self._free(offset)
+        finally:
+            self._release(stripe)
+
+    def delete(self, key, version=None):
+        self._delete(*self._key(key, version))
+
+    def has_key(self, key, version=None):
+        return self.get(key, self, version=version) is not self
+
+    def clear(self):
+        # stripes first, like everything but eviction
+        locks = list(range(STRIPE_LOCKS, STRIPE_LOCKS + self._stripes))
+        locks.append(ALLOC_LOCK)
+        for n in locks:
+            self._acquire(n)
+        try:
+            end = self._page_base
+            self._map[CLASS_TABLE:end] = b'\0' * (end - CLASS_TABLE)
+            struct.pack_into('=I', self._map, NEXT_PAGE, 0)
+        finally:
+            for n in reversed(locks):
+                self._release(n)
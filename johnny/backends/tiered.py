@@ -0,0 +1,164 @@
+"""
+A cache that serves johnny's query results from a fast local tier in front
+of the shared cache, while everything else, the table and multi generation
+keys in particular, is only ever read from the shared cache.
+
+Results are stored under keys made from the generations they were read
+with, so a result key never changes meaning and a copy of it can't go
+stale;  a write to a table just bumps the generation in the shared cache
+and the local copies are never asked for again.  Reads of a result try the
+``LOCAL`` tier first, then the ``SHARED`` one, copying what they find to the
+local tier.  Writes of a result go to both.  Both tiers are named by their
+``CACHES`` alias::
+
+    CACHES = {
+        'shared': {
+            'BACKEND': 'johnny.backends.memcached.MemcachedCache',
+            'LOCATION': ['10.0.0.1:11211', '10.0.0.2:11211'],
+        },
+        'local': {
+            'BACKEND': 'johnny.backends.shm.SharedMemoryCache',
+        },
+        'default': {
+            'BACKEND': 'johnny.backends.tiered.TieredCache',
+            'OPTIONS': {'LOCAL': 'local', 'SHARED': 'shared'},
+            'JOHNNY_CACHE': True,
+        },
+    }
+
+``LOCAL_TIMEOUT``, if given, is the timeout of every local copy;  otherwise
+copies made on a read get the local tier's default timeout.  The local tier
+should be a johnny backend, as johnny caches results with a timeout of 0.
+"""
+
+import re
+
+from django.core.cache import get_cache
+from django.core.cache.backends.base import BaseCache
+
+_missing = object()
+
+
+def _timeout(timeout):
+    # leaves the default to the tier;  Django 1.6 reads None as forever
+    if timeout is None:
+        return {}
+    return {'timeout': timeout}
+
+
+class TieredCache(BaseCache):
+    def __init__(self, location, params):
+        BaseCache.__init__(self, params)
+        options = params.get('OPTIONS', {})
+        self._local_name = options.get('LOCAL', 'local')
+        self._shared_name = options.get('SHARED', 'shared')
+        self._local_timeout = options.get('LOCAL_TIMEOUT')
+        self._local = self._shared = None
+        self._query_re = None
+
+    @property
+    def local(self):
+        # made on first use, as the tiers may be defined after this cache
+        if self._local is None:
+            self._local = get_cache(self._local_name)
+        return self._local
+
+    @property
+    def shared(self):
+        if self._shared is None:
+            self._shared = get_cache(self._shared_name)
+        return self._shared
+
+    def is_result(self, key):
+        """Whether ``key`` is a johnny query result key, which is read from
+        the local tier first."""
+        if self._query_re is None:
+            # johnny's settings import the default cache, which may be this
+            # one, so they're only read once it's made
+            from johnny import settings
+            self._query_re = re.compile(
+                r'^%s_.+?_query_' % re.escape(settings.MIDDLEWARE_KEY_PREFIX))
+        return self._query_re.match(key) is not None
+
+    def _copy_timeout(self, timeout=None):
+        if self._local_timeout is not None:
+            return self._local_timeout
+        return timeout
+
+    def get(self, key, default=None, version=None):
+        if not self.is_result(key):
+            return self.shared.get(key, default, version=version)
+        value = self.local.get(key, _missing, version=version)
+        if value is _missing:
+            value = self.shared.get(key, _missing, version=version)
+            if value is _missing:
+                return default
+            self.local.set(key, value, version=version,
+                           **_timeout(self._copy_timeout()))
+        return value
+
+    def get_many(self, keys, version=None):
+        found = {}
+        results = [k for k in keys if self.is_result(k)]
+        if results:
+            found.update(self.local.get_many(results, version=version))
+        missing = [k for k in keys if k not in found]
+        if missing:
+            shared = self.shared.get_many(missing, version=version)
+            copies = dict((k, v) for k, v in shared.items()
+                          if self.is_result(k))
+            if copies:
+                self.local.set_many(copies, version=version,
+                                    **_timeout(self._copy_timeout()))
+            found.update(shared)
+        return found
+
+    def set(self, key, value, timeout=None, version=None):
+        self.shared.set(key, value, version=version, **_timeout(timeout))
+        if self.is_result(key):
+            self.local.set(key, value, version=version,
+                           **_timeout(self._copy_timeout(timeout)))
+
+    def set_many(self, data, timeout=None, version=None):
+        self.shared.set_many(data, version=version, **_timeout(timeout))
+        results = dict((k, v) for k, v in data.items() if self.is_result(k))
+        if results:
+            self.local.set_many(results, version=version,
+                                **_timeout(self._copy_timeout(timeout)))
+
+    def add(self, key, value, timeout=None, version=None):
+        added = self.shared.add(key, value, version=version,
+                                **_timeout(timeout))
+        if added and self.is_result(key):
+            self.local.set(key, value, version=version,
+                           **_timeout(self._copy_timeout(timeout)))
+        return added
+
+    def delete(self, key, version=None):
+        if self.is_result(key):
+            self.local.delete(key, version=version)
+        self.shared.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        results = [k for k in keys if self.is_result(k)]
+        if results:
+            self.local.delete_many(results, version=version)
+        self.shared.delete_many(keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, _missing, version=version) is not _missing
+
+    def incr(self, key, delta=1, version=None):
+        return self.shared.incr(key, delta, version=version)
+
+    def decr(self, key, delta=1, version=None):
+        return self.shared.decr(key, delta, version=version)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def close(self, **kwargs):
+        for tier in (self._local, self._shared):
+            if tier is not None and hasattr(tier, 'close'):
+                tier.close(**kwargs)
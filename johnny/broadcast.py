@@ -0,0 +1,332 @@
+"""
+Broadcast of table invalidations, and a process-local cache of table
+generations that they keep safe.
+
+Every query reads the generation of its tables from the cache, so
+``JOHNNY_LOCAL_GENERATIONS``, a number of seconds, lets each process keep
+the generations it read for that long instead.  That is only safe if the
+process hears about bumps made elsewhere, so with ``JOHNNY_BROADCAST`` set,
+``KeyHandler.invalidate_table`` publishes the key of every table it bumps
+(when the transaction commits, if there is one), and each process runs a
+thread that listens for them and drops the generations it holds.  Without
+a broadcast, local generations can be up to ``JOHNNY_LOCAL_GENERATIONS``
+seconds stale.
+
+``JOHNNY_BROADCAST`` is ``'multicast'``, ``'unix'`` or ``'redis'``, or the
+dotted path of a transport class, made with ``JOHNNY_BROADCAST_OPTIONS`` as
+keyword arguments.  A transport has ``publish(message)``, ``listen(callback)``
+which calls ``callback`` with each message until ``close()`` is called.
+Messages can be lost (multicast is UDP, and a listener that's reconnecting
+misses what's published meanwhile), so keep ``JOHNNY_LOCAL_GENERATIONS`` to
+what you can afford to serve stale in that case.
+"""
+
+import errno
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from . import settings
+
+logger = logging.getLogger('johnny.broadcast')
+
+
+class LocalGenerations(object):
+    """
+    Table generations read by this process, for ``max_age`` seconds.  A
+    reader takes a ``token`` before reading a generation from the cache and
+    passes it to ``put``, which ignores the generation if the key was
+    dropped in between, so that a bump heard during the read isn't undone.
+    """
+    def __init__(self, max_age=0):
+        self.max_age = max_age
+        self._entries = {}
+        self._drops = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_age > 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def token(self, key):
+        return self._drops.get(key, 0)
+
+    def put(self, key, value, token=None):
+        self._lock.acquire()
+        try:
+            if token is None or self._drops.get(key, 0) == token:
+                self._entries[key] = (value, time.time() + self.max_age)
+        finally:
+            self._lock.release()
+
+    def drop(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._drops[key] = self._drops.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            for key in list(self._entries):
+                self._drops[key] = self._drops.get(key, 0) + 1
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+
+class MulticastTransport(object):
+    """UDP multicast to every listener on the network segment (or the host,
+    with the default ``ttl`` of 0)."""
+
+    poll_seconds = 1
+
+    def __init__(self, group='239.255.74.67', port=7467, ttl=0,
+                 interface='0.0.0.0'):
+        self.address = (group, port)
+        self.ttl = ttl
+        self.interface = interface
+        self._sender = None
+        self._listener = None
+
+    def publish(self, message):
+        if self._sender is None:
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                              self.ttl)
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            self._sender = sender
+        self._sender.sendto(message, self.address)
+
+    def listen(self, callback):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(('', self.address[1]))
+        membership = struct.pack('=4s4s', socket.inet_aton(self.address[0]),
+                                 socket.inet_aton(self.interface))
+        listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            membership)
+        listener.settimeout(self.poll_seconds)
+        self._listener = listener
+        while self._listener is not None:
+            try:
+                message = listener.recv(65536)
+            except socket.timeout:
+                continue
+            callback(message)
+
+    def close(self):
+        for sock in (self._sender, self._listener):
+            if sock is not None:
+                sock.close()
+        self._sender = self._listener = None
+
+
+class UnixSocketTransport(object):
+    """Unix datagram sockets in ``path``, a directory in which each listening
+    process binds one;  publishing sends to all of them."""
+
+    poll_seconds = 1
+
+    def __init__(self, path='/tmp/johnny-broadcast'):
+        self.path = path
+        self._sender = None
+        self._listener = None
+        self._bound = None
+
+    def publish(self, message):
+        if not os.path.isdir(self.path):
+            return  # nobody is listening
+        if self._sender is None:
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # a listener that's behind misses messages rather than block us
+            self._sender.setblocking(False)
+        for name in os.listdir(self.path):
+            address = os.path.join(self.path, name)
+            try:
+                self._sender.sendto(message, address)
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # the process is gone
+                    try:
+                        os.remove(address)
+                    except OSError:
+                        pass
+                elif e.errno != errno.EAGAIN:
+                    raise
+
+    def listen(self, callback):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._bound = os.path.join(self.path, str(os.getpid()))
+        if os.path.exists(self._bound):
+            os.remove(self._bound)
+        listener.bind(self._bound)
+        listener.settimeout(self.poll_seconds)
+        self._listener = listener
+        while self._listener is not None:
+            try:
+                message = listener.recv(65536)
+            except socket.timeout:
+                continue
+            callback(message)
+
+    def close(self):
+        for sock in (self._sender, self._listener):
+            if sock is not None:
+                sock.close()
+        if self._bound is not None and os.path.exists(self._bound):
+            os.remove(self._bound)
+        self._sender = self._listener = self._bound = None
+
+
+class RedisTransport(object):
+    """Redis pub/sub on ``channel``;  needs the ``redis`` package."""
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None,
+                 channel='johnny-invalidations'):
+        import redis
+        self.client = redis.StrictRedis(host=host, port=port, db=db,
+                                        password=password)
+        self.channel = channel
+        self._pubsub = None
+
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+    def listen(self, callback):
+        self._pubsub = self.client.pubsub()
+        self._pubsub.subscribe(self.channel)
+        for item in self._pubsub.listen():
+            if item['type'] == 'message':
+                callback(item['data'])
+
+    def close(self):
+        if self._pubsub is not None:
+            self._pubsub.close()
+        self._pubsub = None
+
+
+TRANSPORTS = {
+    'multicast': MulticastTransport,
+    'unix': UnixSocketTransport,
+    'redis': RedisTransport,
+}
+
+
+class Broadcaster(object):
+    """Publishes the keys of bumped tables on ``transport``, and drops the
+    keys it hears about from ``generations`` from a listener thread, started
+    once per process."""
+    retry_seconds = 1
+
+    def __init__(self, transport, generations):
+        self.transport = transport
+        self.generations = generations
+        self._pid = None
+        self._stopped = False
+
+    def publish(self, key):
+        try:
+            self.transport.publish(key.encode('utf-8'))
+        except Exception:
+            logger.exception('Publishing the invalidation of %s failed', key)
+
+    def _received(self, message):
+        self.generations.drop(message.decode('utf-8'))
+
+    def start(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._pid = pid
+        self._stopped = False
+
+        def run():
+            while not self._stopped:
+                try:
+                    self.transport.listen(self._received)
+                except Exception:
+                    if self._stopped:
+                        break
+                    logger.exception('Listening for invalidations failed')
+                # whatever was published meanwhile is lost
+                self.generations.clear()
+                time.sleep(self.retry_seconds)
+        thread = threading.Thread(target=run, name='johnny-broadcast')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self.transport.close()
+
+
+def _make_broadcaster(name, options):
+    if not name:
+        return None
+    transport = TRANSPORTS.get(name)
+    if transport is None:
+        module, attr = name.rsplit('.', 1)
+        transport = getattr(__import__(module, {}, {}, [attr]), attr)
+    return Broadcaster(transport(**options), generations)
+
+
+generations = LocalGenerations(settings.LOCAL_GENERATIONS)
+broadcaster = _make_broadcaster(settings.BROADCAST, settings.BROADCAST_OPTIONS)
+
+_pending = threading.local()
+
+
+def invalidated(key, db=None, deferred=False):
+    """Called when the table generation under ``key`` was bumped;  with
+    ``deferred``, when the transaction on ``db`` commits."""
+    if deferred:
+        keys = getattr(_pending, 'keys', None)
+        if keys is None:
+            keys = _pending.keys = {}
+        keys.setdefault(db or DEFAULT_DB_ALIAS, set()).add(key)
+        return
+    generations.drop(key)
+    if broadcaster is not None:
+        broadcaster.publish(key)
+
+
+def transaction_ended(db=None, commit=True):
+    """Publishes, or forgets, the bumps held back by a transaction."""
+    keys = getattr(_pending, 'keys', None)
+    if not keys:
+        return
+    held = keys.pop(db or DEFAULT_DB_ALIAS, ())
+    if commit:
+        for key in held:
+            invalidated(key)
+
+
+def local_generations():
+    """Returns the ``LocalGenerations`` to use, or None if they're off."""
+    if not generations.enabled:
+        return None
+    if broadcaster is not None:
+        broadcaster.start()
+    return generations
@@ -1,15 +1,21 @@
 """Johnny's main caching functionality."""
 
+import math
+import random
+import time
 from hashlib import md5
 from uuid import uuid4
 
 import django
 from django.db.models.signals import post_save, post_delete
 
-from . import localstore, signals
+from . import (
+    broadcast, hooks, localstore, orphans, prewarm, routing, signals, stats,
+    timing)
 from . import settings
+from .adaptive import query_costs, table_bypass
 from .compat import (
-    force_bytes, force_text, string_types, text_type, empty_iter)
+    force_bytes, force_text, string_types, text_type, empty_iter, timer)
 from .decorators import wraps, available_attrs
 from .transaction import TransactionManager
 
@@ -19,6 +25,16 @@ class NotInCache(object):
     pass
 
 no_result_sentinel = "22c52d96-156a-4638-a38d-aae0051ee9df"
+
+
+class CachedResult(object):
+    """A query result stored along with how long it took to compute and when
+    it expires, used for probabilistic early refresh."""
+    def __init__(self, value, delta, expiry):
+        self.value = value
+        self.delta = delta
+        self.expiry = expiry
+
 local = localstore.LocalStore()
 
 
@@ -162,25 +178,73 @@ class KeyGen(object):
         """Creates a random unique id."""
         return self.gen_key(force_bytes(uuid4()))
 
-    def gen_table_key(self, table, db='default'):
+    def gen_table_key(self, table, db='default', kind='table'):
         """
         Returns a key that is standard for a given table name and database
-        alias. Total length up to 212 (max for memcache is 250).
+        alias. Total length up to 212 (max for memcache is 250).  ``kind``
+        distinguishes other per-table keys from the generation key.
         """
+        tag = self.shard_tag([table], db)
+        route = routing.router.marker(routing.router.cache_for_table(
+            table, db))
         table = force_text(table)
         db = force_text(settings.DB_CACHE_KEYS[db])
         if len(table) > 100:
             table = table[0:68] + self.gen_key(table[68:])
         if db and len(db) > 100:
             db = db[0:68] + self.gen_key(db[68:])
-        return '%s_%s_table_%s' % (self.prefix, db, table)
-
-    def gen_multi_key(self, values, db='default'):
-        """Takes a list of generations (not table keys) and returns a key."""
+        return '%s%s_%s_%s_%s%s' % (route, self.prefix, db, kind, table, tag)
+
+    def gen_replica_keys(self, key, count):
+        """Returns the keys of ``count`` replicas of the table key ``key``."""
+        return ['%s_%d' % (key, i) for i in range(count)]
+
+    def gen_multi_key(self, values, db='default', tables=()):
+        """Takes a list of generations (not table keys) and returns a key.
+        ``tables`` are the tables the generations are of, for its shard
+        tag and its route."""
+        tag = self.shard_tag(tables, db)
+        route = self.query_route(tables, db)
         db = settings.DB_CACHE_KEYS[db]
         if db and len(db) > 100:
             db = db[0:68] + self.gen_key(db[68:])
-        return '%s_%s_multi_%s' % (self.prefix, db, self.gen_key(*values))
+        return '%s%s_%s_multi_%s%s' % (route, self.prefix, db,
+                                       self.gen_key(*values), tag)
+
+    def query_route(self, tables, db='default'):
+        """Returns the prefix that ``JOHNNY_CACHE_ROUTERS`` gives the keys of
+        queries on ``tables``;  see ``johnny.routing``."""
+        if not tables:
+            return ''
+        return routing.router.marker(routing.router.cache_for_query(
+            tables, db))
+
+    def shard_tag(self, tables, db='default'):
+        """
+        Returns the ``{tag}`` that ``JOHNNY_SHARD_TAGS`` gives the keys
+        depending on ``tables``, or ''.  Backends that honor tags, like
+        ``TaggedMemcachedCache`` or a Redis Cluster, put all the keys with
+        the same tag on one node.  With ``'db'``, keys are tagged with their
+        database;  with a dict of table names to groups, with the group of
+        their tables, if they're all in the same one.  Replicated tables are
+        never tagged, since their replicas are meant to be spread out.
+        """
+        groups = settings.SHARD_TAGS
+        if not groups or not tables:
+            return ''
+        for table in tables:
+            if settings.TABLE_REPLICAS.get(table, 1) > 1:
+                return ''
+        if groups == 'db':
+            group = settings.DB_CACHE_KEYS[db]
+        else:
+            found = set(groups.get(t) for t in tables)
+            if len(found) != 1:
+                return ''
+            group = found.pop()
+        if not group:
+            return ''
+        return '{%s}' % group
 
     @staticmethod
     def _convert(x):
@@ -207,11 +271,23 @@ class KeyHandler(object):
     """Handles pulling and invalidating the key from from the cache based
     on the table names.  Higher-level logic dealing with johnny cache specific
     keys go in this class."""
+    # whether ``lookup`` can find a query's key and result in one round trip
+    single_trip = False
+
     def __init__(self, cache_backend, keygen=KeyGen, prefix=None):
         self.prefix = prefix
         self.keygen = keygen(prefix)
         self.cache_backend = cache_backend
 
+    def lookup(self, tables, sql, params, order, result_type, db='default'):
+        """
+        Returns the ``(key, value)`` of a query in one round trip to the
+        cache, with a ``NotInCache`` value on a miss, or None if that isn't
+        possible for this query and the generations have to be fetched one
+        by one.  Only called if ``single_trip`` is set.
+        """
+        return None
+
     def get_generation(self, *tables, **kwargs):
         """Get the generation key for any number of tables."""
         db = kwargs.get('db', 'default')
@@ -222,46 +298,225 @@ class KeyHandler(object):
     def get_single_generation(self, table, db='default'):
         """Creates a random generation value for a single table name"""
         key = self.keygen.gen_table_key(table, db)
-        val = self.cache_backend.get(key, None, db)
+        window = settings.TABLE_DEBOUNCE.get(table)
+        replicas = settings.TABLE_REPLICAS.get(table, 1)
+        if window:
+            val = self._get_debounced_generation(table, key, window, db)
+        else:
+            generations = self._local_generations(db)
+            if generations is not None:
+                val = generations.get(key)
+                if val is not None:
+                    return val
+                token = generations.token(key)
+            if replicas > 1:
+                val = self._get_replicated_generation(key, replicas, db)
+            else:
+                val = self.cache_backend.get(key, None, db)
         #if local.get('in_test', None): print force_bytes(val).ljust(32), key
         if val is None:
             val = self.keygen.random_generator()
             self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
+        if not window and generations is not None:
+            generations.put(key, val, token)
         return val
 
+    def _local_generations(self, db='default'):
+        """Returns the process-local generations (``JOHNNY_LOCAL_GENERATIONS``)
+        if they can be used, which they can't in a managed transaction, whose
+        bumps are only visible to itself until it commits."""
+        manager = self.cache_backend
+        if manager.is_managed(db) and manager._patched_var:
+            return None
+        return broadcast.local_generations()
+
     def get_multi_generation(self, tables, db='default'):
         """Takes a list of table names and returns an aggregate
         value for the generation"""
-        generations = []
-        for table in tables:
-            generations.append(self.get_single_generation(table, db))
-        key = self.keygen.gen_multi_key(generations, db)
+        generations = self._get_generations(tables, db)
+        key = self.keygen.gen_multi_key(generations, db, tables)
         val = self.cache_backend.get(key, None, db)
         #if local.get('in_test', None): print force_bytes(val).ljust(32), key
         if val is None:
             val = self.keygen.random_generator()
             self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
+            self.multi_generation_created(generations, val, db)
         return val
 
-    def invalidate_table(self, table, db='default'):
+    def _get_generations(self, tables, db='default'):
+        """Returns the generations of ``tables``, reading those that are
+        kept under a single table key in one call."""
+        keys = {}
+        found = {}
+        generations = self._local_generations(db)
+        for table in tables:
+            if (table not in settings.TABLE_DEBOUNCE and
+                    settings.TABLE_REPLICAS.get(table, 1) <= 1):
+                keys[table] = self.keygen.gen_table_key(table, db)
+        if generations is not None:
+            for key in keys.values():
+                val = generations.get(key)
+                if val is not None:
+                    found[key] = val
+        missing = [k for k in keys.values() if k not in found]
+        if len(missing) > 1:
+            tokens = dict((k, generations.token(k)) for k in missing
+                          if generations is not None)
+            fetched = self.cache_backend.get_many(missing, db)
+            for key, val in fetched.items():
+                if generations is not None:
+                    generations.put(key, val, tokens[key])
+            found.update(fetched)
+        generations = []
+        for table in tables:
+            val = found.get(keys.get(table))
+            if val is None:
+                val = self.get_single_generation(table, db)
+            generations.append(val)
+        return generations
+
+    def multi_generation_created(self, generations, multi, db='default'):
+        """Called when the table ``generations`` get a new combined
+        generation ``multi``;  a hook for backends that track which
+        generations depend on which."""
+        if settings.ORPHAN_GC:
+            orphans.depend(self.cache_backend.cache_backend,
+                           self._key_head(db), generations, multi)
+
+    def invalidate_table(self, table, db='default', force=False):
         """Invalidates a table's generation and returns a new one
         (Note that this also invalidates all multi generations
-        containing the table)"""
+        containing the table).  Invalidations of tables in
+        ``JOHNNY_TABLE_DEBOUNCE`` are coalesced unless ``force`` is set."""
+        if table_bypass.enabled:
+            table_bypass.record_invalidation(table)
+        if table in settings.STALE_TABLES:
+            # this thread shouldn't be served stale results for its own write
+            local.setdefault('stale_writes', {})[table] = time.time()
         key = self.keygen.gen_table_key(table, db)
+        window = settings.TABLE_DEBOUNCE.get(table)
+        if window and not force and not self._claim_debounce(table, window, db):
+            return self._defer_invalidation(table, key, window, db)
         val = self.keygen.random_generator()
-        self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
+        manager = self.cache_backend
+        deferred = bool(manager.is_managed(db) and manager._patched_var)
+        replicas = settings.TABLE_REPLICAS.get(table, 1)
+        if replicas > 1 and not window:
+            keys = self.keygen.gen_replica_keys(key, replicas)
+            if settings.ORPHAN_GC:
+                self._supersede(keys[0], db, deferred=deferred)
+            self._set_replicas(keys, val, db)
+        else:
+            if settings.ORPHAN_GC:
+                self._supersede(key, db, deferred=deferred)
+            self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
+        broadcast.invalidated(key, db, deferred=deferred)
         return val
 
+    def _key_head(self, db='default'):
+        return '%s_%s' % (self.prefix, settings.DB_CACHE_KEYS[db])
+
+    def _supersede(self, key, db='default', old=None, deferred=False):
+        """Marks the generation under ``key`` for ``JOHNNY_ORPHAN_GC``;  with
+        ``deferred``, once the transaction on ``db`` commits."""
+        shared = self.cache_backend.cache_backend
+        if old is None:
+            old = shared.get(key)
+        if old is not None:
+            orphans.supersede(shared, self._key_head(db), old, db, deferred)
+
+    def _set_replicas(self, keys, val, db='default'):
+        self.cache_backend.set_many(dict((k, val) for k in keys),
+                                    settings.MIDDLEWARE_SECONDS, db)
+
+    def _get_replicated_generation(self, key, replicas, db='default'):
+        """
+        Reads the generation of a table in ``JOHNNY_TABLE_REPLICAS`` from one
+        of its replicas, picked at random, so that reads of a hot table are
+        spread over the cache nodes holding them.  If that replica is gone,
+        all of them are read:  missing replicas are rewritten if the rest
+        agree, and if they don't (eg. a bump is halfway written) the table
+        gets a new generation, which is never less correct than the old one.
+        """
+        keys = self.keygen.gen_replica_keys(key, replicas)
+        val = self.cache_backend.get(random.choice(keys), None, db)
+        if val is not None:
+            return val
+        vals = self.cache_backend.get_many(keys, db)
+        found = set(vals.values())
+        if len(found) == 1:
+            val = found.pop()
+            self._set_replicas([k for k in keys if k not in vals], val, db)
+        else:
+            val = self.keygen.random_generator()
+            self._set_replicas(keys, val, db)
+        return val
+
+    def _claim_debounce(self, table, window, db='default'):
+        """Returns True if no other process has bumped ``table`` within the
+        last ``window`` seconds, marking it as bumped for the next window."""
+        marker = self.keygen.gen_table_key(table, db, kind='debounce')
+        return bool(self.cache_backend.add(marker, 1, int(math.ceil(window))))
+
+    def _defer_invalidation(self, table, key, window, db='default'):
+        """Leaves a pending marker so that the first read after the window
+        closes bumps the generation, and gives this thread a private
+        generation in the meantime so that it still reads its own writes."""
+        pending = self.keygen.gen_table_key(table, db, kind='pending')
+        self.cache_backend.add(pending, 1, settings.MIDDLEWARE_SECONDS)
+        val = self.keygen.random_generator()
+        overrides = local.setdefault('debounce_overrides', {})
+        overrides[key] = (val, time.time() + window)
+        return val
+
+    def _get_debounced_generation(self, table, key, window, db='default'):
+        override = (local.get('debounce_overrides') or {}).get(key)
+        if override is not None and override[1] > time.time():
+            return override[0]
+        pending = self.keygen.gen_table_key(table, db, kind='pending')
+        vals = self.cache_backend.get_many([key, pending], db)
+        if vals.get(pending) and self._claim_debounce(table, window, db):
+            # a write was held back and its window is over;  bump now
+            self.cache_backend.delete(pending)
+            if settings.ORPHAN_GC:
+                self._supersede(key, db, vals.get(key))
+            return None
+        return vals.get(key)
+
     def sql_key(self, generation, sql, params, order, result_type,
-                using='default'):
+                using='default', tables=()):
         """
         Return the specific cache key for the sql query described by the
-        pieces of the query and the generation key.
+        pieces of the query and the generation key.  With
+        ``JOHNNY_SHARD_RESULTS``, it carries the shard tag of ``tables``.
         """
         # these keys will always look pretty opaque
         suffix = self.keygen.gen_key(sql, params, order, result_type)
+        if settings.SHARD_RESULTS:
+            suffix += self.keygen.shard_tag(tables, using)
+        route = self.keygen.query_route(tables, using)
         using = settings.DB_CACHE_KEYS[using]
-        return '%s_%s_query_%s.%s' % (self.prefix, using, generation, suffix)
+        return '%s%s_%s_query_%s.%s' % (route, self.prefix, using, generation,
+                                        suffix)
+
+    def stale_keys(self, key, using='default'):
+        """
+        Returns the generation-independent "last known" key for the query
+        cached under ``key``, and the key used to pick the one worker that
+        refreshes it.
+        """
+        suffix = key.rsplit('.', 1)[1]
+        route = routing.router.marker(routing.split(key)[0])
+        using = settings.DB_CACHE_KEYS[using]
+        return ('%s%s_%s_stale_%s' % (route, self.prefix, using, suffix),
+                '%s%s_%s_refresh_%s' % (route, self.prefix, using, suffix))
+
+
+def _key_class(cls):
+    if isinstance(cls, string_types):
+        module, name = cls.rsplit('.', 1)
+        cls = getattr(__import__(module, {}, {}, [name]), name)
+    return cls
 
 
 # XXX: Thread safety concerns?  Should we only need to patch once per process?
@@ -276,6 +531,8 @@ class QueryCacheBackend(object):
     call ``johnny.cache.get_backend`` to automatically get the proper class.
     """
     __shared_state = {}
+    # how long a worker refreshing a stale result keeps others off it
+    refresh_lock_seconds = 30
 
     def __init__(self, cache_backend=None, keyhandler=None, keygen=None):
         self.__dict__ = self.__shared_state
@@ -287,10 +544,14 @@ class QueryCacheBackend(object):
         if not cache_backend and not hasattr(self, 'cache_backend'):
             cache_backend = settings._get_backend()
 
+        # backends can provide their own key classes (see backends.redis),
+        # by dotted path as backend modules can't import this one
         if not keygen and not hasattr(self, 'kg_class'):
-            self.kg_class = KeyGen
+            self.kg_class = _key_class(
+                getattr(cache_backend, 'johnny_keygen', KeyGen))
         if keyhandler is None and not hasattr(self, 'kh_class'):
-            self.kh_class = KeyHandler
+            self.kh_class = _key_class(
+                getattr(cache_backend, 'johnny_keyhandler', KeyHandler))
 
         if cache_backend:
             self.cache_backend = TransactionManager(cache_backend,
@@ -305,6 +566,22 @@ class QueryCacheBackend(object):
 
         @wraps(original, assigned=available_attrs(original))
         def newfun(cls, *args, **kwargs):
+            collector = stats.current()
+            timings = timing.start()
+            if collector is None and timings is None:
+                return select(cls, None, None, args, kwargs)
+            start = timer()
+            db_time = collector.db_time if collector is not None else 0.0
+            try:
+                return select(cls, collector, timings, args, kwargs)
+            finally:
+                if collector is not None:
+                    collector.time += (timer() - start -
+                                       (collector.db_time - db_time))
+                if timings is not None:
+                    timing.finish(timings)
+
+        def select(cls, collector, timings, args, kwargs):
             if args:
                 result_type = args[0]
             else:
@@ -313,7 +590,11 @@ class QueryCacheBackend(object):
             if any([isinstance(cls, c) for c in self._write_compilers]):
                 return original(cls, *args, **kwargs)
             try:
+                if timings is not None:
+                    timings.begin()
                 sql, params = cls.as_sql()
+                if timings is not None:
+                    timings.end('as_sql')
                 if not sql:
                     raise EmptyResultSet
             except EmptyResultSet:
@@ -326,40 +607,120 @@ class QueryCacheBackend(object):
             key, val = None, NotInCache()
             # check the blacklist for any of the involved tables;  if it's not
             # there, then look for the value in the cache.
+            if timings is not None:
+                timings.begin()
             tables = get_tables_for_query(cls.query)
+            if timings is not None:
+                timings.end('tables')
+                timings.begin()
             # if the tables are blacklisted, send a qc_skip signal
             blacklisted = disallowed_table(*tables)
-
-            try:
-                ordering_aliases = cls.ordering_aliases
-            except AttributeError:
-                ordering_aliases = cls.query.ordering_aliases
-
-            if blacklisted:
-                signals.qc_skip.send(sender=cls, tables=tables,
-                    query=(sql, params, ordering_aliases),
-                    key=key)
-            if tables and not blacklisted:
+            if timings is not None:
+                timings.end('disallowed')
+
+            # only signal receivers need the ordering aliases
+            ordering_aliases = None
+            if (signals.qc_hit.receivers or signals.qc_miss.receivers or
+                    signals.qc_skip.receivers):
+                try:
+                    ordering_aliases = cls.ordering_aliases
+                except AttributeError:
+                    ordering_aliases = cls.query.ordering_aliases
+
+            # if the query is cheaper to run than to cache, skip it too
+            shape = None
+            skipped = blacklisted
+            if tables and not blacklisted and query_costs.enabled:
+                shape = (db, result_type, sql)
+                skipped = query_costs.is_cheap(shape)
+            if tables and not skipped and table_bypass.enabled:
+                skipped = table_bypass.is_bypassed(tables)
+
+            if skipped:
+                if collector is not None:
+                    collector.skips += 1
+                if signals.qc_skip.receivers:
+                    signals.qc_skip.send(sender=cls, tables=tables,
+                        query=(sql, params, ordering_aliases),
+                        key=key)
+                for callback in hooks.skip:
+                    callback(key, tables)
+            found = None
+            if tables and not skipped and self.keyhandler.single_trip:
+                if timings is not None:
+                    timings.begin()
+                found = self.keyhandler.lookup(tables, sql, params,
+                                               cls.get_ordering(),
+                                               result_type, db)
+                if timings is not None:
+                    timings.end('get')
+            if found is not None:
+                key, val = found
+            elif tables and not skipped:
+                if timings is not None:
+                    timings.begin()
                 gen_key = self.keyhandler.get_generation(*tables, **{'db': db})
+                if timings is not None:
+                    timings.end('generation')
+                    timings.begin()
                 key = self.keyhandler.sql_key(gen_key, sql, params,
                                               cls.get_ordering(),
-                                              result_type, db)
+                                              result_type, db, tables)
+                if timings is not None:
+                    timings.end('sql_key')
+                    timings.begin()
                 val = self.cache_backend.get(key, NotInCache(), db)
+                if timings is not None:
+                    timings.end('get')
+
+            refreshing = False
+            if isinstance(val, CachedResult):
+                refreshing = self._refresh_early(key, val, db)
+                val = NotInCache() if refreshing else val.value
+
+            stale_age = None
+            if key is not None and isinstance(val, NotInCache) and not refreshing:
+                stale_age = self._stale_age(tables, db)
+                if stale_age:
+                    val = self._get_stale(key, stale_age, db)
 
             if not isinstance(val, NotInCache):
                 if val == no_result_sentinel:
                     val = []
 
-                signals.qc_hit.send(sender=cls, tables=tables,
-                        query=(sql, params, ordering_aliases),
-                        size=len(val), key=key)
+                if table_bypass.enabled:
+                    table_bypass.record_hit(tables)
+                if collector is not None:
+                    collector.hits += 1
+                    collector.est_bytes_read += stats.size(val)
+                if signals.qc_hit.receivers:
+                    signals.qc_hit.send(sender=cls, tables=tables,
+                            query=(sql, params, ordering_aliases),
+                            size=len(val), key=key)
+                for callback in hooks.hit:
+                    callback(key, tables, len(val))
                 return val
 
-            if not blacklisted:
-                signals.qc_miss.send(sender=cls, tables=tables,
-                    query=(sql, params, ordering_aliases),
-                    key=key)
-
+            if not skipped:
+                if table_bypass.enabled:
+                    table_bypass.record_miss(tables)
+                if collector is not None:
+                    collector.misses += 1
+                if signals.qc_miss.receivers:
+                    signals.qc_miss.send(sender=cls, tables=tables,
+                        query=(sql, params, ordering_aliases),
+                        key=key)
+                for callback in hooks.miss:
+                    callback(key, tables)
+                if key is not None and prewarm.recorder is not None:
+                    prewarm.recorder.record(cls, result_type, db, key)
+
+            early = key is not None and bool(settings.EARLY_REFRESH_BETA and
+                                             settings.MIDDLEWARE_SECONDS)
+            timed = (shape is not None or early or collector is not None or
+                     timings is not None)
+            if timed:
+                start = timer()
             val = original(cls, *args, **kwargs)
 
             if hasattr(val, '__iter__'):
@@ -368,14 +729,90 @@ class QueryCacheBackend(object):
                 #no longer lazy...
                 #todo - create a smart iterable wrapper
                 val = list(val)
+            if timed:
+                elapsed = timer() - start
+                if timings is not None:
+                    timings.phases['db'] = elapsed
+            if shape is not None:
+                query_costs.record(shape, elapsed)
+            if collector is not None:
+                collector.db_time += elapsed
             if key is not None:
-                if not val:
-                    self.cache_backend.set(key, no_result_sentinel, settings.MIDDLEWARE_SECONDS, db)
-                else:
-                    self.cache_backend.set(key, val, settings.MIDDLEWARE_SECONDS, db)
+                if timings is not None:
+                    timings.begin()
+                stored = val if val else no_result_sentinel
+                if early:
+                    stored = CachedResult(stored, elapsed,
+                                          time.time() + settings.MIDDLEWARE_SECONDS)
+                self.cache_backend.set(key, stored, settings.MIDDLEWARE_SECONDS, db)
+                # routed results are left to their own cache;  their
+                # generations are never collected
+                if settings.ORPHAN_GC and routing.split(key)[0] is None:
+                    orphans.index(self.cache_backend.cache_backend, key)
+                if timings is not None:
+                    timings.end('set')
+                if collector is not None:
+                    collector.est_bytes_written += stats.size(stored)
+                if stale_age:
+                    self._set_stale(key, val if val else no_result_sentinel,
+                                    stale_age, db)
+                elif refreshing:
+                    lock_key = self.keyhandler.stale_keys(key, db)[1]
+                    self.cache_backend.delete(lock_key)
             return val
         return newfun
 
+    def _refresh_early(self, key, entry, db='default'):
+        """
+        Decides whether to recompute ``entry`` before it expires, using the
+        XFetch algorithm:  the closer the entry is to expiry, and the longer
+        it took to compute, the more likely a read is to refresh it.  Only
+        the worker that claims the refresh marker recomputes it;  everyone
+        else keeps getting the cached value.
+        """
+        beta = settings.EARLY_REFRESH_BETA
+        # 1 - random() is in (0, 1], so the log is always defined
+        gap = -entry.delta * beta * math.log(1.0 - random.random())
+        if time.time() + gap < entry.expiry:
+            return False
+        lock_key = self.keyhandler.stale_keys(key, db)[1]
+        return bool(self.cache_backend.add(lock_key, 1,
+                                           self.refresh_lock_seconds))
+
+    def _stale_age(self, tables, db='default'):
+        """Returns how old a result for ``tables`` may be when it is served
+        after a generation bump, or None if it may not be served stale."""
+        if not settings.STALE_TABLES:
+            return None
+        ages = [settings.STALE_TABLES.get(t) for t in tables]
+        if not all(ages) or self.cache_backend.is_managed(db):
+            return None
+        age = min(ages)
+        writes = local.get('stale_writes') or {}
+        now = time.time()
+        for table in tables:
+            if writes.get(table, 0) > now - age:
+                return None
+        return age
+
+    def _get_stale(self, key, age, db='default'):
+        """Returns the last known result for the query at ``key`` if it is
+        recent enough and another worker is already refreshing it.  The
+        first worker to ask gets ``NotInCache`` and refreshes it inline."""
+        stale_key, lock_key = self.keyhandler.stale_keys(key, db)
+        entry = self.cache_backend.get(stale_key, None, db)
+        if entry is None or time.time() - entry[0] > age:
+            return NotInCache()
+        if self.cache_backend.add(lock_key, 1, self.refresh_lock_seconds):
+            return NotInCache()
+        return entry[1]
+
+    def _set_stale(self, key, val, age, db='default'):
+        stale_key, lock_key = self.keyhandler.stale_keys(key, db)
+        self.cache_backend.set(stale_key, (time.time(), val),
+                               int(math.ceil(age)), db)
+        self.cache_backend.delete(lock_key)
+
     def _monkey_write(self, original):
         @wraps(original, assigned=available_attrs(original))
         def newfun(cls, *args, **kwargs):
@@ -469,4 +906,4 @@ class QueryCacheBackend(object):
         #seen_models = connection.introspection.installed_models(tables)
         for table in tables:
             # we want this to just work, so invalidate even things in blacklist
-            self.keyhandler.invalidate_table(table)
+            self.keyhandler.invalidate_table(table, force=True)
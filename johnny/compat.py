@@ -13,6 +13,11 @@ try:
 except ImportError:  # Python < 3.0
     from Queue import Queue
 
+try:
+    from time import perf_counter as timer
+except ImportError:  # Python < 3.3
+    from time import time as timer
+
 import django
 from django.db import transaction
 
@@ -27,7 +32,7 @@ except ImportError:  # Django < 1.4.2
 
 
 __all__ = (
-    'Queue', 'force_bytes', 'force_text', 'string_types', 'text_type',
+    'Queue', 'timer', 'force_bytes', 'force_text', 'string_types', 'text_type',
     'empty_iter', 'is_managed', 'managed',
 )
 
@@ -0,0 +1,52 @@
+"""
+Lightweight callbacks for high-frequency consumers of query cache events.
+
+The ``qc_hit``, ``qc_miss`` and ``qc_skip`` signals go through Django's
+signal dispatch and carry the query's sql and params, which is more than
+most stats consumers need.  Callbacks registered here are called directly,
+with positional arguments only:
+
+* ``hit`` callbacks get ``(key, tables, size)``
+* ``miss`` callbacks get ``(key, tables)``
+* ``skip`` callbacks get ``(key, tables)``
+
+Unlike signal receivers, callbacks are held by strong references and are
+called in the thread that ran the query.  They should be fast and must not
+raise.
+"""
+
+import threading
+
+EVENTS = ('hit', 'miss', 'skip')
+
+# tuples are replaced rather than mutated, so the query cache can iterate
+# them without a lock
+hit = ()
+miss = ()
+skip = ()
+
+_lock = threading.Lock()
+
+
+def register(event, callback):
+    """Calls ``callback`` on every ``event`` (one of ``EVENTS``)."""
+    if event not in EVENTS:
+        raise ValueError('Unknown query cache event %r' % (event,))
+    _lock.acquire()
+    try:
+        current = globals()[event]
+        if callback not in current:
+            globals()[event] = current + (callback,)
+    finally:
+        _lock.release()
+
+
+def unregister(event, callback):
+    if event not in EVENTS:
+        raise ValueError('Unknown query cache event %r' % (event,))
+    _lock.acquire()
+    try:
+        globals()[event] = tuple(c for c in globals()[event]
+                                 if c != callback)
+    finally:
+        _lock.release()
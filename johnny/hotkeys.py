@@ -0,0 +1,186 @@
+"""
+Sampling of the keys johnny reads from the cache, to find hot keys.
+
+Every query on a table reads that table's generation key, so on a cache
+cluster the node holding the generation of a popular table gets far more
+traffic than the others.  When ``JOHNNY_HOTKEY_SAMPLE_RATE`` is above ``0``,
+that fraction of the reads johnny sends to the cache backend are counted in
+a space-saving sketch, which keeps the ``JOHNNY_HOTKEY_CAPACITY`` most
+frequent keys in constant memory.  ``hot_keys.report()`` returns the hottest
+keys of this process with their estimated read rates;  if
+``JOHNNY_HOTKEY_FILE`` is set, each process also writes its sketch to that
+path followed by its pid, and ``manage.py johnny_hotkeys`` merges them.
+"""
+
+import atexit
+import glob
+import json
+import os
+import random
+import threading
+import time
+
+from . import settings
+
+
+class SpaceSaving(object):
+    """
+    The space-saving top-k sketch of Metwally et al.  It keeps ``capacity``
+    counters;  a key that isn't counted takes over the smallest counter and
+    records its old value as its possible overcount (``error``).  Any key
+    read more often than 1/``capacity`` of the time is guaranteed a counter.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+
+    def add(self, key, count=1):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0]
+        else:
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + count, floor]
+
+    def top(self, limit=None):
+        """Returns (key, count, error) tuples, most frequent first."""
+        items = sorted(self.counters.items(), key=lambda i: -i[1][0])
+        return [(k, c, e) for k, (c, e) in items[:limit]]
+
+
+KINDS = ('table', 'multi', 'query', 'stale', 'refresh', 'debounce', 'pending')
+
+
+def key_kind(key):
+    """Returns what kind of johnny key ``key`` is:  ``table`` for table
+    generations, ``multi`` for combined generations, ``query`` for cached
+    results, or the other kinds of ``KeyGen.gen_table_key``."""
+    # the first match wins, since table names can contain these words too
+    for part in key.split('_'):
+        if part in KINDS:
+            return part
+    return 'other'
+
+
+class HotKeyTracker(object):
+    """Samples the keys read from the cache backend into a ``SpaceSaving``
+    sketch.  Disabled while ``JOHNNY_HOTKEY_SAMPLE_RATE`` is ``0``."""
+    flush_every = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.clear()
+        if settings.HOTKEY_FILE:
+            self.path = settings.HOTKEY_FILE
+            atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return settings.HOTKEY_SAMPLE_RATE > 0
+
+    def record(self, key):
+        """Counts a read of ``key`` with probability
+        ``JOHNNY_HOTKEY_SAMPLE_RATE``."""
+        rate = settings.HOTKEY_SAMPLE_RATE
+        if rate < 1 and random.random() >= rate:
+            return
+        self.lock.acquire()
+        try:
+            self.sketch.add(key)
+            self.samples += 1
+            flush = self.path and self.samples % self.flush_every == 0
+        finally:
+            self.lock.release()
+        if flush:
+            self.flush()
+
+    def dump(self):
+        """Returns the state of the sketch as a json-able dict."""
+        self.lock.acquire()
+        try:
+            return {
+                'started': self.started,
+                'dumped': time.time(),
+                'sample_rate': settings.HOTKEY_SAMPLE_RATE,
+                'samples': self.samples,
+                'keys': dict((k, list(v))
+                             for k, v in self.sketch.counters.items()),
+            }
+        finally:
+            self.lock.release()
+
+    def report(self, limit=20):
+        """Returns the ``limit`` hottest keys read by this process."""
+        return report([self.dump()], limit)
+
+    def flush(self):
+        if not self.path or not self.samples:
+            return
+        data = self.dump()
+        filename = '%s.%d' % (self.path, os.getpid())
+        tmp = '%s.tmp' % filename
+        f = open(tmp, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.sketch = SpaceSaving(settings.HOTKEY_CAPACITY)
+            self.samples = 0
+            self.started = time.time()
+        finally:
+            self.lock.release()
+
+
+hot_keys = HotKeyTracker()
+
+
+def report(dumps, limit=20):
+    """
+    Merges the sketches in ``dumps`` (as returned by ``HotKeyTracker.dump``)
+    into a list of dicts, hottest first, with each key's kind, its estimated
+    number of reads and reads per second, summed over the dumps, and the
+    share of all sampled reads it accounts for.  ``error`` is the number of
+    reads the estimate may be over by.
+    """
+    keys = {}
+    total = 0
+    for dump in dumps:
+        rate = float(dump['sample_rate'] or 1)
+        elapsed = max(dump['dumped'] - dump['started'], 1e-6)
+        total += dump['samples']
+        for key, (count, error) in dump['keys'].items():
+            entry = keys.setdefault(key, {'key': key, 'kind': key_kind(key),
+                                          'samples': 0, 'reads': 0.0,
+                                          'error': 0.0, 'per_second': 0.0})
+            entry['samples'] += count
+            entry['reads'] += count / rate
+            entry['error'] += error / rate
+            entry['per_second'] += count / rate / elapsed
+    rows = sorted(keys.values(), key=lambda e: -e['per_second'])[:limit]
+    for row in rows:
+        row['share'] = float(row['samples']) / total if total else 0.0
+    return rows
+
+
+def load_dumps(path=None):
+    """Reads the sketches written by every process to ``path``."""
+    path = path or settings.HOTKEY_FILE
+    dumps = []
+    for filename in glob.glob('%s.*' % path):
+        if filename.endswith('.tmp'):
+            continue
+        f = open(filename)
+        try:
+            dumps.append(json.load(f))
+        finally:
+            f.close()
+    return dumps
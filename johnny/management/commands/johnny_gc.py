@@ -0,0 +1,15 @@
+"""Deletes the query results cached under superseded generations."""
+
+from django.core.management.base import BaseCommand
+
+from johnny import cache, orphans
+
+
+class Command(BaseCommand):
+    help = ("Deletes the query results cached under superseded generations, "
+            "as indexed with JOHNNY_ORPHAN_GC.")
+
+    def handle(self, *args, **options):
+        shared = cache.get_backend().cache_backend.cache_backend
+        deleted = orphans.collect(shared)
+        self.stdout.write('Deleted %d orphaned keys.\n' % deleted)
@@ -0,0 +1,41 @@
+"""Prints the hottest cache keys read by the query cache."""
+
+import glob
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from johnny import hotkeys, settings
+
+
+class Command(BaseCommand):
+    help = ("Merges the hot key sketches written by each process to "
+            "JOHNNY_HOTKEY_FILE and prints the hottest keys.")
+    option_list = BaseCommand.option_list + (
+        make_option('--file', dest='path', default=None,
+                    help='Hot key file prefix; defaults to JOHNNY_HOTKEY_FILE.'),
+        make_option('--limit', dest='limit', type='int', default=20,
+                    help='How many keys to print.'),
+        make_option('--reset', action='store_true', dest='reset',
+                    default=False,
+                    help='Delete the hot key files after printing them.'),
+    )
+
+    def handle(self, *args, **options):
+        path = options.get('path') or settings.HOTKEY_FILE
+        if not path:
+            raise CommandError('Set JOHNNY_HOTKEY_FILE or pass --file.')
+        rows = hotkeys.report(hotkeys.load_dumps(path), options.get('limit'))
+        if not rows:
+            self.stdout.write('No hot keys recorded in %s.*\n' % path)
+        else:
+            self.stdout.write('%-8s %10s %12s %8s  %s\n' % (
+                'kind', 'reads/s', 'reads', 'share', 'key'))
+            for row in rows:
+                self.stdout.write('%-8s %10.1f %12d %7.1f%%  %s\n' % (
+                    row['kind'], row['per_second'], row['reads'],
+                    row['share'] * 100, row['key']))
+        if options.get('reset'):
+            for filename in glob.glob('%s.*' % path):
+                os.remove(filename)
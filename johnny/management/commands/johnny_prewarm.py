@@ -0,0 +1,40 @@
+"""Fills the query cache by replaying recorded cache misses."""
+
+import glob
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from johnny import prewarm, settings
+
+
+class Command(BaseCommand):
+    help = ("Replays the queries that most often missed the query cache, as "
+            "recorded to JOHNNY_PREWARM_FILE, to fill the cache.")
+    option_list = BaseCommand.option_list + (
+        make_option('--file', dest='path', default=None,
+                    help='Recording file prefix; defaults to '
+                         'JOHNNY_PREWARM_FILE.'),
+        make_option('--limit', dest='limit', type='int', default=500,
+                    help='Replay this many of the most missed queries.'),
+        make_option('--threads', dest='threads', type='int', default=4,
+                    help='Number of threads replaying queries.'),
+        make_option('--reset', action='store_true', dest='reset',
+                    default=False,
+                    help='Delete the recording files after replaying them.'),
+    )
+
+    def handle(self, *args, **options):
+        path = options.get('path') or settings.PREWARM_FILE
+        if not path:
+            raise CommandError('Set JOHNNY_PREWARM_FILE or pass --file.')
+        queries = prewarm.load_queries(path)[:options.get('limit')]
+        # replaying misses shouldn't record them again
+        prewarm.set_recorder(None)
+        ran = prewarm.replay(queries, options.get('threads'))
+        self.stdout.write('Replayed %d of %d recorded queries.\n' % (
+            ran, len(queries)))
+        if options.get('reset'):
+            for filename in glob.glob('%s.*' % path):
+                os.remove(filename)
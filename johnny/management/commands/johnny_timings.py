@@ -0,0 +1,39 @@
+"""Prints percentile summaries of the query cache phase timings."""
+
+import glob
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from johnny import settings, timing
+
+
+class Command(BaseCommand):
+    help = ("Summarizes the query cache phase timings written by "
+            "johnny.timing.HistogramSink to JOHNNY_TIMING_FILE.")
+    option_list = BaseCommand.option_list + (
+        make_option('--file', dest='path', default=None,
+                    help='Timing file prefix; defaults to JOHNNY_TIMING_FILE.'),
+        make_option('--reset', action='store_true', dest='reset',
+                    default=False,
+                    help='Delete the timing files after summarizing them.'),
+    )
+
+    def handle(self, *args, **options):
+        path = options.get('path') or settings.TIMING_FILE
+        if not path:
+            raise CommandError('Set JOHNNY_TIMING_FILE or pass --file.')
+        histograms = timing.load_histograms(path)
+        rows = timing.summarize(histograms, (50, 90, 99))
+        if not rows:
+            self.stdout.write('No timings recorded in %s.*\n' % path)
+        else:
+            self.stdout.write('%-12s %10s %10s %10s %10s %10s %10s\n' % (
+                'phase', 'count', 'mean', 'p50', 'p90', 'p99', 'max'))
+            for row in rows:
+                self.stdout.write('%-12s %10d' % row[:2] + ''.join(
+                    ' %8.3fms' % (t * 1000) for t in row[2:]) + '\n')
+        if options.get('reset'):
+            for filename in glob.glob('%s.*' % path):
+                os.remove(filename)
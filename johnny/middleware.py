@@ -3,7 +3,7 @@
 
 """Middleware classes for johnny cache."""
 
-from johnny import cache, settings
+from johnny import cache, settings, stats
 
 
 class QueryCacheMiddleware(object):
@@ -44,3 +44,23 @@ class LocalStoreClearMiddleware(object):
     def process_response(self, req, resp):
         cache.local.clear()
         return resp
+
+
+class QueryCacheStatsMiddleware(object):
+    """
+    This middleware collects query cache statistics for each request (see
+    ``johnny.stats.CacheStats``).  If ``JOHNNY_STATS_HEADER`` is set, they
+    are added to the response as a header of that name, and if
+    ``JOHNNY_STATS_LOG`` is True, they are logged to the ``johnny`` logger.
+    """
+    def process_request(self, request):
+        stats.start()
+
+    def process_response(self, request, response):
+        collected = stats.stop()
+        if collected is not None:
+            if settings.STATS_HEADER:
+                response[settings.STATS_HEADER] = str(collected)
+            if settings.STATS_LOG:
+                stats.logger.info('%s %s', request.path, collected)
+        return response
@@ -0,0 +1,180 @@
+"""
+Garbage collection of the results cached under superseded generations.
+
+Johnny never deletes cached results;  once a table's generation changes
+they are just never read again.  Memcached evicts them in time, but
+johnny's ``locmem`` and ``filebased`` backends keep them forever, or until
+Django culls entries at random.  With ``JOHNNY_ORPHAN_GC`` set, johnny keeps
+an index of the query keys written under each generation and a list of the
+generations that were superseded, and ``collect`` deletes the results of
+those, with the results of the multi generations made from them.
+
+Each index is a journal:  a counter, and a key per entry numbered by
+``incr``, so that adding to it never rewrites what's there, and writes
+from several processes get entries of their own wherever ``incr`` is
+atomic (as it is with memcached and redis).  The list of superseded
+generations is a ring of ``backlog`` entries, read from where the last
+collection stopped;  anything beyond that is left to Django's culling, as
+it was before.  Generations superseded inside a
+managed transaction are only listed once it commits.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from . import settings
+
+logger = logging.getLogger('johnny.orphans')
+
+lock = threading.Lock()
+
+# how many superseded generations are remembered between collections
+backlog = 10000
+
+_pending = threading.local()
+
+
+def _append(cache, key, member, ring=None):
+    """Adds ``member`` to the journal under ``key``, in the next of its
+    ``ring`` entries if given."""
+    timeout = settings.MIDDLEWARE_SECONDS
+    lock.acquire()
+    try:
+        try:
+            number = cache.incr(key)
+        except ValueError:
+            # a new journal
+            cache.add(key, 0, timeout)
+            number = cache.incr(key)
+    finally:
+        lock.release()
+    slot = number % ring if ring else number
+    cache.set('%s_%d' % (key, slot), (number, member), timeout)
+
+
+def _read(cache, key, after=0, ring=None, lost=None):
+    """Returns the number of the last entry in the journal under ``key``,
+    the number of the last one read, and the ``(entry key, member)`` of the
+    ones read after ``after``.  Missing entries are skipped, but with
+    ``lost`` the read stops at the first missing one after ``lost``, which
+    may still be being written."""
+    last = int(cache.get(key) or 0)
+    if ring:
+        after = max(after, last - ring)
+    numbers = range(after + 1, last + 1)
+    slots = ['%s_%d' % (key, n % ring if ring else n) for n in numbers]
+    found = cache.get_many(slots) if slots else {}
+    entries = []
+    for number, slot in zip(numbers, slots):
+        entry = found.get(slot)
+        if entry is None or entry[0] != number:
+            if lost is not None and number > lost:
+                return last, number - 1, entries
+            continue
+        entries.append((slot, entry[1]))
+    return last, last, entries
+
+
+def _orphans_key():
+    return '%s_orphans' % settings.MIDDLEWARE_KEY_PREFIX
+
+
+def index(cache, key):
+    """Adds the query key ``key`` to the index of its generation."""
+    head, generation = key.rsplit('.', 1)[0].rsplit('_query_', 1)
+    _append(cache, '%s_index_%s' % (head, generation), key)
+
+
+def depend(cache, head, generations, multi):
+    """Records that the ``multi`` generation is made of ``generations``."""
+    for generation in generations:
+        _append(cache, '%s_deps_%s' % (head, generation), multi)
+
+
+def supersede(cache, head, generation, db=None, deferred=False):
+    """Marks ``generation`` for collection;  with ``deferred``, when the
+    transaction on ``db`` commits."""
+    if deferred:
+        held = getattr(_pending, 'held', None)
+        if held is None:
+            held = _pending.held = {}
+        held.setdefault(db or DEFAULT_DB_ALIAS, []).append(
+            (cache, head, generation))
+        return
+    _append(cache, _orphans_key(), (head, generation), ring=backlog)
+    if settings.ORPHAN_GC_INTERVAL:
+        _start_collector(cache)
+
+
+def transaction_ended(db=None, commit=True):
+    """Marks, or forgets, the generations superseded in a transaction."""
+    held = getattr(_pending, 'held', None)
+    if not held:
+        return
+    superseded = held.pop(db or DEFAULT_DB_ALIAS, ())
+    if commit:
+        for cache, head, generation in superseded:
+            supersede(cache, head, generation)
+
+
+def collect(cache):
+    """Deletes the results cached under superseded generations from
+    ``cache``, returning the number of keys deleted."""
+    done_key = '%s_done' % _orphans_key()
+    lock.acquire()
+    try:
+        done, lost = cache.get(done_key) or (0, 0)
+        last, done, entries = _read(cache, _orphans_key(), done, backlog, lost)
+        # an entry that's still missing at the next collection was lost
+        cache.set(done_key, (done, done + 1 if done < last else done),
+                  settings.MIDDLEWARE_SECONDS)
+    finally:
+        lock.release()
+    deleted = 0
+    for slot, (head, generation) in entries:
+        doomed = [slot]
+        gens = [generation]
+        deps = '%s_deps_%s' % (head, generation)
+        gens.extend(_take(cache, deps, doomed))
+        for gen in gens:
+            doomed.extend(_take(cache, '%s_index_%s' % (head, gen), doomed))
+        cache.delete_many(doomed)
+        deleted += len(doomed)
+    return deleted
+
+
+def _take(cache, key, doomed):
+    """Returns the members of the journal under ``key``, adding its keys to
+    ``doomed``."""
+    entries = _read(cache, key)[2]
+    doomed.append(key)
+    doomed.extend(slot for slot, member in entries)
+    return [member for slot, member in entries]
+
+
+_collector = {}
+
+
+def _start_collector(cache):
+    """Starts a daemon thread that collects every ``JOHNNY_ORPHAN_GC_INTERVAL``
+    seconds, once per process."""
+    pid = os.getpid()
+    if _collector.get('pid') == pid:
+        return
+    _collector['pid'] = pid
+    interval = settings.ORPHAN_GC_INTERVAL
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                collect(cache)
+            except Exception:
+                logger.exception('Collecting orphaned query keys failed')
+    thread = threading.Thread(target=run, name='johnny-orphans')
+    thread.daemon = True
+    thread.start()
@@ -0,0 +1,171 @@
+"""
+Recording and replaying of the queries that miss the query cache, to fill
+the cache before traffic reaches it after a deploy, a ``flush_query_cache``
+or a cache restart.
+
+When ``JOHNNY_PREWARM_FILE`` is set, every query that misses the cache is
+counted by its *shape* (the database and the hash of its sql, params,
+ordering and result type), and the first time a shape is seen its Django
+``Query`` is pickled.  Each process writes what it recorded to that path
+followed by its pid, and ``manage.py johnny_prewarm`` replays the most
+frequent shapes over all of them through the query cache.
+"""
+
+import atexit
+import glob
+import logging
+import os
+import pickle
+import threading
+
+from . import settings
+
+logger = logging.getLogger('johnny.prewarm')
+
+# the oldest protocol that handles new-style classes;  files may be replayed
+# by a different python than the one that recorded them
+PROTOCOL = 2
+
+
+class QueryRecorder(object):
+    """Counts cache misses by query shape and keeps a pickled query for each
+    shape, up to ``max_queries`` shapes."""
+    max_queries = 5000
+    flush_every = 1000
+
+    def __init__(self, path=None):
+        self.path = path or settings.PREWARM_FILE
+        self.queries = {}
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def record(self, compiler, result_type, db, key):
+        """Records a miss of ``key``, which ``compiler`` was executed for."""
+        # the part of the key after the generation is the same in every
+        # generation;  see KeyHandler.sql_key
+        shape = (db, key.rsplit('.', 1)[-1])
+        self.lock.acquire()
+        try:
+            entry = self.queries.get(shape)
+            if entry is not None:
+                entry[0] += 1
+                return
+            if len(self.queries) >= self.max_queries:
+                return
+        finally:
+            self.lock.release()
+        try:
+            query = pickle.dumps(compiler.query, PROTOCOL)
+        except Exception:
+            # eg. a query with a lambda or an open file in it;  keep counting
+            # it so it isn't pickled again, but it can't be replayed
+            logger.debug('Query for %s cannot be pickled', key)
+            query = None
+        self.lock.acquire()
+        try:
+            self.queries.setdefault(shape, [0, result_type, query])[0] += 1
+            self.pending += 1
+            flush = self.path and self.pending >= self.flush_every
+        finally:
+            self.lock.release()
+        if flush:
+            self.flush()
+
+    def flush(self):
+        if not self.path:
+            return
+        self.lock.acquire()
+        try:
+            data = dict((shape, list(entry))
+                        for shape, entry in self.queries.items())
+            self.pending = 0
+        finally:
+            self.lock.release()
+        if not data:
+            return
+        filename = '%s.%d' % (self.path, os.getpid())
+        tmp = '%s.tmp' % filename
+        f = open(tmp, 'wb')
+        try:
+            pickle.dump(data, f, PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.queries.clear()
+            self.pending = 0
+        finally:
+            self.lock.release()
+
+
+recorder = QueryRecorder() if settings.PREWARM_FILE else None
+
+
+def set_recorder(new_recorder):
+    """Installs a recorder, or stops recording if ``new_recorder`` is None.
+    Only the recorder installed when the process exits is flushed then."""
+    global recorder
+    recorder = new_recorder
+
+
+@atexit.register
+def _flush_at_exit():
+    if recorder is not None:
+        recorder.flush()
+
+
+def load_queries(path=None):
+    """Merges the queries recorded by every process to ``path``, and returns
+    them as (count, db, result_type, pickled query) tuples, the most missed
+    first.  Queries that couldn't be pickled are left out."""
+    path = path or settings.PREWARM_FILE
+    merged = {}
+    for filename in glob.glob('%s.*' % path):
+        if filename.endswith('.tmp'):
+            continue
+        f = open(filename, 'rb')
+        try:
+            data = pickle.load(f)
+        finally:
+            f.close()
+        for shape, (count, result_type, query) in data.items():
+            entry = merged.setdefault(shape, [0, result_type, query])
+            entry[0] += count
+            if entry[2] is None:
+                entry[2] = query
+    queries = [(count, shape[0], result_type, query)
+               for shape, (count, result_type, query) in merged.items()
+               if query is not None]
+    queries.sort(key=lambda q: -q[0])
+    return queries
+
+
+def replay_query(db, result_type, query):
+    """Runs a pickled query through the (patched) compiler, which caches
+    its result.  Returns True if it ran."""
+    try:
+        query = pickle.loads(query)
+        query.get_compiler(using=db).execute_sql(result_type)
+    except Exception:
+        # the model may be gone or changed since the query was recorded
+        logger.warning('Could not replay a recorded query', exc_info=True)
+        return False
+    return True
+
+
+def replay(queries, threads=4):
+    """Replays (count, db, result_type, pickled query) tuples through a pool
+    of ``threads`` threads, returning how many of them ran."""
+    from multiprocessing.pool import ThreadPool
+    from . import cache
+    cache.enable()
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(lambda q: replay_query(*q[1:]), queries)
+    finally:
+        pool.close()
+        pool.join()
+    return sum(1 for ran in results if ran)
@@ -0,0 +1,174 @@
+"""
+Routing of johnny's keys to several caches, in the style of Django's
+database routers.
+
+``JOHNNY_CACHE_ROUTERS`` lists the dotted paths of router classes.  A
+router can define either of these methods, returning the alias of a cache
+in ``CACHES``, or None to leave the decision to the next router:
+
+``cache_for_table(table, db)``
+    The cache holding the generation of ``table`` in database ``db``, and
+    its other per-table keys.
+
+``cache_for_query(tables, db)``
+    The cache holding the results of queries on ``tables``, and their
+    combined generation.  If no router has an opinion, it's the cache of
+    the tables, if they're all in the same one.
+
+Everything else goes to johnny's cache.  A table's generation only ever
+lives in one cache, where every query reads it and every write bumps it, so
+routes stay coherent as long as the routers are the same in every process.
+
+Keys routed elsewhere than johnny's cache start with ``@<alias>:``, so that
+a ``RoutedCache`` under the transaction manager can send them, and the
+writes a transaction holds back until it commits, to the right cache.
+``JOHNNY_ORPHAN_GC`` only indexes and collects results kept in johnny's cache.
+"""
+
+from django.core.cache import get_cache
+
+from . import settings
+from .compat import string_types
+
+
+def _load(path):
+    module, name = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [name]), name)()
+
+
+class CacheRouter(object):
+    """Asks each of ``routers`` in turn where keys go."""
+
+    def __init__(self, routers=()):
+        self.routers = [_load(r) if isinstance(r, string_types) else r
+                        for r in routers]
+
+    def _ask(self, method, *args):
+        for router in self.routers:
+            chosen = getattr(router, method, None)
+            if chosen is None:
+                continue
+            alias = chosen(*args)
+            if alias is not None:
+                return alias
+        return None
+
+    def cache_for_table(self, table, db='default'):
+        return self._ask('cache_for_table', table, db)
+
+    def cache_for_query(self, tables, db='default'):
+        alias = self._ask('cache_for_query', tables, db)
+        if alias is None and tables:
+            found = set(self.cache_for_table(t, db) for t in tables)
+            if len(found) == 1:
+                alias = found.pop()
+        return alias
+
+    def marker(self, alias):
+        """The prefix of the keys routed to ``alias``."""
+        if alias is None or not self.routers:
+            return ''
+        return '@%s:' % alias
+
+
+router = CacheRouter(settings.CACHE_ROUTERS)
+
+
+def split(key):
+    """Returns the alias ``key`` is routed to, or None, and the key
+    without its route."""
+    if key.startswith('@'):
+        marker, _, rest = key.partition(':')
+        if rest:
+            return marker[1:], rest
+    return None, key
+
+
+class RoutedCache(object):
+    """
+    Sends each key to the cache its route names, and the rest to
+    ``default``;  ``caches`` can provide some of the routed caches, which
+    are otherwise looked up in ``CACHES`` when first used.
+    """
+    def __init__(self, default, caches=None):
+        self.default = default
+        self.caches = dict(caches or {})
+
+    def __getattr__(self, name):
+        # johnny_keygen and friends, and any extras of the default cache
+        return getattr(self.default, name)
+
+    def cache(self, alias):
+        if alias is None:
+            return self.default
+        found = self.caches.get(alias)
+        if found is None:
+            found = self.caches[alias] = get_cache(alias)
+        return found
+
+    def _route(self, key):
+        alias, key = split(key)
+        return self.cache(alias), key
+
+    def _group(self, keys):
+        """Groups ``keys`` by cache, as lists of (key, routed key)."""
+        groups = {}
+        for key in keys:
+            alias, bare = split(key)
+            groups.setdefault(alias, []).append((key, bare))
+        return [(self.cache(alias), pairs) for alias, pairs in groups.items()]
+
+    def get(self, key, *args, **kwargs):
+        cache, key = self._route(key)
+        return cache.get(key, *args, **kwargs)
+
+    def set(self, key, *args, **kwargs):
+        cache, key = self._route(key)
+        return cache.set(key, *args, **kwargs)
+
+    def add(self, key, *args, **kwargs):
+        cache, key = self._route(key)
+        return cache.add(key, *args, **kwargs)
+
+    def delete(self, key, *args, **kwargs):
+        cache, key = self._route(key)
+        return cache.delete(key, *args, **kwargs)
+
+    def has_key(self, key, *args, **kwargs):
+        cache, key = self._route(key)
+        return cache.has_key(key, *args, **kwargs)
+
+    def incr(self, key, *args, **kwargs):
+        cache, key = self._route(key)
+        return cache.incr(key, *args, **kwargs)
+
+    def decr(self, key, *args, **kwargs):
+        cache, key = self._route(key)
+        return cache.decr(key, *args, **kwargs)
+
+    def get_many(self, keys, *args, **kwargs):
+        found = {}
+        for cache, pairs in self._group(keys):
+            names = dict((bare, key) for key, bare in pairs)
+            values = cache.get_many(list(names), *args, **kwargs)
+            for bare, value in values.items():
+                found[names[bare]] = value
+        return found
+
+    def set_many(self, data, *args, **kwargs):
+        for cache, pairs in self._group(data):
+            cache.set_many(dict((bare, data[key]) for key, bare in pairs),
+                           *args, **kwargs)
+
+    def delete_many(self, keys, *args, **kwargs):
+        for cache, pairs in self._group(keys):
+            cache.delete_many([bare for key, bare in pairs], *args, **kwargs)
+
+    def clear(self):
+        for cache in set([self.default] + list(self.caches.values())):
+            cache.clear()
+
+    def close(self, **kwargs):
+        for cache in set([self.default] + list(self.caches.values())):
+            if hasattr(cache, 'close'):
+                cache.close(**kwargs)
@@ -20,6 +20,46 @@ MIDDLEWARE_KEY_PREFIX = getattr(settings, 'JOHNNY_MIDDLEWARE_KEY_PREFIX', 'jc')
 
 MIDDLEWARE_SECONDS = getattr(settings, 'JOHNNY_MIDDLEWARE_SECONDS', 0)
 
+EARLY_REFRESH_BETA = getattr(settings, 'JOHNNY_EARLY_REFRESH_BETA', 0)
+
+MIN_QUERY_SECONDS = getattr(settings, 'JOHNNY_MIN_QUERY_SECONDS', 0)
+MIN_QUERY_SAMPLES = getattr(settings, 'JOHNNY_MIN_QUERY_SAMPLES', 10)
+
+BYPASS_INVALIDATION_RATE = getattr(settings,
+                                   'JOHNNY_BYPASS_INVALIDATION_RATE', 0)
+BYPASS_MAX_HIT_RATE = getattr(settings, 'JOHNNY_BYPASS_MAX_HIT_RATE', 0.5)
+BYPASS_WINDOW = getattr(settings, 'JOHNNY_BYPASS_WINDOW', 10)
+
+TABLE_DEBOUNCE = dict(getattr(settings, 'JOHNNY_TABLE_DEBOUNCE', {}))
+
+TABLE_REPLICAS = dict(getattr(settings, 'JOHNNY_TABLE_REPLICAS', {}))
+
+SHARD_TAGS = getattr(settings, 'JOHNNY_SHARD_TAGS', None)
+SHARD_RESULTS = getattr(settings, 'JOHNNY_SHARD_RESULTS', False)
+
+STALE_TABLES = dict(getattr(settings, 'JOHNNY_STALE_TABLES', {}))
+
+STATS_HEADER = getattr(settings, 'JOHNNY_STATS_HEADER', None)
+STATS_LOG = getattr(settings, 'JOHNNY_STATS_LOG', False)
+
+TIMING_SINK = getattr(settings, 'JOHNNY_TIMING_SINK', None)
+TIMING_FILE = getattr(settings, 'JOHNNY_TIMING_FILE', None)
+
+HOTKEY_SAMPLE_RATE = getattr(settings, 'JOHNNY_HOTKEY_SAMPLE_RATE', 0)
+HOTKEY_CAPACITY = getattr(settings, 'JOHNNY_HOTKEY_CAPACITY', 100)
+HOTKEY_FILE = getattr(settings, 'JOHNNY_HOTKEY_FILE', None)
+
+PREWARM_FILE = getattr(settings, 'JOHNNY_PREWARM_FILE', None)
+
+ORPHAN_GC = getattr(settings, 'JOHNNY_ORPHAN_GC', False)
+ORPHAN_GC_INTERVAL = getattr(settings, 'JOHNNY_ORPHAN_GC_INTERVAL', 0)
+
+LOCAL_GENERATIONS = getattr(settings, 'JOHNNY_LOCAL_GENERATIONS', 0)
+BROADCAST = getattr(settings, 'JOHNNY_BROADCAST', None)
+BROADCAST_OPTIONS = dict(getattr(settings, 'JOHNNY_BROADCAST_OPTIONS', {}))
+
+CACHE_ROUTERS = list(getattr(settings, 'JOHNNY_CACHE_ROUTERS', []))
+
 CACHE_BACKEND = getattr(settings, 'JOHNNY_CACHE_BACKEND',
                 getattr(settings, 'CACHE_BACKEND', None))
 
@@ -28,10 +68,19 @@ CACHES = getattr(settings, 'CACHES', {})
 
 def _get_backend():
     """
-    Returns the actual django cache object johnny is configured to use.
-    This relies on the settings only;  the actual active cache can
-    theoretically be changed at runtime.
+    Returns the actual django cache object johnny is configured to use,
+    wrapped in a ``RoutedCache`` if ``JOHNNY_CACHE_ROUTERS`` is set.  This
+    relies on the settings only;  the actual active cache can theoretically
+    be changed at runtime.
     """
+    backend = _get_default_backend()
+    if CACHE_ROUTERS:
+        from johnny.routing import RoutedCache
+        backend = RoutedCache(backend)
+    return backend
+
+
+def _get_default_backend():
     enabled = [n for n, c in sorted(CACHES.items())
                if c.get('JOHNNY_CACHE', False)]
     if len(enabled) > 1:
@@ -8,3 +8,6 @@ qc_hit = Signal(providing_args=['key', 'tables', 'query', 'size'])
 qc_miss = Signal(providing_args=['key', 'tables', 'query'])
 # sent when johnny skips a statement because of blacklisting
 qc_skip = Signal(providing_args=['key', 'tables', 'query'])
+# sent when a table goes in or out of adaptive bypass
+qc_bypass = Signal(providing_args=['table', 'bypassed', 'invalidation_rate',
+                                   'hit_rate'])
@@ -0,0 +1,70 @@
+"""Per-request and per-task statistics for the query cache."""
+
+import logging
+import pickle
+import threading
+
+logger = logging.getLogger('johnny')
+
+_state = threading.local()
+
+
+class CacheStats(object):
+    """
+    Counts of what the query cache did for one request or task:  cache hits,
+    misses and skips, an estimate of the bytes of results read from and
+    written to the cache (see ``size``), the number of calls made to the
+    cache backend, and the wall time spent inside johnny (not counting the
+    database).
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.skips = 0
+        self.est_bytes_read = 0
+        self.est_bytes_written = 0
+        self.backend_calls = 0
+        self.time = 0.0
+        self.db_time = 0.0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def __str__(self):
+        return ('hits=%d misses=%d skips=%d est_read=%d est_written=%d '
+                'calls=%d time=%.3fms db=%.3fms' % (
+                    self.hits, self.misses, self.skips, self.est_bytes_read,
+                    self.est_bytes_written, self.backend_calls,
+                    self.time * 1000, self.db_time * 1000))
+
+
+def start():
+    """Starts collecting stats for the current thread and returns them."""
+    _state.stats = CacheStats()
+    return _state.stats
+
+
+def stop():
+    """Stops collecting stats for the current thread and returns them, or
+    None if they weren't being collected."""
+    stats = getattr(_state, 'stats', None)
+    _state.stats = None
+    return stats
+
+
+def current():
+    """Returns the stats being collected for the current thread, if any."""
+    return getattr(_state, 'stats', None)
+
+
+def count_call(calls=1):
+    stats = getattr(_state, 'stats', None)
+    if stats is not None:
+        stats.backend_calls += calls
+
+
+def size(value):
+    """Estimates the bytes ``value`` takes in the cache by pickling it again;
+    the backend may pickle it differently, or compress it.  Only computed
+    while collecting."""
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
@@ -63,6 +63,50 @@ def _post_teardown(self):
     settings.INSTALLED_APPS = self.saved_INSTALLED_APPS
     settings.DEBUG = self.saved_DEBUG
 
+class CountingCache(object):
+    """Wraps a django cache backend and counts the calls made to it, by
+    method name, in ``calls``."""
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.cache, name)
+        if not callable(attr):
+            return attr
+        def counted(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return attr(*args, **kwargs)
+        return counted
+
+class _AssertCacheCallsContext(object):
+    """Puts a ``CountingCache`` under johnny's ``TransactionManager`` for
+    the duration of a with block, then checks the calls it counted."""
+    def __init__(self, test_case, expected):
+        self.test_case = test_case
+        self.expected = expected
+
+    def __enter__(self):
+        from johnny import cache
+        self.manager = cache.get_backend().cache_backend
+        self.counter = CountingCache(self.manager.cache_backend)
+        self.manager.cache_backend = self.counter
+        return self.counter
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.manager.cache_backend = self.counter.cache
+        if exc_type is not None:
+            return
+        # only the methods named are checked;  name one with 0 to forbid it
+        actual = dict((name, self.counter.calls.get(name, 0))
+                      for name in self.expected)
+        self.test_case.assertEqual(actual, self.expected,
+            "Unexpected cache calls: %s (all calls made: %s)" % (
+                pformat(actual), pformat(self.counter.calls)))
+
+def assert_cache_calls(test_case, **expected):
+    return _AssertCacheCallsContext(test_case, expected)
+
 class JohnnyTestCase(TestCase):
     def _pre_setup(self):
         _pre_setup(self)
@@ -72,6 +116,12 @@ class JohnnyTestCase(TestCase):
         _post_teardown(self)
         super(JohnnyTestCase, self)._post_teardown()
 
+    def assertCacheCalls(self, **expected):
+        """Like ``assertNumQueries``, for calls to the cache backend, eg.
+        ``with self.assertCacheCalls(get=2, set=0):``.  Calls deferred to
+        the ``LocalStore`` during a managed transaction aren't counted."""
+        return assert_cache_calls(self, **expected)
+
 class TransactionJohnnyTestCase(TransactionTestCase):
     def _pre_setup(self):
         _pre_setup(self)
@@ -81,6 +131,9 @@ class TransactionJohnnyTestCase(TransactionTestCase):
         _post_teardown(self)
         super(TransactionJohnnyTestCase, self)._post_teardown()
 
+    def assertCacheCalls(self, **expected):
+        return assert_cache_calls(self, **expected)
+
 class TransactionJohnnyWebTestCase(TransactionJohnnyTestCase):
     def _pre_setup(self):
         self.saved_MIDDLEWARE_CLASSES = settings.MIDDLEWARE_CLASSES
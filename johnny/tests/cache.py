@@ -4,23 +4,60 @@
 """Tests for the QueryCache functionality of johnny."""
 
 from __future__ import print_function
+import os
+import random
+import shutil
+import tempfile
+import time
+import traceback
 from threading import Thread
 
 from django.conf import settings
+from django.core.cache.backends import base as cache_base
 from django.core.paginator import Paginator
 from django.db import connection, connections, transaction, IntegrityError
 from django.db.models import Q, Count, Sum
-from johnny import middleware, settings as johnny_settings, cache
+from django.test import TestCase
+from johnny import (
+    middleware, settings as johnny_settings, broadcast, cache, hooks, orphans,
+    prewarm, routing, timing)
+from johnny.adaptive import query_costs, table_bypass
+from johnny.hotkeys import SpaceSaving, hot_keys
 from johnny.cache import get_tables_for_query, invalidate
-from johnny.compat import is_managed, managed, Queue
-from johnny.signals import qc_hit, qc_miss, qc_skip
+from johnny.compat import force_bytes, is_managed, managed, Queue
+from johnny.signals import qc_hit, qc_miss, qc_skip, qc_bypass
 from . import base
+from .memcached import MemcachedServer
 from .testapp.models import (
     Genre, Book, Publisher, Person, PersonType, Issue24Model as i24m)
 
 
 # put tests in here to be included in the testing suite
-__all__ = ['MultiDbTest', 'SingleModelTest', 'MultiModelTest', 'TransactionSupportTest', 'BlackListTest', 'TransactionManagerTestCase']
+__all__ = ['MultiDbTest', 'SingleModelTest', 'MultiModelTest', 'TransactionSupportTest', 'BlackListTest', 'TransactionManagerTestCase',
+           'QueryCostTest', 'TableBypassTest', 'DebounceTest',
+           'StaleResultTest', 'EarlyRefreshTest', 'TimingTest',
+           'HooksTest', 'CacheCallsTest', 'HotKeysTest', 'ReplicaTest',
+           'PrewarmTest', 'OrphanGCTest', 'ShardTagTest', 'RoutingTest', 'BroadcastTest',
+           'SegmentCacheTest',
+           'SharedMemoryCacheTest', 'TieredCacheTest', 'ClientPoolTest']
+
+_backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+if _backend.endswith('ScriptedRedisCache'):
+    __all__.append('ScriptedRedisTest')
+if _backend.endswith('GenerationHashRedisCache'):
+    __all__.append('GenerationHashRedisTest')
+
+try:
+    import memcache
+    __all__.extend(['FakeMemcachedTest', 'TaggedMemcachedTest'])
+except ImportError:  # python-memcached isn't installed
+    memcache = None
+
+try:
+    import pylibmc
+    __all__.append('PooledPyLibMCTest')
+except ImportError:
+    pylibmc = None
 
 
 def is_multithreading_safe(db_using=None):
@@ -32,6 +69,14 @@ def is_multithreading_safe(db_using=None):
     return not db_engine.endswith('sqlite3')
 
 
+def update(queryset, **values):
+    """Updates ``queryset`` and invalidates its table in the shared cache.
+    Django 1.6 commits the update with ``atomic``, which johnny doesn't hook,
+    so its own invalidation is left in the LocalStore."""
+    queryset.update(**values)
+    invalidate(queryset.model)
+
+
 def _pre_setup(self):
     self.saved_DISABLE_SETTING = getattr(johnny_settings, 'DISABLE_QUERYSET_CACHE', False)
     johnny_settings.DISABLE_QUERYSET_CACHE = False
@@ -81,6 +126,996 @@ class BlackListTest(QueryCacheBase):
         johnny_settings.BLACKLIST = old
 
 
+class QueryCostTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_costs = (johnny_settings.MIN_QUERY_SECONDS,
+                            johnny_settings.MIN_QUERY_SAMPLES)
+        johnny_settings.MIN_QUERY_SAMPLES = 1
+        query_costs.clear()
+        invalidate(Publisher)
+
+    def tearDown(self):
+        (johnny_settings.MIN_QUERY_SECONDS,
+         johnny_settings.MIN_QUERY_SAMPLES) = self.saved_costs
+        query_costs.clear()
+
+    def test_cheap_query_skipped(self):
+        johnny_settings.MIN_QUERY_SECONDS = 60
+        q = base.message_queue()
+        Publisher.objects.get(id=1)
+        with self.assertNumQueries(1):
+            Publisher.objects.get(id=1)
+        self.assertFalse(q.get_nowait())
+        self.assertFalse(q.get_nowait())
+        report = query_costs.report()
+        self.assertEqual(len(report), 1)
+        self.assertTrue(report[0]['excluded'])
+        self.assertEqual(report[0]['count'], 2)
+
+    def test_slow_query_cached(self):
+        johnny_settings.MIN_QUERY_SECONDS = 1e-12
+        Publisher.objects.get(id=1)
+        with self.assertNumQueries(0):
+            Publisher.objects.get(id=1)
+        report = query_costs.report()
+        self.assertFalse(report[0]['excluded'])
+        self.assertEqual(report[0]['count'], 1)
+
+
+class TableBypassTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_bypass = (johnny_settings.BYPASS_INVALIDATION_RATE,
+                             johnny_settings.BYPASS_WINDOW)
+        johnny_settings.BYPASS_WINDOW = 10
+        table_bypass.clear()
+        self.now = time.time()
+        table_bypass.clock = lambda: self.now
+        self.changes = []
+        qc_bypass.connect(self._bypass)
+
+    def tearDown(self):
+        qc_bypass.disconnect(self._bypass)
+        (johnny_settings.BYPASS_INVALIDATION_RATE,
+         johnny_settings.BYPASS_WINDOW) = self.saved_bypass
+        table_bypass.clock = time.time
+        table_bypass.clear()
+
+    def _bypass(self, sender, table, bypassed, **kwargs):
+        self.changes.append((table, bypassed))
+
+    def test_bypass_and_recover(self):
+        # one invalidation in a 10 second window is 0.1/s
+        johnny_settings.BYPASS_INVALIDATION_RATE = 0.1
+        invalidate(Publisher)
+        self.assertEqual(self.changes, [('testapp_publisher', True)])
+        with self.assertNumQueries(2):
+            Publisher.objects.get(id=1)
+            Publisher.objects.get(id=1)
+        # other tables are still cached
+        Genre.objects.get(id=1)
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+        # raising the threshold lets the table cool down on the next read
+        # once it's checked again
+        johnny_settings.BYPASS_INVALIDATION_RATE = 1000
+        with self.assertNumQueries(1):
+            Publisher.objects.get(id=1)
+        self.assertEqual(self.changes[-1], ('testapp_publisher', True))
+        self.now += table_bypass.recheck_seconds
+        Publisher.objects.get(id=1)
+        self.assertEqual(self.changes[-1], ('testapp_publisher', False))
+        with self.assertNumQueries(0):
+            Publisher.objects.get(id=1)
+
+
+class DebounceTest(TransactionQueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_debounce = johnny_settings.TABLE_DEBOUNCE
+        johnny_settings.TABLE_DEBOUNCE = {'testapp_genre': 60}
+        self.keyhandler = cache.get_backend().keyhandler
+        keygen = self.keyhandler.keygen
+        self.markers = [keygen.gen_table_key('testapp_genre', kind=kind)
+                        for kind in ('debounce', 'pending')]
+        self.shared = self.keyhandler.cache_backend.cache_backend
+        self.shared.delete_many(self.markers)
+        self.forget_writes()
+
+    def tearDown(self):
+        johnny_settings.TABLE_DEBOUNCE = self.saved_debounce
+        self.shared.delete_many(self.markers)
+        self.forget_writes()
+
+    def forget_writes(self):
+        """Drops the generations this thread's held back writes gave it."""
+        del cache.local['debounce_overrides']
+
+    def test_debounced_invalidation(self):
+        # the first write in a window bumps the generation right away
+        invalidate(Genre)
+        with self.assertNumQueries(1):
+            Genre.objects.get(id=1)
+            Genre.objects.get(id=1)
+        # later writes are held back, but this thread reads its own write
+        invalidate(Genre)
+        with self.assertNumQueries(1):
+            Genre.objects.get(id=1)
+        # everyone else keeps reading the cached generation
+        self.forget_writes()
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+        # the first read after the window closes bumps the generation
+        self.shared.delete(self.markers[0])
+        with self.assertNumQueries(1):
+            Genre.objects.get(id=1)
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+
+
+class ReplicaTest(TransactionQueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_replicas = johnny_settings.TABLE_REPLICAS
+        johnny_settings.TABLE_REPLICAS = {'testapp_genre': 3}
+        self.keyhandler = cache.get_backend().keyhandler
+        self.keys = self.keyhandler.keygen.gen_replica_keys(
+            self.keyhandler.keygen.gen_table_key('testapp_genre'), 3)
+        self.shared = self.keyhandler.cache_backend.cache_backend
+
+    def tearDown(self):
+        johnny_settings.TABLE_REPLICAS = self.saved_replicas
+
+    def replicas(self):
+        return [self.shared.get(k) for k in self.keys]
+
+    def test_replicated_generation(self):
+        invalidate(Genre)
+        gen = self.replicas()[0]
+        self.assertEqual(self.replicas(), [gen] * 3)
+        Genre.objects.get(id=1)
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+        update(Genre.objects.filter(id=1), title='Fantasy')
+        self.assertNotEqual(self.replicas()[0], gen)
+        self.assertEqual(len(set(self.replicas())), 1)
+
+    def test_missing_replicas(self):
+        invalidate(Genre)
+        gen = self.replicas()[0]
+        saved_choice = random.choice
+        random.choice = lambda seq: seq[0]
+        try:
+            # a missing replica is rewritten from the others
+            self.shared.delete(self.keys[0])
+            self.assertEqual(self.keyhandler.get_generation('testapp_genre'),
+                             gen)
+            self.assertEqual(self.replicas(), [gen] * 3)
+            # replicas that disagree are replaced by a new generation
+            self.shared.delete(self.keys[0])
+            self.shared.set(self.keys[1], 'other')
+            new = self.keyhandler.get_generation('testapp_genre')
+            self.assertTrue(new not in (gen, 'other'))
+            self.assertEqual(self.replicas(), [new] * 3)
+        finally:
+            random.choice = saved_choice
+
+
+class StaleResultTest(TransactionQueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_stale = johnny_settings.STALE_TABLES
+        johnny_settings.STALE_TABLES = {'testapp_genre': 60}
+        self.keyhandler = cache.get_backend().keyhandler
+        self.shared = self.keyhandler.cache_backend.cache_backend
+        self.keys = []
+        qc_miss.connect(self._miss)
+
+    def tearDown(self):
+        qc_miss.disconnect(self._miss)
+        johnny_settings.STALE_TABLES = self.saved_stale
+        self.forget_writes()
+
+    def _miss(self, sender, key, **kwargs):
+        self.keys.append(key)
+
+    def forget_writes(self):
+        """Makes this thread look like one that didn't write to a table."""
+        del cache.local['stale_writes']
+
+    def test_stale_while_revalidate(self):
+        invalidate(Genre)
+        self.forget_writes()
+        Genre.objects.get(id=1)
+        lock_key = self.keyhandler.stale_keys(self.keys[-1])[1]
+        # from here on, act as a thread that didn't write to the table
+        invalidate(Genre)
+        self.forget_writes()
+        # while another worker refreshes the result, the old one is served
+        # (with a timeout, as Django 1.6's locmem add() overwrites keys set
+        # without one)
+        self.shared.add(lock_key, 1, 60)
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+        # otherwise this worker refreshes it
+        self.shared.delete(lock_key)
+        with self.assertNumQueries(1):
+            Genre.objects.get(id=1)
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+        # the thread that wrote never sees stale results
+        invalidate(Genre)
+        self.shared.add(lock_key, 1, 60)
+        with self.assertNumQueries(1):
+            Genre.objects.get(id=1)
+        self.shared.delete(lock_key)
+
+
+class EarlyRefreshTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_early = (johnny_settings.EARLY_REFRESH_BETA,
+                            johnny_settings.MIDDLEWARE_SECONDS)
+        johnny_settings.EARLY_REFRESH_BETA = 1
+        johnny_settings.MIDDLEWARE_SECONDS = 600
+        self.keyhandler = cache.get_backend().keyhandler
+        self.shared = self.keyhandler.cache_backend.cache_backend
+        self.keys = []
+        qc_miss.connect(self._miss)
+
+    def tearDown(self):
+        qc_miss.disconnect(self._miss)
+        (johnny_settings.EARLY_REFRESH_BETA,
+         johnny_settings.MIDDLEWARE_SECONDS) = self.saved_early
+
+    def _miss(self, sender, key, **kwargs):
+        self.keys.append(key)
+
+    def test_early_refresh(self):
+        invalidate(Genre)
+        Genre.objects.get(id=1)
+        lock_key = self.keyhandler.stale_keys(self.keys[-1])[1]
+        # far from expiry, reads are plain hits
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+        # with a huge beta every read wants to refresh, but only the worker
+        # that claims the refresh does;  the rest keep hitting the cache (the
+        # claim needs a timeout, as Django 1.6's locmem add() overwrites keys
+        # set without one)
+        johnny_settings.EARLY_REFRESH_BETA = 1e12
+        self.shared.add(lock_key, 1, 60)
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+        self.shared.delete(lock_key)
+        with self.assertNumQueries(1):
+            Genre.objects.get(id=1)
+
+
+class TimingTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_sink = timing.sink
+        self.sink = timing.HistogramSink(path='')
+        timing.set_sink(self.sink)
+
+    def tearDown(self):
+        timing.set_sink(self.saved_sink)
+
+    def test_phase_timings(self):
+        invalidate(Genre)
+        Genre.objects.get(id=1)
+        Genre.objects.get(id=1)
+        hists = self.sink.histograms
+        self.assertEqual(hists['total'].count, 2)
+        for phase in ('as_sql', 'tables', 'generation', 'sql_key', 'get'):
+            self.assertEqual(hists[phase].count, 2)
+        # only the miss went to the database and set the result
+        self.assertEqual(hists['db'].count, 1)
+        self.assertEqual(hists['set'].count, 1)
+        phases = [row[0] for row in self.sink.summary()]
+        self.assertTrue('db' in phases)
+        self.assertEqual(phases[-1], 'total')
+
+
+class HooksTest(QueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.events = []
+        hooks.register('hit', self._hit)
+        hooks.register('miss', self._miss)
+
+    def tearDown(self):
+        hooks.unregister('hit', self._hit)
+        hooks.unregister('miss', self._miss)
+
+    def _hit(self, key, tables, size):
+        self.events.append(('hit', key, tables))
+
+    def _miss(self, key, tables):
+        self.events.append(('miss', key, tables))
+
+    def test_hooks(self):
+        invalidate(Genre)
+        Genre.objects.get(id=1)
+        Genre.objects.get(id=1)
+        self.assertEqual([e[0] for e in self.events], ['miss', 'hit'])
+        self.assertEqual(self.events[0][1], self.events[1][1])
+        self.assertEqual(self.events[0][2], ['testapp_genre'])
+        self.assertRaises(ValueError, hooks.register, 'bogus', self._hit)
+
+
+class CacheCallsTest(TransactionQueryCacheBase):
+    """Pins down the cache round trips each kind of query costs."""
+    fixtures = base.johnny_fixtures
+
+    def test_single_table(self):
+        invalidate(Genre)
+        # the table generation, the query miss, caching the result
+        with self.assertCacheCalls(get=2, set=1):
+            Genre.objects.get(id=1)
+        with self.assertCacheCalls(get=2, set=0):
+            Genre.objects.get(id=1)
+
+    def test_multi_table(self):
+        list(Book.objects.select_related('publisher'))
+        # both table generations at once, the combined generation and the
+        # query
+        with self.assertCacheCalls(get_many=1, get=2, set=0):
+            list(Book.objects.select_related('publisher'))
+
+
+class HotKeysTest(TransactionQueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_rate = johnny_settings.HOTKEY_SAMPLE_RATE
+        johnny_settings.HOTKEY_SAMPLE_RATE = 1
+        hot_keys.clear()
+
+    def tearDown(self):
+        johnny_settings.HOTKEY_SAMPLE_RATE = self.saved_rate
+        hot_keys.clear()
+
+    def test_space_saving(self):
+        sketch = SpaceSaving(2)
+        for key in 'aaabc':
+            sketch.add(key)
+        # c took over b's counter, so it may be overcounted by one
+        self.assertEqual(sketch.top(), [('a', 3, 0), ('c', 2, 1)])
+
+    def test_report(self):
+        for i in range(3):
+            Genre.objects.get(id=1)
+        Publisher.objects.get(id=1)
+        report = hot_keys.report()
+        genre = [row for row in report if row['kind'] == 'table' and
+                 row['key'].endswith('testapp_genre')]
+        self.assertEqual(genre[0]['samples'], 3)
+        self.assertEqual(report[0]['samples'], 3)
+        kinds = set(row['kind'] for row in report)
+        self.assertEqual(kinds, set(['table', 'query']))
+
+
+class PrewarmTest(TransactionQueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved_recorder = prewarm.recorder
+        self.recorder = prewarm.QueryRecorder(self.dir + '/prewarm')
+        prewarm.set_recorder(self.recorder)
+
+    def tearDown(self):
+        prewarm.set_recorder(self.saved_recorder)
+        shutil.rmtree(self.dir)
+
+    def test_record_and_replay(self):
+        for i in range(2):
+            invalidate(Genre)
+            Genre.objects.get(id=1)
+            Genre.objects.get(id=1)
+        list(Book.objects.filter(title__startswith='A'))
+        self.recorder.flush()
+        queries = prewarm.load_queries(self.dir + '/prewarm')
+        self.assertEqual([q[0] for q in queries], [2, 1])
+        invalidate(Genre, Book)
+        # the pool's threads wouldn't see sqlite's in-memory test database
+        for count, db, result_type, query in queries:
+            self.assertTrue(prewarm.replay_query(db, result_type, query))
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+            list(Book.objects.filter(title__startswith='A'))
+
+
+class OrphanGCTest(TransactionQueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_gc = johnny_settings.ORPHAN_GC
+        johnny_settings.ORPHAN_GC = True
+        self.shared = cache.get_backend().cache_backend.cache_backend
+        self.keys = []
+        hooks.register('miss', self._miss)
+
+    def tearDown(self):
+        hooks.unregister('miss', self._miss)
+        johnny_settings.ORPHAN_GC = self.saved_gc
+
+    def _miss(self, key, tables):
+        self.keys.append(key)
+
+    def test_collect(self):
+        invalidate(Genre, Book, Publisher)
+        orphans.collect(self.shared)
+        Genre.objects.get(id=1)
+        list(Book.objects.select_related('publisher'))
+        genre, books = self.keys
+        invalidate(Genre)
+        self.assertTrue(orphans.collect(self.shared) > 0)
+        self.assertEqual(self.shared.get(genre), None)
+        self.assertNotEqual(self.shared.get(books), None)
+        # results under a multi generation go with any of its tables
+        invalidate(Publisher)
+        orphans.collect(self.shared)
+        self.assertEqual(self.shared.get(books), None)
+
+    def test_rollback(self):
+        Genre.objects.get(id=1)
+        genre = self.keys[-1]
+        orphans.collect(self.shared)
+        transaction.enter_transaction_management()
+        managed()
+        g = Genre.objects.get(id=1)
+        g.title = 'Rolled back'
+        g.save()
+        transaction.rollback()
+        managed(False)
+        # the generation is still current, so its results stay
+        self.assertEqual(orphans.collect(self.shared), 0)
+        self.assertNotEqual(self.shared.get(genre), None)
+
+
+class ScriptedRedisTest(TransactionQueryCacheBase):
+    """Runs with CACHE_BACKEND=redis-scripted against a local redis."""
+    fixtures = base.johnny_fixtures
+
+    def test_single_trip(self):
+        invalidate(Genre, Book, Publisher)
+        Genre.objects.get(id=1)
+        list(Book.objects.select_related('publisher'))
+        with self.assertNumQueries(0):
+            with self.assertCacheCalls(lookup_query=2, get=0, get_many=0):
+                Genre.objects.get(id=1)
+                list(Book.objects.select_related('publisher'))
+        # a write is seen by the next lookup
+        update(Genre.objects.filter(id=1), title='Fantasy')
+        with self.assertNumQueries(1):
+            self.assertEqual(Genre.objects.get(id=1).title, 'Fantasy')
+
+
+class GenerationHashRedisTest(TransactionQueryCacheBase):
+    """Runs with CACHE_BACKEND=redis-hashes against a local redis."""
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.keyhandler = cache.get_backend().keyhandler
+        self.redis = self.keyhandler.cache_backend.cache_backend
+
+    def results(self, *tables):
+        gen = self.keyhandler.get_generation(*tables)
+        return self.redis.make_key('%s_default_results_%s' % (
+            johnny_settings.MIDDLEWARE_KEY_PREFIX, gen))
+
+    def exists(self, key):
+        return self.redis._client.exists(key)
+
+    def test_reclaim_on_invalidation(self):
+        invalidate(Genre, Book, Publisher)
+        Genre.objects.get(id=1)
+        list(Book.objects.select_related('publisher'))
+        genres = self.results('testapp_genre')
+        # the query's tables come from a set, so try both orders
+        books = [self.results('testapp_book', 'testapp_publisher'),
+                 self.results('testapp_publisher', 'testapp_book')]
+        self.assertTrue(self.exists(genres))
+        self.assertTrue(any(self.exists(k) for k in books))
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+            list(Book.objects.select_related('publisher'))
+        update(Genre.objects.filter(id=1), title='Fantasy')
+        self.assertFalse(self.exists(genres))
+        # multi generations go with any of their tables
+        invalidate(Publisher)
+        self.assertFalse(any(self.exists(k) for k in books))
+
+
+class ShardTagTest(TransactionQueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.saved_tags = johnny_settings.SHARD_TAGS
+        self.saved_results = johnny_settings.SHARD_RESULTS
+        johnny_settings.SHARD_TAGS = {'testapp_book': 'books',
+                                      'testapp_publisher': 'books'}
+        johnny_settings.SHARD_RESULTS = True
+        self.keyhandler = cache.get_backend().keyhandler
+
+    def tearDown(self):
+        johnny_settings.SHARD_TAGS = self.saved_tags
+        johnny_settings.SHARD_RESULTS = self.saved_results
+
+    def test_keys(self):
+        keygen = self.keyhandler.keygen
+        self.assertTrue(keygen.gen_table_key('testapp_book').endswith('{books}'))
+        self.assertFalse('{' in keygen.gen_table_key('testapp_genre'))
+        tables = ['testapp_book', 'testapp_publisher']
+        self.assertTrue(keygen.gen_multi_key(['a', 'b'], 'default',
+                                             tables).endswith('{books}'))
+        tables.append('testapp_genre')
+        self.assertFalse('{' in keygen.gen_multi_key(['a', 'b', 'c'],
+                                                     'default', tables))
+        johnny_settings.SHARD_TAGS = 'db'
+        self.assertTrue(keygen.gen_table_key('testapp_genre').endswith(
+            '{%s}' % johnny_settings.DB_CACHE_KEYS['default']))
+
+    def test_tagged_queries(self):
+        keys = []
+        miss = lambda key, tables: keys.append(key)
+        hooks.register('miss', miss)
+        try:
+            invalidate(Book, Publisher)
+            list(Book.objects.select_related('publisher'))
+        finally:
+            hooks.unregister('miss', miss)
+        self.assertTrue(keys[0].endswith('{books}'))
+        with self.assertNumQueries(0):
+            list(Book.objects.select_related('publisher'))
+        update(Publisher.objects.filter(id=1), title='Tagged')
+        with self.assertNumQueries(1):
+            list(Book.objects.select_related('publisher'))
+
+
+class GenreRouter(object):
+    def cache_for_table(self, table, db):
+        if table == 'testapp_genre':
+            return 'reports'
+
+
+class RoutingTest(TransactionQueryCacheBase):
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        from django.core.cache import get_cache
+        self.saved_router = routing.router
+        routing.router = routing.CacheRouter([GenreRouter()])
+        self.manager = cache.get_backend().cache_backend
+        self.default = self.manager.cache_backend
+        self.reports = get_cache('johnny.backends.locmem.LocMemCache',
+                                 LOCATION='johnny-reports')
+        self.manager.cache_backend = routing.RoutedCache(
+            self.default, {'reports': self.reports})
+        # loading the fixtures left unrouted generations behind
+        self.default.clear()
+        self.keygen = cache.get_backend().keyhandler.keygen
+
+    def tearDown(self):
+        self.manager.cache_backend = self.default
+        routing.router = self.saved_router
+        self.reports.clear()
+
+    def test_routes(self):
+        genre = self.keygen.gen_table_key('testapp_genre')
+        book = self.keygen.gen_table_key('testapp_book')
+        self.assertEqual(routing.split(genre)[0], 'reports')
+        self.assertEqual(routing.split(book), (None, book))
+        invalidate(Genre, Book)
+        bare = routing.split(genre)[1]
+        self.assertEqual(self.default.get(bare), None)
+        self.assertNotEqual(self.reports.get(bare), None)
+        self.assertEqual(
+            set(self.manager.cache_backend.get_many([genre, book])),
+            set([genre, book]))
+
+    def test_queries(self):
+        Genre.objects.get(id=1)
+        with self.assertNumQueries(0):
+            Genre.objects.get(id=1)
+        update(Genre.objects.filter(id=1), title='Routed')
+        with self.assertNumQueries(1):
+            Genre.objects.get(id=1)
+
+    def test_orphan_gc(self):
+        saved_gc = johnny_settings.ORPHAN_GC
+        johnny_settings.ORPHAN_GC = True
+        try:
+            Genre.objects.get(id=1)
+        finally:
+            johnny_settings.ORPHAN_GC = saved_gc
+        # routed results aren't indexed, as they're never collected
+        self.assertEqual(
+            [k for k in self.reports._cache if '_index_' in k], [])
+
+
+class BroadcastTest(TransactionQueryCacheBase):
+    """Tests local generations, with a second unix socket transport
+    standing in for another process."""
+    fixtures = base.johnny_fixtures
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = broadcast.generations, broadcast.broadcaster
+        self.generations = broadcast.LocalGenerations(60)
+        self.broadcaster = broadcast.Broadcaster(
+            broadcast.UnixSocketTransport(self.dir), self.generations)
+        broadcast.generations = self.generations
+        broadcast.broadcaster = self.broadcaster
+        self.other = broadcast.UnixSocketTransport(self.dir)
+        self.key = cache.get_backend().keyhandler.keygen.gen_table_key(
+            'testapp_genre')
+
+    def tearDown(self):
+        broadcast.generations, broadcast.broadcaster = self.saved
+        self.broadcaster.stop()
+        self.other.close()
+        shutil.rmtree(self.dir)
+
+    def wait_for(self, check):
+        for i in range(50):
+            if check():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_local_generation(self):
+        Genre.objects.get(id=1)
+        self.assertNotEqual(self.generations.get(self.key), None)
+        # only the query itself is read from the cache
+        with self.assertCacheCalls(get=1, set=0):
+            Genre.objects.get(id=1)
+
+    def test_write_drops(self):
+        Genre.objects.get(id=1)
+        old = self.generations.get(self.key)
+        update(Genre.objects.filter(id=1), title='Broadcast')
+        self.assertEqual(self.generations.get(self.key), None)
+        self.assertEqual(Genre.objects.get(id=1).title, 'Broadcast')
+        self.assertNotEqual(self.generations.get(self.key), old)
+
+    def test_remote_bump(self):
+        Genre.objects.get(id=1)
+        self.assertTrue(self.wait_for(lambda: os.listdir(self.dir)))
+        self.other.publish(self.key.encode('utf-8'))
+        self.assertTrue(
+            self.wait_for(lambda: self.generations.get(self.key) is None))
+
+
+class SegmentCacheTest(TestCase):
+    """Tests the segment file backend, with two instances standing in for
+    two processes sharing a directory."""
+    def setUp(self):
+        from django.core.cache import get_cache
+        self.dir = tempfile.mkdtemp()
+        options = {'SEGMENTS': 2, 'MIN_COMPACT_SIZE': 1000,
+                   'MAX_SEGMENT_SIZE': 20000}
+        self.a, self.b = [
+            get_cache('johnny.backends.segments.SegmentCache',
+                      LOCATION=self.dir, OPTIONS=options)
+            for i in range(2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared(self):
+        a, b = self.a, self.b
+        a.set('genre', {'title': 'Fantasy'}, 0)
+        self.assertEqual(b.get('genre'), {'title': 'Fantasy'})
+        self.assertFalse(b.add('genre', 1))
+        self.assertTrue(b.add('book', 2))
+        self.assertEqual(a.get('book'), 2)
+        a.delete('genre')
+        self.assertEqual(b.get('genre'), None)
+        a.set('gone', 1, -1)
+        self.assertEqual(b.get('gone'), None)
+        # Django 1.6 reads a timeout of None as forever, older ones as the
+        # default
+        a.set('kept', 1, None)
+        key, segment = a._key('kept')
+        self.assertEqual(segment.index[key][2] == 0,
+                         hasattr(cache_base, 'DEFAULT_TIMEOUT'))
+        a.clear()
+        self.assertEqual(b.get('book'), None)
+
+    def test_compaction(self):
+        a, b = self.a, self.b
+        for i in range(1000):
+            a.set('key%d' % (i % 10), i, 0)
+        self.assertEqual(b.get('key9'), 999)
+        # overwritten records are dropped once they're most of a segment
+        for segment in a._segments:
+            self.assertTrue(segment.live * 2 >= segment.size)
+        for i in range(1000):
+            a.set('new%d' % i, 'x' * 20, 0)
+        # and the oldest live ones when a segment outgrows MAX_SEGMENT_SIZE
+        self.assertEqual(b.get('new0'), None)
+        self.assertEqual(b.get('new999'), 'x' * 20)
+        for segment in a._segments:
+            self.assertTrue(segment.size <= 20000)
+
+
+class SharedMemoryCacheTest(TestCase):
+    """Tests the shared memory backend, with a forked process mapping the
+    same region."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.a = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        from django.core.cache import get_cache
+        options = {'SIZE': 1024 * 1024, 'PAGE_SIZE': 64 * 1024, 'STRIPES': 8}
+        return get_cache('johnny.backends.shm.SharedMemoryCache',
+                         LOCATION=self.dir + '/region', OPTIONS=options)
+
+    def in_child(self, check):
+        """Calls ``check`` with a cache of its own in another process."""
+        pid = os.fork()
+        if not pid:
+            try:
+                check(self.open())
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+    def test_shared(self):
+        a = self.a
+        a.set('genre', {'title': 'Fantasy'}, 0)
+
+        def add(b):
+            self.assertEqual(b.get('genre'), {'title': 'Fantasy'})
+            self.assertFalse(b.add('genre', 1))
+            self.assertTrue(b.add('book', 2))
+        self.in_child(add)
+        self.assertEqual(a.get('book'), 2)
+        a.delete('genre')
+        a.set('gone', 1, -1)
+        # bigger than a page
+        a.set('book', 'x' * 100000, 0)
+
+        def gone(b):
+            for key in ('genre', 'gone', 'book'):
+                self.assertEqual(b.get(key), None)
+            b.set('genre', 3, 0)
+        self.in_child(gone)
+        a.clear()
+        self.assertEqual(a.get('genre'), None)
+
+    def test_locks(self):
+        # instances in one process share the locks of the region
+        b = self.open()
+        self.a._acquire(1)
+        try:
+            taken = []
+            thread = Thread(
+                target=lambda: taken.append(b._acquire(1, blocking=False)))
+            thread.start()
+            thread.join()
+            self.assertEqual(taken, [False])
+        finally:
+            self.a._release(1)
+
+    def test_store_holds_stripe(self):
+        # a clear() can't get in between allocating a chunk and linking it
+        a = self.a
+        allocate = a._allocate
+        held = []
+
+        def check(size):
+            stripe = a._stripe(a._key('genre')[2])
+            held.append(a._mutexes[stripe].locked())
+            return allocate(size)
+        a._allocate = check
+        a.set('genre', 1, 0)
+        self.assertEqual(held, [True])
+        self.assertEqual(a.get('genre'), 1)
+
+    def test_sizing(self):
+        from django.core.cache import get_cache
+        for size in range(4200, 4232):
+            c = get_cache('johnny.backends.shm.SharedMemoryCache',
+                          LOCATION='%s/sized-%d' % (self.dir, size),
+                          OPTIONS={'SIZE': size, 'PAGE_SIZE': 128})
+            # the last page, after the aligned buckets, fits in the region
+            self.assertTrue(c._page_base + c._pages * c._page_size <= size)
+
+    def test_eviction(self):
+        for i in range(20000):
+            self.a.set('key%d' % i, 'x' * 100, 0)
+
+        def evicted(b):
+            self.assertEqual(b.get('key19999'), 'x' * 100)
+            self.assertEqual(b.get('key0'), None)
+        self.in_child(evicted)
+
+
+class TieredCacheTest(TestCase):
+    """Tests that only query results are served from the local tier."""
+    def setUp(self):
+        from django.core.cache import get_cache
+        self.cache = get_cache('johnny.backends.tiered.TieredCache')
+        self.cache._local = self.local = get_cache(
+            'johnny.backends.locmem.LocMemCache', LOCATION='tiered-local')
+        self.cache._shared = self.shared = get_cache(
+            'johnny.backends.locmem.LocMemCache', LOCATION='tiered-shared')
+
+    def tearDown(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def test_tiers(self):
+        c = self.cache
+        prefix = johnny_settings.MIDDLEWARE_KEY_PREFIX
+        table = '%s_default_table_testapp_genre' % prefix
+        result = '%s_default_query_1234.abcd' % prefix
+        c.set(table, 1234, 0)
+        c.set(result, ['Fantasy'], 0)
+        self.assertEqual(self.local.get(table), None)
+        self.assertEqual(self.local.get(result), ['Fantasy'])
+        # a result is served locally, and copied there when it isn't
+        self.shared.delete(result)
+        self.assertEqual(c.get(result), ['Fantasy'])
+        self.local.delete(result)
+        self.shared.set(result, ['Horror'], 0)
+        self.assertEqual(c.get_many([table, result]),
+                         {table: 1234, result: ['Horror']})
+        self.assertEqual(self.local.get(result), ['Horror'])
+        # generations always come from the shared cache
+        self.local.set(table, 1, 0)
+        self.assertEqual(c.get(table), 1234)
+        c.delete(result)
+        self.assertEqual(c.get(result), None)
+
+
+class ClientPoolTest(TestCase):
+    """Tests the bounds and counters of the memcached client pool."""
+    def test_pool(self):
+        from johnny.backends.memcached import ClientPool, PoolTimeout
+        pool = ClientPool(object, max_size=2, timeout=0.05)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertRaises(PoolTimeout, pool.acquire)
+        pool.release(first)
+        self.assertTrue(pool.acquire() is first)
+        pool.release(first)
+        pool.release(second)
+        stats = pool.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['peak'], 2)
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['timeouts'], 1)
+
+    def test_waits(self):
+        from johnny.backends.memcached import ClientPool
+        pool = ClientPool(object, max_size=1, timeout=5)
+        client = pool.acquire()
+        got = Queue()
+        thread = Thread(target=lambda: got.put(pool.acquire()))
+        thread.start()
+        pool.release(client)
+        thread.join()
+        self.assertTrue(got.get() is client)
+        self.assertEqual(pool.stats()['size'], 1)
+
+
+class PooledPyLibMCTest(TestCase):
+    """Checks the pooled pylibmc backend against the fake memcached
+    server."""
+    def setUp(self):
+        from django.core.cache import get_cache
+        self.server = MemcachedServer().start()
+        self.cache = get_cache('johnny.backends.memcached.PooledPyLibMCCache',
+                               LOCATION=self.server.location,
+                               OPTIONS={'POOL_SIZE': 2})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_pool(self):
+        c = self.cache
+        threads = [Thread(target=lambda i=i: c.set('key%d' % i, i, 0))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        c.close()
+        self.assertEqual(c.get_many(['key%d' % i for i in range(8)]),
+                         dict(('key%d' % i, i) for i in range(8)))
+        stats = c.pool_stats()
+        self.assertTrue(stats['size'] <= 2)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['checkouts'], 9)
+
+
+class FakeMemcachedTest(TestCase):
+    """Checks the fake memcached server against a real memcached client."""
+    def setUp(self):
+        from django.core.cache import get_cache
+        self.server = MemcachedServer().start()
+        self.cache = get_cache('johnny.backends.memcached.MemcachedCache',
+                               LOCATION=self.server.location)
+
+    def tearDown(self):
+        self.cache.close()
+        self.server.stop()
+
+    def test_commands(self):
+        c = self.cache
+        c.set('a', {'genre': 1}, 0)
+        c.set('n', 1, 0)
+        self.assertEqual(c.get('a'), {'genre': 1})
+        self.assertEqual(c.get_many(['a', 'n', 'missing']),
+                         {'a': {'genre': 1}, 'n': 1})
+        self.assertFalse(c.add('a', 2))
+        self.assertTrue(c.add('b', 2))
+        self.assertEqual(c.incr('n', 5), 6)
+        self.assertEqual(c.decr('n', 10), 0)
+        c.delete('a')
+        self.assertEqual(c.get('a'), None)
+        c.set('gone', 1, -1)
+        self.assertEqual(c.get('gone'), None)
+
+
+class TaggedMemcachedTest(TestCase):
+    """Checks that keys with the same ``{tag}`` land on one memcached."""
+    def setUp(self):
+        from django.core.cache import get_cache
+        self.servers = [MemcachedServer().start() for i in range(2)]
+        self.cache = get_cache(
+            'johnny.backends.memcached.TaggedMemcachedCache',
+            LOCATION=';'.join(s.location for s in self.servers))
+
+    def tearDown(self):
+        self.cache.close()
+        for server in self.servers:
+            server.stop()
+
+    def test_tags(self):
+        c = self.cache
+        used = set()
+        for tag in ('genre', 'book', 'publisher', 'person'):
+            values = dict(('%s_{%s}' % (name, tag), name)
+                          for name in ('gen', 'multi', 'query'))
+            c.set_many(values, 0)
+            made = [force_bytes(c.make_key(k)[1]) for k in values]
+            holding = [i for i, server in enumerate(self.servers)
+                       if made[0] in server.data]
+            self.assertEqual(len(holding), 1)
+            for key in made:
+                self.assertNotEqual(self.servers[holding[0]].lookup(key),
+                                    None)
+            used.update(holding)
+            # replies come back under the keys asked for
+            self.assertEqual(c.get_many(list(values) + ['missing']), values)
+            c.delete_many(list(values))
+            self.assertEqual(c.get_many(list(values)), {})
+        # the tags are spread over both servers
+        self.assertEqual(used, set([0, 1]))
+
+
 class MultiDbTest(TransactionQueryCacheBase):
     multi_db = True
     fixtures = ['genres.json', 'genres2.json']
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A small in-process server speaking the memcached text protocol, for tests
+and benchmarks that should pay for real network round trips and
+serialization without needing a memcached installed.  It supports
+get/gets, set/add/replace/append/prepend/cas, incr/decr, delete, touch and
+flush_all, honors expiry times, and can add an artificial ``latency`` to
+every command to simulate a server on another machine::
+
+    server = MemcachedServer(latency=0.0005).start()
+    CACHES = {'default': {
+        'BACKEND': 'johnny.backends.memcached.MemcachedCache',
+        'LOCATION': server.location,
+        'JOHNNY_CACHE': True,
+    }}
+    ...
+    server.stop()
+
+It can also be run on its own, eg. as the target of the load benchmark::
+
+    python johnny/tests/memcached.py --port 11311 --latency 0.0005
+"""
+
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:  # Python < 3.0
+    import SocketServer as socketserver
+
+# relative expiry times above this are unix timestamps, as in memcached
+MAX_RELATIVE_EXPIRY = 60 * 60 * 24 * 30
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+    """Serves the commands of one client connection."""
+
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0].decode('ascii').lower()
+            if command == 'quit':
+                break
+            noreply = parts[-1] == b'noreply'
+            if noreply:
+                parts = parts[:-1]
+            method = getattr(self, 'cmd_%s' % command, None)
+            try:
+                if method is None:
+                    response = b'ERROR\r\n'
+                else:
+                    response = method(parts[1:])
+            except (ValueError, IndexError):
+                response = b'CLIENT_ERROR bad command line format\r\n'
+            if server.latency:
+                time.sleep(server.latency)
+            if not noreply:
+                self.wfile.write(response)
+                self.wfile.flush()
+
+    def _expires(self, exptime):
+        exptime = int(exptime)
+        if exptime == 0:
+            return None
+        if exptime < 0:
+            return 0
+        if exptime > MAX_RELATIVE_EXPIRY:
+            return exptime
+        return time.time() + exptime
+
+    def _values(self, keys, with_cas):
+        lines = []
+        for key in keys:
+            item = self.server.lookup(key)
+            if item is None:
+                continue
+            flags, expires, cas, value = item
+            header = b'VALUE ' + key + (' %d %d' % (flags, len(value))).encode()
+            if with_cas:
+                header += (' %d' % cas).encode()
+            lines.append(header + b'\r\n' + value + b'\r\n')
+        lines.append(b'END\r\n')
+        return b''.join(lines)
+
+    def cmd_get(self, args):
+        return self._values(args, False)
+
+    def cmd_gets(self, args):
+        return self._values(args, True)
+
+    def _store(self, args, mode):
+        key, flags, exptime, length = args[:4]
+        value = self.rfile.read(int(length) + 2)[:-2]
+        cas = int(args[4]) if mode == 'cas' else None
+        return self.server.store(mode, key, int(flags),
+                                 self._expires(exptime), value, cas)
+
+    def cmd_set(self, args):
+        return self._store(args, 'set')
+
+    def cmd_add(self, args):
+        return self._store(args, 'add')
+
+    def cmd_replace(self, args):
+        return self._store(args, 'replace')
+
+    def cmd_append(self, args):
+        return self._store(args, 'append')
+
+    def cmd_prepend(self, args):
+        return self._store(args, 'prepend')
+
+    def cmd_cas(self, args):
+        return self._store(args, 'cas')
+
+    def cmd_incr(self, args):
+        return self.server.incr(args[0], int(args[1]))
+
+    def cmd_decr(self, args):
+        return self.server.incr(args[0], -int(args[1]))
+
+    def cmd_delete(self, args):
+        # older clients send a (now meaningless) hold time after the key
+        return self.server.delete(args[0])
+
+    def cmd_touch(self, args):
+        return self.server.touch(args[0], self._expires(args[1]))
+
+    def cmd_flush_all(self, args):
+        self.server.flush()
+        return b'OK\r\n'
+
+    def cmd_version(self, args):
+        return b'VERSION 1.4.0-johnny\r\n'
+
+    def cmd_verbosity(self, args):
+        return b'OK\r\n'
+
+    def cmd_stats(self, args):
+        return ('STAT curr_items %d\r\nSTAT cmd_get %d\r\n'
+                'STAT cmd_set %d\r\nEND\r\n' % (
+                    len(self.server.data), self.server.gets,
+                    self.server.sets)).encode()
+
+
+class MemcachedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    A memcached stand-in that keeps its items in a dict.  Binds to a free
+    port on localhost unless given an ``address``;  ``location`` is the
+    ``host:port`` to give a memcached client.  ``latency`` is a number of
+    seconds slept before answering each command.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0):
+        socketserver.TCPServer.__init__(self, address, MemcachedHandler)
+        self.latency = latency
+        self.data = {}
+        self.lock = threading.Lock()
+        self.next_cas = 0
+        self.gets = 0
+        self.sets = 0
+        self.thread = None
+
+    @property
+    def location(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def start(self):
+        """Serves requests from a daemon thread and returns the server."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def lookup(self, key):
+        self.lock.acquire()
+        try:
+            self.gets += 1
+            return self._get(key)
+        finally:
+            self.lock.release()
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self.data[key]
+            item = None
+        return item
+
+    def _put(self, key, flags, expires, value):
+        self.next_cas += 1
+        self.data[key] = (flags, expires, self.next_cas, value)
+
+    def store(self, mode, key, flags, expires, value, cas=None):
+        self.lock.acquire()
+        try:
+            self.sets += 1
+            item = self._get(key)
+            if mode == 'cas':
+                if item is None:
+                    return b'NOT_FOUND\r\n'
+                if item[2] != cas:
+                    return b'EXISTS\r\n'
+            elif mode == 'add' and item is not None:
+                return b'NOT_STORED\r\n'
+            elif mode in ('replace', 'append', 'prepend') and item is None:
+                return b'NOT_STORED\r\n'
+            if mode == 'append':
+                flags, expires, value = item[0], item[1], item[3] + value
+            elif mode == 'prepend':
+                flags, expires, value = item[0], item[1], value + item[3]
+            self._put(key, flags, expires, value)
+            return b'STORED\r\n'
+        finally:
+            self.lock.release()
+
+    def incr(self, key, delta):
+        self.lock.acquire()
+        try:
+            item = self._get(key)
+            if item is None:
+                return b'NOT_FOUND\r\n'
+            try:
+                value = int(item[3])
+            except ValueError:
+                return (b'CLIENT_ERROR cannot increment or decrement '
+                        b'non-numeric value\r\n')
+            # incr wraps at 64 bits, decr stops at 0
+            value = max(value + delta, 0) % 2 ** 64
+            self._put(key, item[0], item[1], str(value).encode())
+            return str(value).encode() + b'\r\n'
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            if self._get(key) is None:
+                return b'NOT_FOUND\r\n'
+            del self.data[key]
+            return b'DELETED\r\n'
+        finally:
+            self.lock.release()
+
+    def touch(self, key, expires):
+        self.lock.acquire()
+        try:
+            item = self._get(key)
+            if item is None:
+                return b'NOT_FOUND\r\n'
+            self.data[key] = (item[0], expires, item[2], item[3])
+            return b'TOUCHED\r\n'
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.data.clear()
+        finally:
+            self.lock.release()
+
+
+def main(argv=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=11211)
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Seconds to wait before answering each command.')
+    options, args = parser.parse_args(argv)
+    server = MemcachedServer((options.host, options.port), options.latency)
+    print('Serving memcached protocol on %s' % server.location)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,12 @@
 
 """Tests for the QueryCache functionality of johnny."""
 
+from johnny import settings as johnny_settings
 from . import base
 
 
 # put tests in here to be included in the testing suite
-__all__ = ['MiddlewaresTestCase']
+__all__ = ['MiddlewaresTestCase', 'StatsMiddlewareTestCase']
 
 
 class MiddlewaresTestCase(base.TransactionJohnnyWebTestCase):
@@ -31,3 +32,30 @@ class MiddlewaresTestCase(base.TransactionJohnnyWebTestCase):
             self.client.get('/test/template_queries')
         with self.assertNumQueries(0):
             self.client.get('/test/template_queries')
+
+
+class StatsMiddlewareTestCase(base.TransactionJohnnyWebTestCase):
+    fixtures = base.johnny_fixtures
+    middlewares = (
+        'johnny.middleware.LocalStoreClearMiddleware',
+        'johnny.middleware.QueryCacheStatsMiddleware',
+        'johnny.middleware.QueryCacheMiddleware',
+        'django.middleware.common.CommonMiddleware',
+    )
+
+    def setUp(self):
+        self.saved_header = johnny_settings.STATS_HEADER
+        johnny_settings.STATS_HEADER = 'X-Johnny-Cache'
+
+    def tearDown(self):
+        johnny_settings.STATS_HEADER = self.saved_header
+
+    def stats(self, response):
+        return dict(field.split('=', 1)
+                    for field in response['X-Johnny-Cache'].split())
+
+    def test_stats_header(self):
+        first = self.stats(self.client.get('/test/template_queries'))
+        second = self.stats(self.client.get('/test/template_queries'))
+        self.assertEqual((first['hits'], first['misses']), ('0', '1'))
+        self.assertEqual((second['hits'], second['misses']), ('1', '0'))
@@ -0,0 +1,234 @@
+"""
+Opt-in timing of the phases of a query going through the query cache.
+
+When no sink is installed, the query cache only pays for a handful of
+``is None`` checks.  To time queries, set ``JOHNNY_TIMING_SINK`` to the
+dotted path of a sink class, or install one with ``set_sink``.  Each query
+is recorded as a dict mapping the names in ``PHASES`` to seconds;  phases
+that didn't happen for a query (eg. ``db`` on a hit) are left out.
+"""
+
+import atexit
+import glob
+import json
+import logging
+import math
+import os
+import threading
+
+from . import settings
+from .compat import timer
+
+PHASES = (
+    'as_sql',       # compiling the sql
+    'tables',       # finding the tables involved
+    'disallowed',   # checking the black and whitelists
+    'generation',   # fetching the generation of those tables
+    'sql_key',      # hashing the query key
+    'get',          # the cache get, including unpickling
+    'db',           # running the query on a miss
+    'set',          # caching the result
+)
+
+
+class QueryTimings(object):
+    """The phase timings of one query."""
+    def __init__(self):
+        self.phases = {}
+        self.started = 0.0
+
+    def begin(self):
+        self.started = timer()
+
+    def end(self, phase):
+        self.phases[phase] = (self.phases.get(phase, 0.0) +
+                              timer() - self.started)
+
+
+class Sink(object):
+    """Receives the phase timings of each query."""
+    def record(self, phases):
+        raise NotImplementedError
+
+
+class LoggingSink(Sink):
+    """Logs the timings of every query to the ``johnny.timing`` logger at
+    the DEBUG level."""
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger('johnny.timing')
+
+    def record(self, phases):
+        self.logger.debug(' '.join('%s=%.3fms' % (p, phases[p] * 1000)
+                                   for p in PHASES if p in phases))
+
+
+class Histogram(object):
+    """A histogram with logarithmic buckets from 1us up, each 20% wider than
+    the last, so percentiles are accurate to within 20%."""
+    base = 1e-6
+    growth = 1.2
+    size = 100
+
+    def __init__(self):
+        self.buckets = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= self.base:
+            idx = 0
+        else:
+            idx = int(math.log(seconds / self.base, self.growth)) + 1
+        self.buckets[min(idx, self.size - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, pct):
+        """Returns the upper bound of the bucket holding the ``pct``th
+        percentile, in seconds."""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * pct / 100.0)
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.base * self.growth ** i, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'buckets': self.buckets, 'count': self.count,
+                'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls()
+        hist.buckets = list(data['buckets'])
+        hist.count = data['count']
+        hist.total = data['total']
+        hist.max = data['max']
+        return hist
+
+
+class HistogramSink(Sink):
+    """
+    Keeps a histogram of each phase in memory.  If ``JOHNNY_TIMING_FILE`` is
+    set, the histograms are also written every ``flush_every`` queries and
+    at exit to a json file named after it and the process id, which is
+    where the ``johnny_timings`` management command reads them from.
+    """
+    flush_every = 1000
+
+    def __init__(self, path=None):
+        self.path = path or settings.TIMING_FILE
+        self.histograms = dict((p, Histogram()) for p in PHASES)
+        self.histograms['total'] = Histogram()
+        self.lock = threading.Lock()
+        self.pending = 0
+        if self.path:
+            atexit.register(self.flush)
+
+    def record(self, phases):
+        self.lock.acquire()
+        try:
+            for phase, seconds in phases.items():
+                self.histograms[phase].add(seconds)
+            self.histograms['total'].add(sum(phases.values()))
+            self.pending += 1
+            flush = self.path and self.pending >= self.flush_every
+        finally:
+            self.lock.release()
+        if flush:
+            self.flush()
+
+    def flush(self):
+        if not self.path:
+            return
+        self.lock.acquire()
+        try:
+            data = dict((p, h.as_dict()) for p, h in self.histograms.items())
+            self.pending = 0
+        finally:
+            self.lock.release()
+        filename = '%s.%d' % (self.path, os.getpid())
+        tmp = '%s.tmp' % filename
+        f = open(tmp, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        return summarize(self.histograms, percentiles)
+
+
+def summarize(histograms, percentiles=(50, 90, 99)):
+    """Returns a list of (phase, count, mean, percentiles..., max) rows,
+    times in seconds, for a dict of phase names to histograms."""
+    rows = []
+    for phase in PHASES + ('total',):
+        hist = histograms.get(phase)
+        if hist is None or not hist.count:
+            continue
+        rows.append((phase, hist.count, hist.total / hist.count) +
+                    tuple(hist.percentile(p) for p in percentiles) +
+                    (hist.max,))
+    return rows
+
+
+def load_histograms(path=None):
+    """Merges the histograms written by every process to ``path``."""
+    path = path or settings.TIMING_FILE
+    merged = {}
+    for filename in glob.glob('%s.*' % path):
+        if filename.endswith('.tmp'):
+            continue
+        f = open(filename)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        for phase, hist in data.items():
+            merged.setdefault(phase, Histogram()).merge(
+                Histogram.from_dict(hist))
+    return merged
+
+
+def _load_sink(path):
+    if not path:
+        return None
+    module, name = path.rsplit('.', 1)
+    return getattr(__import__(module, {}, {}, [name]), name)()
+
+
+sink = _load_sink(settings.TIMING_SINK)
+
+
+def set_sink(new_sink):
+    """Installs a sink, or disables timing if ``new_sink`` is None."""
+    global sink
+    sink = new_sink
+
+
+def start():
+    """Returns a ``QueryTimings`` if timing is enabled, or None."""
+    if sink is None:
+        return None
+    return QueryTimings()
+
+
+def finish(timings):
+    current = sink
+    if current is not None and timings.phases:
+        current.record(timings.phases)
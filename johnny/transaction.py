@@ -1,8 +1,9 @@
 from django.db import transaction, connection, DEFAULT_DB_ALIAS
 
-from johnny import settings as johnny_settings
+from johnny import broadcast, orphans, settings as johnny_settings, stats
 from johnny.compat import is_managed
 from johnny.decorators import wraps, available_attrs
+from johnny.hotkeys import hot_keys
 
 
 class TransactionManager(object):
@@ -60,8 +61,31 @@ class TransactionManager(object):
                 val = self._get_from_savepoints(key, using)
                 if val:
                     return val
+        stats.count_call()
+        if hot_keys.enabled:
+            hot_keys.record(key)
         return self.cache_backend.get(key, default)
 
+    def get_many(self, keys, using=None):
+        """Like ``get``, but fetches all of ``keys`` not found in the local
+        transaction cache in one call to the backend."""
+        found = {}
+        if self.is_managed(using) and self._patched_var:
+            for key in keys:
+                val = self.local.get(key, None)
+                if not val and self._uses_savepoints():
+                    val = self._get_from_savepoints(key, using)
+                if val:
+                    found[key] = val
+        missing = [key for key in keys if key not in found]
+        if missing:
+            stats.count_call()
+            if hot_keys.enabled:
+                for key in missing:
+                    hot_keys.record(key)
+            found.update(self.cache_backend.get_many(missing))
+        return found
+
     def _get_from_savepoints(self, key, using=None):
         sids = self._get_sid(using)
         cp = list(sids)
@@ -90,11 +114,54 @@ class TransactionManager(object):
         if self.is_managed(using=using) and self._patched_var:
             self.local[key] = val
         else:
+            stats.count_call()
             self.cache_backend.set(key, val, timeout)
 
+    def set_many(self, data, timeout=None, using=None):
+        """Like ``set``, for a dict of keys and values, in one call to the
+        backend."""
+        if timeout is None:
+            timeout = self.timeout
+        if self.is_managed(using=using) and self._patched_var:
+            for key, val in data.items():
+                self.local[key] = val
+        else:
+            stats.count_call()
+            self.cache_backend.set_many(data, timeout)
+
+    def add(self, key, val, timeout=None):
+        """
+        Adds a key to the shared cache if it isn't already there, returning
+        True if it was added.  Unlike ``set``, this is never deferred until
+        the end of a transaction;  it is meant for markers that coordinate
+        processes rather than for cached data.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        stats.count_call()
+        return self.cache_backend.add(key, val, timeout)
+
+    def delete(self, key):
+        """Deletes a key from the shared cache right away."""
+        stats.count_call()
+        self.cache_backend.delete(key)
+
+    def _patterns(self, using=None):
+        """The patterns of the keys held back for ``using``, with or without
+        a route (see ``johnny.routing``)."""
+        pattern = '%s_%s_*' % (self.prefix, self._trunc_using(using))
+        return [pattern, '@*:' + pattern]
+
+    def _dirty(self, using=None):
+        """Returns the keys held back for ``using``, with their values."""
+        found = {}
+        for pattern in self._patterns(using):
+            found.update(self.local.mget(pattern))
+        return found
+
     def _clear(self, using=None):
-        self.local.clear('%s_%s_*' %
-                         (self.prefix, self._trunc_using(using)))
+        for pattern in self._patterns(using):
+            self.local.clear(pattern)
 
     def _flush(self, commit=True, using=None):
         """
@@ -104,13 +171,16 @@ class TransactionManager(object):
             # XXX: multi-set?
             if self._uses_savepoints():
                 self._commit_all_savepoints(using)
-            c = self.local.mget('%s_%s_*' %
-                                (self.prefix, self._trunc_using(using)))
+            c = self._dirty(using)
+            stats.count_call(len(c))
             for key, value in c.items():
                 self.cache_backend.set(key, value, self.timeout)
         else:
             if self._uses_savepoints():
                 self._rollback_all_savepoints(using)
+        # tell other processes about the tables bumped, now that it's true
+        broadcast.transaction_ended(using, commit)
+        orphans.transaction_ended(using, commit)
         self._clear(using)
         self._clear_sid_stack(using)
 
@@ -142,8 +212,7 @@ class TransactionManager(object):
         key = self._sid_key(sid, using)
 
         #get all local dirty items
-        c = self.local.mget('%s_%s_*' %
-                            (self.prefix, self._trunc_using(using)))
+        c = self._dirty(using)
         #store them to a dictionary in the localstore
         if key not in self.local:
             self.local[key] = {}
@@ -207,8 +276,7 @@ class TransactionManager(object):
             self._rollback_savepoint(sids[0], using)
 
     def _store_dirty(self, using=None):
-        c = self.local.mget('%s_%s_*' %
-                            (self.prefix, self._trunc_using(using)))
+        c = self._dirty(using)
         backup = 'trans_dirty_store_%s' % self._trunc_using(using)
         self.local[backup] = {}
         for k, v in c.items():
@@ -3,6 +3,7 @@
 
 """Extra johnny utilities."""
 
+from johnny import settings, stats
 from johnny.cache import get_backend, local, patch, unpatch
 from johnny.decorators import wraps, available_attrs
 
@@ -10,12 +11,24 @@ from johnny.decorators import wraps, available_attrs
 __all__ = ["celery_enable_all", "celery_task_wrapper", "johnny_task_wrapper"]
 
 
+def _start_stats():
+    if settings.STATS_LOG:
+        stats.start()
+
+def _log_stats(name):
+    collected = stats.stop()
+    if collected is not None:
+        stats.logger.info('%s %s', name, collected)
+
 def prerun_handler(*args, **kwargs):
     """Celery pre-run handler.  Enables johnny-cache."""
     patch()
+    _start_stats()
 
 def postrun_handler(*args, **kwargs):
     """Celery postrun handler.  Unpatches and clears the localstore."""
+    task = kwargs.get('task') or kwargs.get('sender')
+    _log_stats(getattr(task, 'name', 'task'))
     unpatch()
     local.clear()
 
@@ -47,9 +60,11 @@ def celery_task_wrapper(f):
         new_kwargs = dict((key, val) for key, val in kwargs.items()
                                 if key in supported_keys)
 
+        _start_stats()
         try:
             ret = f(*args, **new_kwargs)
         finally:
+            _log_stats(f.__name__)
             local.clear()
         if not was_patched:
             get_backend().unpatch()
@@ -87,6 +87,37 @@ elif cache_backend == 'redis':
             'JOHNNY_CACHE': True,
         }
     }
+elif cache_backend == 'redis-scripted':
+    CACHES = {
+        'default': {
+            'BACKEND': 'johnny.backends.redis.ScriptedRedisCache',
+            'LOCATION': 'localhost:6379:0',
+            'JOHNNY_CACHE': True,
+        }
+    }
+elif cache_backend == 'redis-hashes':
+    CACHES = {
+        'default': {
+            'BACKEND': 'johnny.backends.redis.GenerationHashRedisCache',
+            'LOCATION': 'localhost:6379:0',
+            'JOHNNY_CACHE': True,
+        }
+    }
+elif cache_backend == 'tiered':
+    CACHES = {
+        'shared': {
+            'BACKEND': 'johnny.backends.memcached.MemcachedCache',
+            'LOCATION': ['localhost:11211'],
+        },
+        'local': {
+            'BACKEND': 'johnny.backends.locmem.LocMemCache',
+        },
+        'default': {
+            'BACKEND': 'johnny.backends.tiered.TieredCache',
+            'OPTIONS': {'LOCAL': 'local', 'SHARED': 'shared'},
+            'JOHNNY_CACHE': True,
+        }
+    }
 elif cache_backend == 'locmem':
     CACHES = {
         'default': {
@@ -26,7 +26,8 @@ setup(name='johnny-cache',
       author_email='jmoiron@jmoiron.net',
       url='http://github.com/jmoiron/johnny-cache',
       license='MIT',
-      packages=['johnny', 'johnny.backends'],
+      packages=['johnny', 'johnny.backends', 'johnny.management',
+                'johnny.management.commands'],
       scripts=[],
       # setuptools specific
       zip_safe=False,